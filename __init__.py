@@ -1,2 +1,6 @@
 from . import models
 from . import controllers
+
+
+def post_init_hook(env):
+    env["res.partner"]._backfill_phone_last10()
@@ -1,6 +1,6 @@
 {
     "name": "Aduanex",
-    "version": "18.0.1.11.0",
+    "version": "18.0.1.12.0",
     "category": "CRM",
     "summary": "Gestión de operaciones aduanales y pedimentos desde CRM",
     "depends": ["crm", "mail", "base", "contacts", "account"],
@@ -29,6 +29,7 @@
         "views/aduana_pedimento_views.xml",
         "views/aduana_crm_lead_bridge_views.xml",
         "views/res_partner_views.xml",
+        "views/mx_ped_rulepack_simulacion_wizard_views.xml",
         "views/mx_ped_rulepack_views.xml",
         "views/mx_ped_aduana_seccion_views.xml",
         "views/mx_tigie_maestra_views.xml",
@@ -54,6 +55,7 @@
     "license": "LGPL-3",
     "application": False,
     "installable": True,
+    "post_init_hook": "post_init_hook",
     "assets": {
         "web.assets_backend": [
             "modulo_aduana_odoo/static/src/scss/aduana_theme.scss",
@@ -2,12 +2,37 @@
 import base64
 import json
 import logging
+import threading
+import time
 
 from odoo import fields, http
 from odoo.http import request
 
 _logger = logging.getLogger(__name__)
 
+# Peticiones recientes a /portal/extract-csf por IP (por worker)
+_THROTTLE_WINDOW = 60  # segundos
+_THROTTLE_MAX_KEYS = 4096
+_THROTTLE = {}
+_THROTTLE_LOCK = threading.Lock()
+
+
+def _throttled(key, limit):
+    """True si `key` ya hizo `limit` peticiones en la última ventana."""
+    if limit <= 0:
+        return False
+    now = time.monotonic()
+    with _THROTTLE_LOCK:
+        hits = [t for t in _THROTTLE.get(key, ()) if now - t < _THROTTLE_WINDOW]
+        blocked = len(hits) >= limit
+        if not blocked:
+            hits.append(now)
+        _THROTTLE[key] = hits
+        if len(_THROTTLE) > _THROTTLE_MAX_KEYS:
+            for old_key in [k for k, v in _THROTTLE.items() if not v or now - v[-1] >= _THROTTLE_WINDOW]:
+                del _THROTTLE[old_key]
+    return blocked
+
 
 class PortalRegistrationController(http.Controller):
 
@@ -18,15 +43,33 @@ class PortalRegistrationController(http.Controller):
         methods=["POST"],
         csrf=False,
     )
-    def extract_csf(self, file_b64, **kwargs):
+    def extract_csf(self, file_b64, async_mode=False, **kwargs):
         """
         Recibe un PDF de CSF codificado en base64 y retorna los valores extraídos
         (RFC, CURP, domicilio, etc.) usando la lógica existente de _extract_csf_values.
+
+        Con async_mode=True responde de inmediato: si el PDF ya fue procesado
+        regresa los datos; si no, regresa un `job` para consultar en
+        /portal/extract-csf/status.
         """
         if not file_b64:
             return {"error": "No se recibió archivo"}
 
+        Extraction = request.env["mx.csf.extraction"].sudo()
+        if _throttled(request.httprequest.remote_addr, Extraction._portal_max_per_min()):
+            return {"error": "Demasiadas solicitudes. Espera un minuto e intenta de nuevo."}
+        # Tamaño aproximado del PDF sin decodificar el base64
+        error = Extraction._size_error(len(file_b64) * 3 // 4)
+        if error:
+            return {"error": error}
+
         try:
+            if async_mode:
+                content = base64.b64decode(file_b64)
+                result = Extraction._submit(content)
+                if result["state"] == "error":
+                    return {"error": result["error"], "state": "error"}
+                return dict(result, success=True)
             partner_model = request.env["res.partner"].sudo()
             extracted = partner_model._extract_csf_values(file_b64)
             if not extracted:
@@ -36,6 +79,20 @@ class PortalRegistrationController(http.Controller):
             _logger.exception("Error en extract_csf endpoint")
             return {"error": "Error procesando el CSF en el servidor"}
 
+    @http.route(
+        "/portal/extract-csf/status",
+        type="json",
+        auth="public",
+        methods=["POST"],
+        csrf=False,
+    )
+    def extract_csf_status(self, job, **kwargs):
+        """Estado de una extracción asíncrona: pending / done (con data) / error."""
+        result = request.env["mx.csf.extraction"].sudo()._status(job)
+        if result["state"] == "error":
+            return {"error": result["error"], "state": "error"}
+        return dict(result, success=True)
+
     @http.route(
         "/portal/register",
         type="json",
@@ -0,0 +1,74 @@
+"""
+Post-migration 18.0.1.12.0
+===========================
+Cambios de esquema que antes se hacían en `init()` (en cada carga del
+módulo) y ahora corren una sola vez:
+  - mx.vucem.log: cadena_original / xml_enviado / xml_recibido pasan de
+    columnas de texto a la columna comprimida payload_gz; las columnas
+    viejas se eliminan.
+  - mx.ped.registro: los metadatos indexados (partida_numero, sync_*,
+    source_id, valores_hash) se llenan por lotes para los registros
+    existentes.
+  - res.partner: x_phone_last10 / x_mobile_last10 se llenan para los
+    contactos previos a esos campos.
+  - payload_gz (mx.vucem.log y mx.ped.rule.trace) guarda los bytes
+    comprimidos tal cual; los valores en Base64 se decodifican.
+  - mx.ped.operacion.rule_trace_json pasa a una versión por operación en
+    mx.ped.rule.trace (rule_trace_id apunta a ella); la columna se elimina.
+"""
+import logging
+
+from odoo import SUPERUSER_ID, api
+from odoo.tools.sql import column_exists
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    if not version:
+        return  # instalación limpia — no hay columnas viejas
+
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env["mx.vucem.log"]._migrate_legacy_payload_columns()
+    _logger.info("post-migrate 12.0: payloads de mx.vucem.log migrados.")
+
+    for table in ("mx_vucem_log", "mx_ped_rule_trace"):
+        # Base64 nunca empieza con el prefijo de codec ('Z' zstd, 'G' gzip)
+        cr.execute(f"""
+            UPDATE {table}
+               SET payload_gz = decode(convert_from(payload_gz, 'UTF8'), 'base64')
+             WHERE payload_gz IS NOT NULL
+               AND get_byte(payload_gz, 0) NOT IN (ascii('Z'), ascii('G'))
+        """)
+        if cr.rowcount:
+            _logger.info("post-migrate 12.0: %s payloads de %s sin Base64.", cr.rowcount, table)
+
+    env["mx.ped.registro"]._backfill_registro_meta()
+    _logger.info("post-migrate 12.0: metadatos de mx.ped.registro extraídos.")
+
+    env["res.partner"]._backfill_phone_last10()
+    _logger.info("post-migrate 12.0: teléfonos normalizados de res.partner.")
+
+    if column_exists(cr, "mx_ped_operacion", "rule_trace_json"):
+        cr.execute("""
+            WITH nuevas AS (
+                INSERT INTO mx_ped_rule_trace
+                       (operacion_id, content_hash, payload, compressed, create_date, write_date)
+                SELECT op.id,
+                       encode(sha256(convert_to(op.rule_trace_json::text, 'UTF8')), 'hex'),
+                       op.rule_trace_json,
+                       FALSE,
+                       COALESCE(op.rule_trace_at, now() at time zone 'UTC'),
+                       COALESCE(op.rule_trace_at, now() at time zone 'UTC')
+                  FROM mx_ped_operacion op
+                 WHERE op.rule_trace_json IS NOT NULL
+                   AND op.rule_trace_id IS NULL
+             RETURNING id, operacion_id
+            )
+            UPDATE mx_ped_operacion op
+               SET rule_trace_id = nuevas.id
+              FROM nuevas
+             WHERE op.id = nuevas.operacion_id
+        """)
+        cr.execute("ALTER TABLE mx_ped_operacion DROP COLUMN rule_trace_json")
+        _logger.info("post-migrate 12.0: rule_trace_json migrado a mx.ped.rule.trace.")
@@ -28,7 +28,11 @@ from . import mx_ped_tipo_contenedor
 from . import mx_ped_numero_control
 from . import mx_ped_estructura_regla
 from . import mx_ped_rulepack
+from . import mx_ped_rule_trace
+from . import mx_ped_rulepack_simulacion_wizard
 from . import mx_wa_session
+from . import mx_wa_inbox
+from . import mx_csf_extraction
 from . import account_move
 from . import aduana_catalogos
 from . import aduana_pedimento
@@ -38,5 +42,6 @@ from . import audit_mixin
 from . import mx_firma_digital
 from . import mx_vucem_log
 from . import mx_cove
+from . import mx_cove_queue
 from . import mx_doda
 from . import mx_ped_mv
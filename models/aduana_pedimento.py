@@ -1,8 +1,91 @@
 # -*- coding: utf-8 -*-
 import base64
+import threading
+from collections import OrderedDict
+
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError, ValidationError
 
+# ── Planes compilados del layout técnico ─────────────────────────────────────
+# Por tipo de registro: campos ya ordenados por secuencia con su accesor de
+# ruta resuelto contra `_fields`.  La llave incluye (número de campos,
+# write_date más reciente) del tipo, así que editar el layout invalida el plan.
+_PLAN_CACHE_SIZE = 256
+_PLAN_CACHE = OrderedDict()
+_PLAN_CACHE_LOCK = threading.Lock()
+
+
+def _plan_cache_get(key):
+    with _PLAN_CACHE_LOCK:
+        if key not in _PLAN_CACHE:
+            return None
+        _PLAN_CACHE.move_to_end(key)
+        return _PLAN_CACHE[key]
+
+
+def _plan_cache_put(key, value):
+    with _PLAN_CACHE_LOCK:
+        _PLAN_CACHE[key] = value
+        _PLAN_CACHE.move_to_end(key)
+        while len(_PLAN_CACHE) > _PLAN_CACHE_SIZE:
+            _PLAN_CACHE.popitem(last=False)
+
+
+def _compile_path(env, model_name, path):
+    """Tupla de (campo, es_relacional) de una ruta punteada, o None si no existe."""
+    steps = []
+    model = env[model_name]
+    for part in (path or "").split("."):
+        if model is None or part not in model._fields:
+            return None
+        field = model._fields[part]
+        relational = bool(field.relational)
+        steps.append((part, relational))
+        model = env[field.comodel_name] if relational else None
+    return tuple(steps)
+
+
+def _read_path(record, steps):
+    """Valor de una ruta compilada (misma semántica que `_resolve_path`)."""
+    if steps is None:
+        return None
+    value = record
+    for part, relational in steps:
+        if not value:
+            return None
+        value = value[part]
+        if relational and value._name != "ir.attachment":
+            value = value[:1]
+    if steps[-1][1]:
+        if "code" in value._fields and value.code:
+            return value.code
+        if "name" in value._fields and value.name:
+            return value.name
+        return value.id
+    return value
+
+
+def _format_legacy_value(value, tipo_dato, longitud):
+    """Formatea un valor del layout técnico según tipo de dato y longitud."""
+    if value is None or value is False:
+        raw = ""
+    elif isinstance(value, bool):
+        raw = "1" if value else "0"
+    elif isinstance(value, float):
+        if tipo_dato == "money":
+            raw = f"{value:.2f}"
+        else:
+            raw = str(int(value)) if value == int(value) else str(value)
+    else:
+        raw = str(value)
+    longitud = longitud or 0
+    if longitud:
+        if tipo_dato in ("int", "float", "money"):
+            raw = raw[:longitud].rjust(longitud)
+        else:
+            raw = raw[:longitud].ljust(longitud)
+    return raw
+
 
 class AduanaPedimento(models.Model):
     _name = "aduana.pedimento"
@@ -59,62 +142,81 @@ class AduanaPedimento(models.Model):
     ]
 
     def _resolve_path(self, model_record, path):
-        value = model_record
-        for part in (path or "").split("."):
-            if not value or not hasattr(value, "_fields") or part not in value._fields:
-                return None
-            value = value[part]
-            if hasattr(value, "__len__") and hasattr(value, "_name") and value._name != "ir.attachment":
-                value = value[:1]
-        if hasattr(value, "id"):
-            if hasattr(value, "code") and value.code:
-                return value.code
-            if hasattr(value, "name") and value.name:
-                return value.name
-            return value.id
-        return value
+        return _read_path(model_record, _compile_path(self.env, model_record._name, path))
+
+    @api.model
+    def _layout_tecnico_plans(self, registro_tipos):
+        """{registro_tipo_id: plan} con los campos ordenados y rutas compiladas.
+
+        Cada plan es una tupla de (campo_id, nombre_tecnico, ruta o None,
+        default, tipo_dato, longitud); ruta None = el valor viene del payload.
+        """
+        if not registro_tipos:
+            return {}
+        cr = self.env.cr
+        self.env["aduana.layout_registro_campo"].flush_model()
+        cr.execute("""
+            SELECT registro_tipo_id, COUNT(*), MAX(write_date)
+              FROM aduana_layout_registro_campo
+             WHERE registro_tipo_id = ANY(%s)
+             GROUP BY registro_tipo_id
+        """, [list(registro_tipos.ids)])
+        firmas = {row[0]: (row[1], str(row[2])) for row in cr.fetchall()}
+        plans = {}
+        for tipo in registro_tipos:
+            key = (cr.dbname, tipo.id, firmas.get(tipo.id, (0, "")))
+            plan = _plan_cache_get(key)
+            if plan is None:
+                plan = tuple(
+                    (
+                        campo.id,
+                        campo.nombre_tecnico,
+                        _compile_path(self.env, self._name, campo.origen_campo)
+                        if campo.origen_modelo == self._name else None,
+                        campo.default,
+                        campo.tipo_dato,
+                        campo.longitud,
+                    )
+                    for campo in tipo.campo_ids.sorted("secuencia")
+                )
+                _plan_cache_put(key, plan)
+            plans[tipo.id] = plan
+        return plans
 
     def action_prepare_txt_payload(self):
         """Construye el payload TXT estructurado segun layout tecnico."""
         self.ensure_one()
+        registros = self.registro_tecnico_ids.sorted(lambda r: (r.registro_tipo_id.orden, r.id))
+        plans = self._layout_tecnico_plans(registros.registro_tipo_id)
+        # Las rutas del pedimento no dependen del registro: una lectura por ruta.
+        rutas = {}
+        Campo = self.env["aduana.layout_registro_campo"]
         lines = []
-        for reg in self.registro_tecnico_ids.sorted(lambda r: (r.registro_tipo_id.orden, r.id)):
+        for reg in registros:
+            plan = plans[reg.registro_tipo_id.id]
+            payload = reg.payload or {}
             line_values = {}
-            for field_def in reg.registro_tipo_id.campo_ids.sorted("secuencia"):
-                if field_def.origen_modelo == "aduana.pedimento":
-                    value = self._resolve_path(self, field_def.origen_campo)
+            for _campo_id, nombre, ruta, default, _tipo, _longitud in plan:
+                if ruta is not None:
+                    if ruta not in rutas:
+                        rutas[ruta] = _read_path(self, ruta)
+                    value = rutas[ruta]
                 else:
-                    value = reg.payload.get(field_def.nombre_tecnico) if reg.payload else None
-                if value in (None, "") and field_def.default:
-                    value = field_def.default
-                line_values[field_def.nombre_tecnico] = value
+                    value = payload.get(nombre)
+                if value in (None, "") and default:
+                    value = default
+                line_values[nombre] = value
             lines.append({
                 "registro": reg.registro_tipo_id.codigo,
                 "values": line_values,
-                "campo_ids": reg.registro_tipo_id.campo_ids.sorted("secuencia"),
+                "campo_ids": Campo.browse([item[0] for item in plan]),
+                "plan": plan,
             })
         return lines
 
     def _format_txt_value(self, value, campo):
         """Formatea un valor segun tipo de dato del campo."""
-        if value is None or value is False:
-            raw = ""
-        elif isinstance(value, bool):
-            raw = "1" if value else "0"
-        elif isinstance(value, float):
-            if campo.tipo_dato == "money":
-                raw = f"{value:.2f}"
-            else:
-                raw = str(int(value)) if value == int(value) else str(value)
-        else:
-            raw = str(value)
-        longitud = campo.longitud or 0
-        if longitud:
-            if campo.tipo_dato in ("int", "float", "money"):
-                raw = raw[:longitud].rjust(longitud)
-            else:
-                raw = raw[:longitud].ljust(longitud)
-        return raw
+        return _format_legacy_value(value, campo.tipo_dato, campo.longitud)
 
     def action_export_txt(self):
         """Exporta el pedimento en formato TXT pipe-delimitado segun layout tecnico."""
@@ -122,16 +224,17 @@ class AduanaPedimento(models.Model):
         if not self.registro_tecnico_ids:
             raise UserError(_("No hay registros tecnicos capturados para exportar."))
 
-        payload_lines = self.action_prepare_txt_payload()
-        txt_lines = []
-        for line in payload_lines:
-            codigo = line["registro"]
-            values = line["values"]
-            campos = line["campo_ids"]
-            row = [self._format_txt_value(values.get(c.nombre_tecnico), c) for c in campos]
-            txt_lines.append(codigo + "|" + "|".join(row))
+        from .pedimento_proforma_v2 import PedimentoDocumento, RegistroDoc
 
-        txt_content = "\n".join(txt_lines)
+        registros = []
+        for line in self.action_prepare_txt_payload():
+            values = line["values"]
+            row = tuple(
+                _format_legacy_value(values.get(nombre), tipo_dato, longitud)
+                for _campo_id, nombre, _ruta, _default, tipo_dato, longitud in line["plan"]
+            )
+            registros.append(RegistroDoc(codigo=line["registro"], campos=(line["registro"],) + row))
+        txt_content = PedimentoDocumento(registros=registros).to_txt()
         ref = (self.name or str(self.id)).replace("/", "_").replace(" ", "_")
         filename = f"pedimento_{ref}.txt"
 
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Servicio compartido de lectura de B/L (Bill of Lading) en PDF.
+
+Usado por `crm.lead._autofill_from_bl` y `mx.ped.operacion.action_read_bl`:
+
+  - Patrones regex compilados una sola vez a nivel módulo.
+  - Plantillas por naviera (`register_template`): si el texto coincide con
+    la firma de la naviera, sus patrones tienen prioridad sobre los genéricos.
+  - Extracción de texto con caché por checksum del archivo: re-guardar el
+    mismo PDF no vuelve a correr PyPDF2.
+  - Lectura directa del filestore (sin decodificar Base64 a memoria) cuando
+    el binario vive en un ir.attachment.
+"""
+import base64
+import hashlib
+import io
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    from PyPDF2 import PdfReader
+except Exception:  # pragma: no cover
+    PdfReader = None
+
+_logger = logging.getLogger(__name__)
+
+MAX_PAGES = 3
+_FLAGS = re.IGNORECASE | re.MULTILINE
+
+_WS_RE = re.compile(r"[ \t]+")
+_TOKEN_RE = re.compile(r"[A-Z0-9'/-]+")
+_NON_ALNUM_RE = re.compile(r"[^A-Z0-9]")
+_CONTAINER_RE = re.compile(r"^[A-Z]{4}\d{7}$")
+_CONTAINER_SEARCH_RE = re.compile(r"\b([A-Z]{4}\d{7})")
+
+# Orden = prioridad dentro de cada llave
+GENERIC_PATTERNS = {
+    "bl_no": (
+        re.compile(r"\bB/?L\s*(?:NO\.?|NUMBER)?\s*[:#]?\s*([A-Z0-9\-]+)", _FLAGS),
+        re.compile(r"\bMBL\s*[:#]?\s*([A-Z0-9\-]+)", _FLAGS),
+        re.compile(r"\bMASTER\s*B/?L\s*[:#]?\s*([A-Z0-9\-]+)", _FLAGS),
+    ),
+    "booking": (
+        re.compile(r"\bBOOKING(?:\s*NO\.?)?\s*[:#]?\s*([A-Z0-9\-]+)", _FLAGS),
+    ),
+    "seal": (
+        re.compile(r"\b(?:SEAL\s*NO\.?\s*[:#]?\s*|/)([A-Z0-9]{6,})\b", _FLAGS),
+    ),
+    "kgs": (
+        re.compile(r"(?<![\d.])(\d+(?:\.\d+)?)\s*KGS\b", _FLAGS),
+    ),
+    "cbm": (
+        re.compile(r"(\d+(?:\.\d+)?)\s*CBM\b", _FLAGS),
+    ),
+    "bultos": (
+        re.compile(r"/\s*(\d+)\s+[A-Z ]{2,20}/", _FLAGS),
+        re.compile(r"\b(\d+)\s+(?:WOODEN\s+CASES?|PACKAGES?|PKGS?)\b", _FLAGS),
+    ),
+    "loading": (
+        re.compile(r"Port of Loading\s*([A-Z0-9 ,\-\(\)]+)", _FLAGS),
+    ),
+    "discharge": (
+        re.compile(r"Port of discharge:\s*Place of delivery\s*([A-Z0-9 ,\-\(\)\/]+)", _FLAGS),
+    ),
+    "vessel": (
+        re.compile(r"Ocean Vessel\s+Voy\.?No\.\s+Port of Loading\s*([A-Z0-9 .,\-\(\)]+)", _FLAGS),
+    ),
+}
+
+PARSED_KEYS = ("bl_no", "booking", "container", "seal", "kgs", "cbm", "bultos", "loading", "discharge", "vessel")
+
+
+# ── Plantillas por naviera ───────────────────────────────────────────────────
+
+_TEMPLATES = []
+
+
+def register_template(name, detect, patterns):
+    """Registra patrones específicos de una naviera.
+
+    Args:
+        name    : identificador (se reporta en el resultado como "template")
+        detect  : regex (str) que identifica el B/L de la naviera
+        patterns: {llave: [regex str, ...]} que se prueban antes que los genéricos
+    """
+    _TEMPLATES[:] = [t for t in _TEMPLATES if t[0] != name]
+    _TEMPLATES.append((
+        name,
+        re.compile(detect, _FLAGS),
+        {key: tuple(re.compile(p, _FLAGS) for p in pats) for key, pats in patterns.items()},
+    ))
+
+
+register_template(
+    "msc",
+    r"\bMEDITERRANEAN SHIPPING COMPANY\b",
+    {"bl_no": [r"\b(MEDU[A-Z0-9]{6,10})\b"]},
+)
+register_template(
+    "maersk",
+    r"\bMAERSK\b",
+    {"bl_no": [r"\bB/L\s*No\.?\s*[:#]?\s*(\d{9})\b"]},
+)
+
+
+# ── Parseo de texto ──────────────────────────────────────────────────────────
+
+def _pick(patterns, clean):
+    for pat in patterns:
+        m = pat.search(clean)
+        if m:
+            return (m.group(1) or "").strip()
+    return False
+
+
+def _find_container(clean):
+    # El número de contenedor puede venir pegado con "/40'" u otros caracteres.
+    for tok in _TOKEN_RE.findall(clean.upper()):
+        candidate = _NON_ALNUM_RE.sub("", tok)
+        if _CONTAINER_RE.match(candidate):
+            return candidate
+    m = _CONTAINER_SEARCH_RE.search(clean.upper())
+    return m.group(1) if m else False
+
+
+def parse_bl_text(text):
+    """Extrae los datos logísticos del texto de un B/L.
+
+    Returns:
+        dict con las llaves de PARSED_KEYS (False si no se encontró) y
+        "template" con la plantilla de naviera aplicada (o False).
+    """
+    clean = _WS_RE.sub(" ", text or "")
+    template_name, overrides = False, {}
+    for name, detect, patterns in _TEMPLATES:
+        if detect.search(clean):
+            template_name, overrides = name, patterns
+            break
+
+    result = {"template": template_name}
+    for key, patterns in GENERIC_PATTERNS.items():
+        result[key] = _pick(overrides.get(key, ()), clean) or _pick(patterns, clean)
+    result["container"] = _pick(overrides.get("container", ()), clean) or _find_container(clean)
+    return result
+
+
+# ── Extracción de texto con caché ────────────────────────────────────────────
+
+_TEXT_CACHE_SIZE = 64
+_TEXT_CACHE = OrderedDict()
+_TEXT_CACHE_LOCK = threading.Lock()
+
+
+def extract_pdf_text(stream, max_pages=MAX_PAGES):
+    """Texto de las primeras `max_pages` páginas. `stream` es ruta o file-like."""
+    reader = PdfReader(stream)
+    chunks = []
+    for idx, page in enumerate(reader.pages):
+        if idx >= max_pages:
+            break
+        chunks.append(page.extract_text() or "")
+    return "\n".join(chunks)
+
+
+def _cached_text(checksum, opener, max_pages):
+    key = (checksum, max_pages)
+    with _TEXT_CACHE_LOCK:
+        if key in _TEXT_CACHE:
+            _TEXT_CACHE.move_to_end(key)
+            return _TEXT_CACHE[key]
+    source = opener()
+    try:
+        text = extract_pdf_text(source, max_pages=max_pages)
+    finally:
+        if hasattr(source, "close"):
+            source.close()
+    with _TEXT_CACHE_LOCK:
+        _TEXT_CACHE[key] = text
+        while len(_TEXT_CACHE) > _TEXT_CACHE_SIZE:
+            _TEXT_CACHE.popitem(last=False)
+    return text
+
+
+def get_bl_attachment(record, field_name):
+    """ir.attachment que respalda el campo Binary (o vacío si no aplica)."""
+    if not record.id or not isinstance(record.id, int):
+        return record.env["ir.attachment"]
+    return record.env["ir.attachment"].sudo().search([
+        ("res_model", "=", record._name),
+        ("res_field", "=", field_name),
+        ("res_id", "=", record.id),
+    ], limit=1)
+
+
+def read_bl_text(record, field_name, max_pages=MAX_PAGES):
+    """Texto del PDF guardado en record[field_name], cacheado por checksum.
+
+    Si el binario está en el filestore se lee directo del archivo; si no
+    (onchange, adjunto en BD) se decodifica el valor Base64 del campo.
+    """
+    attachment = get_bl_attachment(record, field_name)
+    if attachment and attachment.checksum:
+        if attachment.store_fname:
+            path = attachment._full_path(attachment.store_fname)
+            return _cached_text(attachment.checksum, lambda: open(path, "rb"), max_pages)
+        return _cached_text(attachment.checksum, lambda: io.BytesIO(attachment.raw), max_pages)
+
+    value = record[field_name]
+    if not value:
+        return ""
+    pdf_bytes = base64.b64decode(value)
+    checksum = hashlib.sha1(pdf_bytes).hexdigest()
+    return _cached_text(checksum, lambda: io.BytesIO(pdf_bytes), max_pages)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Resolución de países a clave corta para el exportador TXT.
+
+El mapa se arma una vez por worker y base de datos con una consulta a
+`res.country` (código y nombre en todos los idiomas) y otra a
+`aduana.catalogo.pais` (clave SAAI M3 y nombre en español, vía su
+`country_id`).  Las llaves son texto normalizado (mayúsculas, sin acentos
+ni espacios repetidos), así que resolver un valor es un acceso a dict.
+
+Precedencia (igual que la búsqueda anterior en `res.country`):
+  1. código exacto (ISO o SAAI M3);
+  2. nombre exacto;
+  3. nombre que contiene el texto (primer país por nombre).
+Los nombres ambiguos (gana el primero) o sin resolver se registran en el
+log para depurar el catálogo; los de exportación, una sola vez por worker.
+"""
+import logging
+import threading
+import unicodedata
+
+_logger = logging.getLogger(__name__)
+
+_MAPS = {}
+_MAPS_LOCK = threading.Lock()
+_CR_KEY = "mx_ped_country_map"
+
+_STAMP_SQL = """
+    SELECT (SELECT COUNT(*) FROM res_country),
+           (SELECT MAX(write_date) FROM res_country),
+           (SELECT COUNT(*) FROM aduana_catalogo_pais),
+           (SELECT MAX(write_date) FROM aduana_catalogo_pais)
+"""
+_COUNTRY_SQL = "SELECT code, name FROM res_country WHERE code IS NOT NULL ORDER BY id"
+_CATALOGO_SQL = """
+    SELECT p.saai_m3, p.name, c.code
+      FROM aduana_catalogo_pais p
+      JOIN res_country c ON c.id = p.country_id
+     WHERE p.active AND c.code IS NOT NULL
+     ORDER BY p.id
+"""
+
+
+def normalize_text(value):
+    txt = unicodedata.normalize("NFKD", str(value or ""))
+    txt = "".join(ch for ch in txt if not unicodedata.combining(ch))
+    return " ".join(txt.upper().split())
+
+
+class CountryMap:
+    """Texto normalizado → código de país; solo el memo de subcadenas crece."""
+
+    __slots__ = ("codes", "names", "ordered_names", "_reported", "_resolved")
+
+    def __init__(self, codes, names, ordered_names):
+        self.codes = codes
+        self.names = names
+        self.ordered_names = ordered_names
+        self._reported = set()
+        # Memo de resoluciones por subcadena (sin consultas a la BD).
+        self._resolved = {}
+
+    def resolve(self, token):
+        """Código del país para `token`, o None."""
+        key = normalize_text(token)
+        if not key:
+            return None
+        code = self.codes.get(key) or self.names.get(key)
+        if code:
+            return code
+        if key in self._resolved:
+            return self._resolved[key]
+        matches = [(name, code) for name, code in self.ordered_names if key in name]
+        code = matches[0][1] if matches else None
+        if len({c for _n, c in matches}) > 1:
+            self._report("País ambiguo en exportación: %r coincide con %s", key, sorted({n for n, _c in matches}))
+        elif not matches:
+            self._report("País sin resolver en exportación: %r", key)
+        self._resolved[key] = code
+        return code
+
+    def _report(self, msg, key, *args):
+        if key in self._reported:
+            return
+        self._reported.add(key)
+        _logger.warning(msg, key, *args)
+
+
+def build_map(country_rows, catalogo_rows):
+    """CountryMap desde filas (code, name) de res.country y (saai_m3, name, code) del catálogo."""
+    codes = {}
+    names = {}
+    ambiguos = set()
+
+    def add_name(name, code):
+        key = normalize_text(name)
+        if not key:
+            return
+        if key in names and names[key] != code:
+            ambiguos.add(key)
+        names.setdefault(key, code)
+
+    for code, name in country_rows:
+        code = (code or "").strip().upper()
+        codes[code] = code
+        for text in (name.values() if isinstance(name, dict) else [name]):
+            add_name(text, code)
+    for saai_m3, name, code in catalogo_rows:
+        code = (code or "").strip().upper()
+        codes.setdefault(normalize_text(saai_m3), code)
+        add_name(name, code)
+    for key in sorted(ambiguos):
+        _logger.warning("Nombre de país ambiguo en catálogos (se usa el primero): %r", key)
+    ordered_names = tuple(sorted(names.items()))
+    return CountryMap(codes, names, ordered_names)
+
+
+def get_map(cr):
+    """CountryMap de la base de datos (firma revisada una vez por transacción)."""
+    mapa = cr.cache.get(_CR_KEY)
+    if mapa is not None:
+        return mapa
+    cr.execute(_STAMP_SQL)
+    stamp = tuple(str(value) for value in cr.fetchone())
+    with _MAPS_LOCK:
+        hit = _MAPS.get(cr.dbname)
+    if hit and hit[0] == stamp:
+        mapa = hit[1]
+    else:
+        cr.execute(_COUNTRY_SQL)
+        country_rows = cr.fetchall()
+        cr.execute(_CATALOGO_SQL)
+        mapa = build_map(country_rows, cr.fetchall())
+        with _MAPS_LOCK:
+            _MAPS[cr.dbname] = (stamp, mapa)
+    cr.cache[_CR_KEY] = mapa
+    return mapa
+
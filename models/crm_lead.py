@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import base64
-import io
 import logging
 import re
 from datetime import datetime
@@ -9,10 +8,8 @@ import requests
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError, ValidationError
 
-try:
-    from PyPDF2 import PdfReader
-except Exception:  # pragma: no cover
-    PdfReader = None
+from . import bl_parser
+from .bl_parser import PdfReader
 
 _logger = logging.getLogger(__name__)
 _UUID_RE = re.compile(
@@ -379,6 +376,12 @@ class CrmLead(models.Model):
     x_bl_file = fields.Binary(string="Archivo B/L (PDF)")
     x_bl_filename = fields.Char(string="Nombre archivo B/L")
     x_bl_last_read = fields.Datetime(string="Ultima lectura B/L", readonly=True)
+    x_bl_parse_pending = fields.Boolean(
+        string="Lectura B/L en proceso",
+        readonly=True,
+        index=True,
+        help="El B/L es grande y se está leyendo en segundo plano.",
+    )
     x_factura_pdf_file = fields.Binary(string="Factura mercancia (PDF)")
     x_factura_pdf_filename = fields.Char(string="Nombre factura PDF")
     x_factura_xml_file = fields.Binary(string="Factura mercancia (XML CFDI)")
@@ -776,8 +779,7 @@ class CrmLead(models.Model):
         if not self.env.context.get("skip_sync_tipo_cambio_banxico"):
             self._sync_tipo_cambio_banxico()
         if "x_bl_file" in vals and not self.env.context.get("skip_bl_autoparse"):
-            for rec in self:
-                rec._autofill_from_bl(onchange_mode=False)
+            self._bl_autoparse_after_save()
         if "x_factura_xml_file" in vals and not self.env.context.get("skip_cfdi_autovalidate"):
             for rec in self:
                 rec._autovalidate_cfdi_xml(onchange_mode=False)
@@ -1012,54 +1014,41 @@ class CrmLead(models.Model):
             'target': 'self',
         }
 
-    def _extract_bl_pdf_text(self, pdf_bytes):
-        if not PdfReader:
-            raise UserError(_("Falta dependencia PyPDF2 en el servidor para leer PDF de B/L."))
-        reader = PdfReader(io.BytesIO(pdf_bytes))
-        chunks = []
-        for page in reader.pages[:3]:
-            chunks.append(page.extract_text() or "")
-        return "\n".join(chunks)
-
     def _parse_bl_text(self, text):
-        clean = re.sub(r"[ \t]+", " ", text or "")
+        return bl_parser.parse_bl_text(text)
 
-        def _pick(patterns):
-            for pat in patterns:
-                m = re.search(pat, clean, re.IGNORECASE | re.MULTILINE)
-                if m:
-                    return (m.group(1) or "").strip()
-            return False
-
-        # Container number can come glued with "/40'" or other chars.
-        container = False
-        for tok in re.findall(r"[A-Z0-9'/-]+", clean.upper()):
-            candidate = re.sub(r"[^A-Z0-9]", "", tok)
-            if re.match(r"^[A-Z]{4}\d{7}$", candidate):
-                container = candidate
-                break
+    def _bl_should_defer(self):
+        """B/L grande: se procesa en segundo plano (cron) en lugar de en el write."""
+        self.ensure_one()
+        attachment = bl_parser.get_bl_attachment(self, "x_bl_file")
+        min_kb = int(
+            self.env["ir.config_parameter"].sudo().get_param("mx_ped.bl.async_min_kb", "1024") or 0
+        )
+        return bool(attachment) and min_kb > 0 and (attachment.file_size or 0) > min_kb * 1024
+
+    def _bl_autoparse_after_save(self):
+        deferred = self.filtered(lambda r: r.x_bl_file and r._bl_should_defer())
+        for rec in self - deferred:
+            rec._autofill_from_bl(onchange_mode=False)
+        if deferred:
+            deferred.with_context(skip_bl_autoparse=True).write({"x_bl_parse_pending": True})
+            cron = self.env.ref("modulo_aduana_odoo.cron_procesar_bl_pendientes", raise_if_not_found=False)
+            if cron:
+                cron._trigger()
 
-        return {
-            "bl_no": _pick([
-                r"\bB/?L\s*(?:NO\.?|NUMBER)?\s*[:#]?\s*([A-Z0-9\-]+)",
-                r"\bMBL\s*[:#]?\s*([A-Z0-9\-]+)",
-                r"\bMASTER\s*B/?L\s*[:#]?\s*([A-Z0-9\-]+)",
-            ]),
-            "booking": _pick([
-                r"\bBOOKING(?:\s*NO\.?)?\s*[:#]?\s*([A-Z0-9\-]+)",
-            ]),
-            "container": container,
-            "seal": _pick([r"\b(?:SEAL\s*NO\.?\s*[:#]?\s*|/)([A-Z0-9]{6,})\b"]),
-            "kgs": _pick([r"(\d{1,6}(?:\.\d{1,3})?)\s*KGS\b"]),
-            "cbm": _pick([r"(\d+(?:\.\d+)?)\s*CBM\b"]),
-            "bultos": _pick([
-                r"/\s*(\d+)\s+[A-Z ]{2,20}/",
-                r"\b(\d+)\s+(?:WOODEN\s+CASES?|PACKAGES?|PKGS?)\b",
-            ]),
-            "loading": _pick([r"Port of Loading\s*([A-Z0-9 ,\-\(\)]+)"]),
-            "discharge": _pick([r"Port of discharge:\s*Place of delivery\s*([A-Z0-9 ,\-\(\)\/]+)"]),
-            "vessel": _pick([r"Ocean Vessel\s+Voy\.?No\.\s+Port of Loading\s*([A-Z0-9 .,\-\(\)]+)"]),
-        }
+    @api.model
+    def cron_procesar_bl_pendientes(self, limit=20):
+        leads = self.search([("x_bl_parse_pending", "=", True)], limit=limit)
+        for lead in leads:
+            try:
+                with self.env.cr.savepoint():
+                    lead._autofill_from_bl(onchange_mode=False)
+            except Exception:
+                _logger.exception("B/L diferido falló en lead %s", lead.id)
+        leads.with_context(skip_bl_autoparse=True).write({"x_bl_parse_pending": False})
+        if self.search_count([("x_bl_parse_pending", "=", True)], limit=1):
+            self.env.ref("modulo_aduana_odoo.cron_procesar_bl_pendientes")._trigger()
+        return True
 
     def action_read_bl(self):
         self.ensure_one()
@@ -1081,7 +1070,13 @@ class CrmLead(models.Model):
 
     @api.onchange("x_bl_file")
     def _onchange_x_bl_file_autoread(self):
+        min_kb = int(
+            self.env["ir.config_parameter"].sudo().get_param("mx_ped.bl.async_min_kb", "1024") or 0
+        )
         for rec in self:
+            # Los B/L grandes se leen al guardar, en segundo plano
+            if min_kb and rec.x_bl_file and len(rec.x_bl_file) * 3 // 4 > min_kb * 1024:
+                continue
             rec._autofill_from_bl(onchange_mode=True)
 
     @api.onchange("x_factura_xml_file")
@@ -1099,8 +1094,9 @@ class CrmLead(models.Model):
         if not self.x_bl_file:
             return
         try:
-            pdf_bytes = base64.b64decode(self.x_bl_file)
-            parsed = self._parse_bl_text(self._extract_bl_pdf_text(pdf_bytes))
+            if not PdfReader:
+                raise UserError(_("Falta dependencia PyPDF2 en el servidor para leer PDF de B/L."))
+            parsed = self._parse_bl_text(bl_parser.read_bl_text(self, "x_bl_file"))
         except Exception:
             _logger.exception("B/L parse error on lead %s (%s)", self.id, self.name)
             if raise_if_empty:
@@ -1916,7 +1912,7 @@ class CrmLead(models.Model):
             leads._sync_tipo_cambio_banxico()
         for i, lead in enumerate(leads):
             if has_bl_file[i]:
-                lead._autofill_from_bl(onchange_mode=False)
+                lead._bl_autoparse_after_save()
             if has_cfdi_xml[i]:
                 lead._autovalidate_cfdi_xml(onchange_mode=False)
             elif has_cfdi_pdf[i]:
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Servicio de extracción de la Constancia de Situación Fiscal (CSF) del SAT.
+
+Usado por `res.partner._extract_csf_values` y por las extracciones
+asíncronas del portal (`mx.csf.extraction`):
+
+  - QR: se renderiza solo la primera página a DPI reducido y se decodifica
+    primero la mitad superior (donde el SAT imprime el QR); solo si no se
+    encuentra se intenta la página completa a la resolución normal.
+  - Consulta al SAT con una sesión HTTP por hilo montada con `DESAdapter`
+    (el portal del SAT exige cifrados antiguos).
+  - Cachés por worker: resultado por SHA-256 del PDF y por URL del QR (el
+    mismo CSF re-enviado en /portal/register no vuelve a correr poppler
+    ni a consultar al SAT).
+"""
+import hashlib
+import logging
+import re
+import ssl
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+try:
+    from pyzbar.pyzbar import decode
+    from pdf2image import convert_from_bytes
+    from bs4 import BeautifulSoup
+except ImportError:
+    decode = None
+
+_logger = logging.getLogger(__name__)
+
+QR_FAST_DPI = 100
+QR_FULL_DPI = 200
+
+_RFC_RE = re.compile(r"\b([A-ZÑ&]{3,4}\d{6}[A-Z0-9]{3})\b", re.IGNORECASE)
+
+
+class DESAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        context.set_ciphers("DEFAULT@SECLEVEL=1")
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        kwargs["ssl_context"] = context
+        return super(DESAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+_HTTP_LOCAL = threading.local()
+
+
+def _sat_http():
+    session = getattr(_HTTP_LOCAL, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.mount("https://", DESAdapter())
+        _HTTP_LOCAL.session = session
+    return session
+
+
+# ── Cachés ───────────────────────────────────────────────────────────────────
+
+_CACHE_SIZE = 256
+_CACHE_TTL = 6 * 3600  # segundos: el domicilio fiscal puede cambiar
+_PDF_CACHE = OrderedDict()   # sha256 → (vals, expira)
+_QR_CACHE = OrderedDict()    # url QR → (vals, expira)
+_CACHE_LOCK = threading.Lock()
+
+
+def _cache_get(cache, key):
+    with _CACHE_LOCK:
+        hit = cache.get(key)
+        if not hit:
+            return None
+        if hit[1] < time.monotonic():
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return dict(hit[0])
+
+
+def _cache_put(cache, key, vals):
+    with _CACHE_LOCK:
+        cache[key] = (dict(vals), time.monotonic() + _CACHE_TTL)
+        cache.move_to_end(key)
+        while len(cache) > _CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def cached_values(sha256):
+    """Valores ya extraídos para el PDF con ese SHA-256 (o None)."""
+    return _cache_get(_PDF_CACHE, sha256)
+
+
+# ── Extracción ───────────────────────────────────────────────────────────────
+
+def available():
+    return decode is not None
+
+
+def read_qr_url(content):
+    """URL del QR de la CSF (o False)."""
+    images = convert_from_bytes(content, dpi=QR_FAST_DPI, first_page=1, last_page=1)
+    if not images:
+        return False
+    page = images[0]
+    width, height = page.size
+    codes = decode(page.crop((0, 0, width, height // 2))) or decode(page)
+    if not codes:
+        images = convert_from_bytes(content, dpi=QR_FULL_DPI, first_page=1, last_page=1)
+        codes = decode(images[0]) if images else []
+    if not codes:
+        return False
+    return codes[0].data.decode("utf-8")
+
+
+def parse_sat_page(html):
+    """Datos fiscales de la página de verificación del SAT."""
+    soup = BeautifulSoup(html, "html.parser")
+
+    # Intentar extraer con <td> (estructura clásica del SAT)
+    tds = soup.find_all("td")
+    page_data = {}
+    for i in range(len(tds) - 1):
+        label = tds[i].get_text().replace(":", "").strip().upper()
+        value = tds[i + 1].get_text(strip=True)
+        if "RFC" in label:
+            page_data["rfc"] = value
+        if "CURP" in label:
+            page_data["curp"] = value
+        if "CP" in label or "CODIGO POSTAL" in label:
+            page_data["cp"] = value
+        if "VIALIDAD" in label or "NOMBRE DE LA CALLE" in label:
+            page_data["calle"] = value
+        if "EXTERIOR" in label:
+            page_data["n_ext"] = value
+        if "INTERIOR" in label:
+            page_data["n_int"] = value
+        if "COLONIA" in label:
+            page_data["colonia"] = value
+        if "MUNICIPIO" in label or "DEMARCACION" in label or "ALCALDIA" in label:
+            page_data["municipio"] = value
+        if "LOCALIDAD" in label:
+            page_data["localidad"] = value
+
+    # Si no se encontró RFC con <td>, buscar en toda la página con regex
+    if not page_data.get("rfc"):
+        rfc_match = _RFC_RE.search(html)
+        if rfc_match:
+            page_data["rfc"] = rfc_match.group(1).upper()
+            _logger.info("CSF: RFC extraído via regex: %s", page_data["rfc"])
+
+    # Intentar también con <span>, <div>, <p> si aún no hay RFC
+    if not page_data.get("rfc"):
+        for tag in soup.find_all(["span", "div", "p", "li"]):
+            text = tag.get_text(strip=True)
+            if "RFC" in text.upper() and len(text) < 60:
+                rfc_match = _RFC_RE.search(text)
+                if rfc_match:
+                    page_data["rfc"] = rfc_match.group(1).upper()
+                    _logger.info("CSF: RFC extraído via tag alternativo: %s", page_data["rfc"])
+                    break
+    return page_data
+
+
+def partner_vals(page_data):
+    """Traduce los datos del SAT a valores de res.partner."""
+    vals = {}
+    if page_data.get("rfc"):
+        vals["vat"] = page_data["rfc"]
+    if page_data.get("curp"):
+        vals["x_curp"] = page_data["curp"]
+    if page_data.get("cp"):
+        vals["zip"] = page_data["cp"]
+    calle = page_data.get("calle", "")
+    nexten = page_data.get("n_ext", "")
+    if calle:
+        vals["street"] = ("%s %s" % (calle, nexten)).strip()
+        vals["x_street_name"] = calle
+    if page_data.get("n_ext"):
+        vals["x_street_number_ext"] = page_data["n_ext"]
+    if page_data.get("n_int"):
+        vals["x_street_number_int"] = page_data["n_int"]
+    if page_data.get("colonia"):
+        vals["x_colonia"] = page_data["colonia"]
+    if page_data.get("municipio"):
+        vals["x_municipio"] = page_data["municipio"]
+    if page_data.get("localidad"):
+        vals["x_localidad"] = page_data["localidad"]
+    return vals
+
+
+def extract_values(content, sha256=None):
+    """Valores de res.partner a partir de los bytes del PDF de la CSF.
+
+    Returns:
+        dict (vacío si no hay QR legible o el SAT no respondió; esos casos
+        no se cachean para permitir reintentar).
+    """
+    if not content or not available():
+        return {}
+    sha256 = sha256 or hashlib.sha256(content).hexdigest()
+    vals = cached_values(sha256)
+    if vals is not None:
+        return vals
+
+    qr_url = read_qr_url(content)
+    if not qr_url:
+        _logger.warning("CSF sin QR detectable.")
+        return {}
+
+    vals = _cache_get(_QR_CACHE, qr_url)
+    if vals is None:
+        response = _sat_http().get(qr_url, timeout=15, verify=False)
+        if response.status_code != 200:
+            _logger.warning("CSF QR URL respondio %s", response.status_code)
+            return {}
+        vals = partner_vals(parse_sat_page(response.text))
+        _cache_put(_QR_CACHE, qr_url, vals)
+    _cache_put(_PDF_CACHE, sha256, vals)
+    return vals
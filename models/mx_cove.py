@@ -721,6 +721,34 @@ class MxCove(models.Model):
             "credencial_id": self.credencial_id.id,
         })
 
+    def _procesar_acuse_cove(self, respuesta, firma_data, ambiente, duracion):
+        """Guarda el Acuse de RecibirCove en el COVE y registra el log.
+
+        Returns:
+            tuple (numero_operacion, mensaje_informativo)
+        """
+        self.ensure_one()
+        num_op = str(getattr(respuesta, "numeroDeOperacion", "") or "")
+        hora = getattr(respuesta, "horaRecepcion", None)
+        mensaje = str(getattr(respuesta, "mensajeInformativo", "") or "")
+
+        self.write({
+            "estado": "enviado",
+            "numero_operacion_vucem": num_op,
+            "acuse_hora_recepcion": hora,
+            "acuse_mensaje": mensaje,
+            "cadena_original_guardada": firma_data["cadena_original"],
+        })
+
+        self._registrar_log(
+            "registrar_cove", ambiente, "exitoso",
+            cadena=firma_data["cadena_original"],
+            xml_recibido=str(respuesta),
+            numero_operacion=num_op,
+            duracion_ms=duracion,
+        )
+        return num_op, mensaje
+
     def action_transmitir_cove(self):
         """Acción principal: firmar y transmitir el COVE a VUCEM."""
         self.ensure_one()
@@ -763,25 +791,7 @@ class MxCove(models.Model):
             ) from exc
 
         # 4. Procesar respuesta (Acuse)
-        num_op = str(getattr(respuesta, "numeroDeOperacion", "") or "")
-        hora = getattr(respuesta, "horaRecepcion", None)
-        mensaje = str(getattr(respuesta, "mensajeInformativo", "") or "")
-
-        self.write({
-            "estado": "enviado",
-            "numero_operacion_vucem": num_op,
-            "acuse_hora_recepcion": hora,
-            "acuse_mensaje": mensaje,
-            "cadena_original_guardada": firma_data["cadena_original"],
-        })
-
-        self._registrar_log(
-            "registrar_cove", ambiente, "exitoso",
-            cadena=firma_data["cadena_original"],
-            xml_recibido=str(respuesta),
-            numero_operacion=num_op,
-            duracion_ms=duracion,
-        )
+        num_op, mensaje = self._procesar_acuse_cove(respuesta, firma_data, ambiente, duracion)
 
         return {
             "type": "ir.actions.client",
@@ -800,23 +810,34 @@ class MxCove(models.Model):
 
     def action_consultar_resultado(self):
         """Consulta el resultado de la transmisión en VUCEM usando el núm. de operación."""
+        e_doc, errores = self._consultar_resultado()
+        msg = f"e-Document: {e_doc}" if e_doc else f"Sin e-document aún. Errores: {errores}"
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Consulta VUCEM"),
+                "message": msg,
+                "type": "success" if e_doc else "warning",
+                "sticky": bool(e_doc),
+            },
+        }
+
+    def _consultar_resultado(self):
+        """Consulta VUCEM y guarda el acuse. Devuelve ``(e_document, errores)``."""
         self.ensure_one()
         if not self.numero_operacion_vucem:
             raise UserError("No hay número de operación VUCEM. Transmite primero el COVE.")
         if not _ZEEP_OK:
             raise UserError("La librería 'zeep' no está instalada.")
 
-        import base64 as _base64
         cred = self.credencial_id
-        cert_bytes = _base64.b64decode(cred.cert_file)
-        key_bytes = _base64.b64decode(cred.key_file)
-        private_key = self._firma_load_private_key(key_bytes, cred.key_password)
+        private_key, cert_b64 = self._firma_get_material(cred)
 
         # Cadena original para consulta: |numOperacion|RFC|
         rfc = cred.ws_username  # El RFC es el usuario VUCEM
         cadena = self._build_cadena_consulta(self.numero_operacion_vucem, rfc)
         firma_b64 = self._firma_sign_b64(private_key, cadena)
-        cert_b64 = self._firma_cert_to_b64(cert_bytes)
 
         ambiente = cred.ambiente or "pruebas"
         consulta_endpoint = VUCEM_CONSULTA_URLS.get(ambiente, VUCEM_CONSULTA_URLS["pruebas"])
@@ -875,16 +896,19 @@ class MxCove(models.Model):
             error_desc=errores or None,
             duracion_ms=duracion,
         )
+        return e_doc, errores
 
-        msg = f"e-Document: {e_doc}" if e_doc else f"Sin e-document aún. Errores: {errores}"
+    def action_encolar_transmision(self):
+        """Encola los COVEs seleccionados para transmisión por el cron de la cola."""
+        entries = self.env["mx.cove.queue"]._encolar(self)
         return {
             "type": "ir.actions.client",
             "tag": "display_notification",
             "params": {
-                "title": _("Consulta VUCEM"),
-                "message": msg,
-                "type": "success" if e_doc else "warning",
-                "sticky": bool(e_doc),
+                "title": _("Cola VUCEM"),
+                "message": _("%s COVE(s) encolados para transmisión.") % len(entries),
+                "type": "success" if entries else "warning",
+                "sticky": False,
             },
         }
 
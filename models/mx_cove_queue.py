@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Cola de transmisión masiva de COVEs a VUCEM.
+
+`mx.cove.action_transmitir_cove` es síncrono y de un solo registro; en
+consolidados con decenas de COVEs el usuario los envía uno por uno.  Esta
+cola desacopla la transmisión:
+
+  pending → signing → sent → acknowledged
+                   ↘ failed
+
+El cron `cron_procesar_cola_cove`:
+  1. Firma y arma el payload de cada entrada pendiente (ORM, hilo principal).
+  2. Envía los SOAP RecibirCove en paralelo acotado (solo HTTP, sin ORM),
+     respetando un límite de peticiones por segundo hacia VUCEM.
+  3. Guarda los acuses y programa la consulta de resultado
+     (`_consultar_resultado`) con backoff hasta obtener el e-document.
+
+Parámetros (ir.config_parameter):
+  mx_ped.cove_queue.batch_size   entradas por corrida (default 50)
+  mx_ped.cove_queue.max_workers  peticiones HTTP simultáneas (default 4)
+  mx_ped.cove_queue.rps          peticiones por segundo a VUCEM (default 2)
+  mx_ped.cove_queue.poll_minutes espera inicial antes de consultar (default 5)
+  mx_ped.cove_queue.max_polls    consultas antes de marcar fallido (default 12)
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+ESTADO_COLA = [
+    ("pending", "Pendiente"),
+    ("signing", "Firmando"),
+    ("sent", "Enviado — esperando e-document"),
+    ("acknowledged", "Con e-document"),
+    ("failed", "Fallido"),
+]
+
+
+class _RateLimiter:
+    """Limitador simple de peticiones por segundo compartido entre hilos.
+
+    Reparte los turnos a intervalos fijos de 1/rps; cada hilo reserva el
+    siguiente turno bajo lock y duerme fuera de él.
+    """
+
+    def __init__(self, rps):
+        self._interval = 1.0 / rps if rps and rps > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def wait(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MxCoveQueue(models.Model):
+    _name = "mx.cove.queue"
+    _description = "Cola de transmisión COVE"
+    _order = "id"
+    _rec_name = "cove_id"
+
+    cove_id = fields.Many2one(
+        "mx.cove",
+        string="COVE",
+        required=True,
+        ondelete="cascade",
+        index=True,
+    )
+    credencial_id = fields.Many2one(
+        related="cove_id.credencial_id",
+        string="Credencial",
+        store=True,
+        index=True,
+    )
+    state = fields.Selection(
+        ESTADO_COLA,
+        string="Estado",
+        default="pending",
+        required=True,
+        index=True,
+    )
+    attempts = fields.Integer(string="Intentos de envío", default=0)
+    poll_count = fields.Integer(string="Consultas realizadas", default=0)
+    sent_at = fields.Datetime(string="Enviado el", readonly=True)
+    next_poll_at = fields.Datetime(
+        string="Próxima consulta",
+        index=True,
+        help="Momento en que el cron consultará el resultado en VUCEM.",
+    )
+    last_error = fields.Text(string="Último error", readonly=True)
+
+    _sql_constraints = [
+        (
+            "mx_cove_queue_cove_uniq",
+            "unique(cove_id)",
+            "El COVE ya está en la cola de transmisión.",
+        ),
+    ]
+
+    # ── Parámetros ────────────────────────────────────────────────────────────
+
+    @api.model
+    def _queue_param(self, key, default, cast=int):
+        raw = self.env["ir.config_parameter"].sudo().get_param(f"mx_ped.cove_queue.{key}")
+        try:
+            return cast(raw) if raw not in (None, False, "") else default
+        except (TypeError, ValueError):
+            _logger.warning("Parámetro mx_ped.cove_queue.%s inválido (%r), usando %s", key, raw, default)
+            return default
+
+    # ── Alta en la cola ───────────────────────────────────────────────────────
+
+    @api.model
+    def _encolar(self, coves):
+        """Encola COVEs transmitibles. Reutiliza la entrada existente si falló.
+
+        Una entrada fallida se reinicia aunque el COVE ya no esté en borrador:
+        al agotarse las consultas el COVE queda ``enviado`` y debe poder
+        volver a la cola.
+        """
+        existing = self.search([("cove_id", "in", coves.ids)])
+        by_cove = {e.cove_id.id: e for e in existing}
+        to_reset = existing.filtered(lambda e: e.state == "failed")
+        coves = coves.filtered(lambda c: c.estado in ("borrador", "rechazado"))
+        if to_reset:
+            to_reset.write({
+                "state": "pending",
+                "attempts": 0,
+                "poll_count": 0,
+                "next_poll_at": False,
+                "last_error": False,
+            })
+        new = self.create([{"cove_id": c.id} for c in coves if c.id not in by_cove])
+        return new | to_reset
+
+    def action_reintentar(self):
+        self.filtered(lambda e: e.state == "failed").write({
+            "state": "pending",
+            "last_error": False,
+            "next_poll_at": False,
+            "poll_count": 0,
+        })
+        return True
+
+    # ── Cron ──────────────────────────────────────────────────────────────────
+
+    @api.model
+    def cron_procesar_cola_cove(self):
+        self._procesar_pendientes()
+        self._procesar_consultas()
+        return True
+
+    @api.model
+    def _procesar_pendientes(self):
+        batch = self.search(
+            [("state", "=", "pending")],
+            limit=self._queue_param("batch_size", 50),
+        )
+        if not batch:
+            return
+        batch.write({"state": "signing"})
+
+        # 1. Cadenas, firma por lote (una carga de llave por credencial) y
+        #    payload en el hilo principal (acceso ORM)
+        prepared = []
+        sin_credencial = batch.filtered(lambda e: not e.credencial_id)
+        if sin_credencial:
+            sin_credencial._marcar_fallido("Selecciona una credencial VUCEM antes de transmitir.")
+        for credencial in batch.credencial_id:
+            entries = batch.filtered(lambda e: e.credencial_id == credencial)
+            cadenas = []
+            for entry in entries:
+                cove = entry.cove_id
+                try:
+                    cove._validar_campos_requeridos()
+                    cadenas.append((entry, cove._build_cadena_cove(cove)))
+                except Exception as exc:
+                    entry._fallo_firma(exc)
+            if not cadenas:
+                continue
+            try:
+                firmas, cert_b64 = self.env["mx.firma.digital"].sign_many(
+                    credencial, [cadena for _entry, cadena in cadenas],
+                )
+            except Exception as exc:
+                for entry, _cadena in cadenas:
+                    entry._fallo_firma(exc)
+                continue
+            for (entry, cadena), firma_b64 in zip(cadenas, firmas):
+                firma_data = {
+                    "cadena_original": cadena,
+                    "certificado_b64": cert_b64,
+                    "firma_b64": firma_b64,
+                }
+                try:
+                    payload = entry.cove_id._build_soap_payload(firma_data)
+                except Exception as exc:
+                    entry._fallo_firma(exc)
+                    continue
+                prepared.append((entry, firma_data, payload))
+
+        # 2. Un cliente zeep por credencial; la sesión HTTP se comparte entre hilos.
+        #    Si una credencial no arranca, solo fallan sus entradas.
+        clients = {}
+        fallidas = {}
+        for entry, _firma, _payload in prepared:
+            cred = entry.cove_id.credencial_id
+            if cred.id in clients or cred.id in fallidas:
+                continue
+            try:
+                clients[cred.id] = entry.cove_id._get_zeep_client()
+            except Exception as exc:
+                fallidas[cred.id] = exc
+        if fallidas:
+            for entry, _firma, _payload in prepared:
+                exc = fallidas.get(entry.cove_id.credencial_id.id)
+                if exc is not None:
+                    entry._marcar_fallido(exc)
+            prepared = [p for p in prepared if p[0].cove_id.credencial_id.id in clients]
+
+        if not prepared:
+            return
+
+        limiter = _RateLimiter(self._queue_param("rps", 2.0, cast=float))
+
+        def _send(client, payload):
+            # Sin ORM aquí: solo la llamada SOAP
+            limiter.wait()
+            t0 = time.time()
+            try:
+                respuesta = client.service.RecibirCove(**payload)
+                return respuesta, None, int((time.time() - t0) * 1000)
+            except Exception as exc:  # noqa: BLE001 — se registra en el log
+                return None, exc, int((time.time() - t0) * 1000)
+
+        max_workers = max(1, self._queue_param("max_workers", 4))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [
+                pool.submit(_send, clients[entry.cove_id.credencial_id.id][0], payload)
+                for entry, _firma, payload in prepared
+            ]
+            results = [f.result() for f in futures]
+
+        # 3. Acuses de vuelta en el hilo principal
+        poll_delay = timedelta(minutes=self._queue_param("poll_minutes", 5))
+        for (entry, firma_data, _payload), (respuesta, exc, duracion) in zip(prepared, results):
+            cove = entry.cove_id
+            ambiente = clients[cove.credencial_id.id][1]
+            if exc is not None:
+                estatus = "timeout" if "timeout" in str(exc).lower() else "error_red"
+                cove._registrar_log(
+                    "registrar_cove", ambiente, estatus,
+                    cadena=firma_data["cadena_original"],
+                    xml_recibido=str(exc),
+                    duracion_ms=duracion,
+                    error_desc=str(exc),
+                )
+                entry._marcar_fallido(exc)
+                continue
+            cove._procesar_acuse_cove(respuesta, firma_data, ambiente, duracion)
+            now = fields.Datetime.now()
+            entry.write({
+                "state": "sent",
+                "attempts": entry.attempts + 1,
+                "sent_at": now,
+                "next_poll_at": now + poll_delay,
+                "last_error": False,
+            })
+
+    @api.model
+    def _procesar_consultas(self):
+        due = self.search(
+            [("state", "=", "sent"), ("next_poll_at", "<=", fields.Datetime.now())],
+            limit=self._queue_param("batch_size", 50),
+        )
+        if not due:
+            return
+        limiter = _RateLimiter(self._queue_param("rps", 2.0, cast=float))
+        max_polls = self._queue_param("max_polls", 12)
+        poll_minutes = self._queue_param("poll_minutes", 5)
+        for entry in due:
+            cove = entry.cove_id
+            limiter.wait()
+            error = errores = False
+            try:
+                with self.env.cr.savepoint():
+                    _e_doc, errores = cove._consultar_resultado()
+            except Exception as exc:
+                error = str(exc)
+                _logger.warning("Consulta COVE %s falló: %s", cove.display_name, exc)
+                # El savepoint deshizo el log de la consulta; se registra fuera
+                cove._registrar_log(
+                    "consultar_resultado",
+                    entry.credencial_id.ambiente or "pruebas",
+                    "timeout" if "timeout" in error.lower() else "error_red",
+                    error_desc=error,
+                )
+
+            polls = entry.poll_count + 1
+            if cove.e_document:
+                entry.write({"state": "acknowledged", "poll_count": polls, "next_poll_at": False})
+            elif errores:
+                # VUCEM rechazó la operación: seguir consultando no cambia nada
+                entry.write({
+                    "state": "failed",
+                    "poll_count": polls,
+                    "next_poll_at": False,
+                    "last_error": errores,
+                })
+            elif polls >= max_polls:
+                entry.write({
+                    "state": "failed",
+                    "poll_count": polls,
+                    "next_poll_at": False,
+                    "last_error": error or "VUCEM no devolvió e-document tras %s consultas." % polls,
+                })
+            else:
+                # Backoff lineal: 5, 10, 15… minutos
+                entry.write({
+                    "poll_count": polls,
+                    "next_poll_at": fields.Datetime.now() + timedelta(minutes=poll_minutes * (polls + 1)),
+                    "last_error": error,
+                })
+
+    def _fallo_firma(self, exc):
+        for entry in self:
+            entry.cove_id._registrar_log(
+                "registrar_cove",
+                entry.credencial_id.ambiente or "pruebas",
+                "error_firma",
+                error_desc=str(exc),
+            )
+        self._marcar_fallido(exc)
+
+    def _marcar_fallido(self, exc):
+        for entry in self:
+            entry.write({
+                "state": "failed",
+                "attempts": entry.attempts + 1,
+                "last_error": str(exc),
+            })
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Extracciones de CSF: trabajos asíncronos del portal.
+
+Solo los trabajos asíncronos crean filas; las extracciones síncronas
+(onchange del contacto, /portal/extract-csf sin async_mode) usan el caché
+por worker de `csf_service`, y reutilizan el resultado de un trabajo
+terminado con el mismo SHA-256 si existe.
+
+Modo asíncrono del portal:
+  /portal/extract-csf  (async_mode=True) → {"state": "pending", "job": token}
+  /portal/extract-csf/status (job)       → {"state": "done", "data": {...}}
+El cron `cron_procesar_extracciones_csf` resuelve los trabajos pendientes y
+`cron_limpiar_extracciones_csf` borra los terminados y expira los que se
+quedaron pendientes.
+
+Parámetros (ir.config_parameter):
+  mx_ped.csf.max_pdf_mb          tamaño máximo del PDF (default 5)
+  mx_ped.csf.max_pending         trabajos pendientes a la vez (default 200)
+  mx_ped.csf.portal_max_per_min  peticiones por IP y minuto a
+                                 /portal/extract-csf (default 10, 0 = sin límite)
+"""
+import base64
+import hashlib
+import json
+import logging
+import secrets
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from . import csf_service
+
+_logger = logging.getLogger(__name__)
+
+_RESULT_TTL_HOURS = 6
+_RETENTION_HOURS = 24
+_PENDING_TTL_HOURS = 2
+_MAX_PDF_MB_DEFAULT = 5
+_MAX_PENDING_DEFAULT = 200
+_PORTAL_MAX_PER_MIN_DEFAULT = 10
+
+
+class MxCsfExtraction(models.Model):
+    _name = "mx.csf.extraction"
+    _description = "Extracción de Constancia de Situación Fiscal"
+    _order = "id desc"
+    _rec_name = "token"
+
+    token = fields.Char(
+        string="Token",
+        required=True,
+        readonly=True,
+        copy=False,
+        default=lambda self: secrets.token_urlsafe(24),
+    )
+    sha256 = fields.Char(string="SHA-256 del PDF", required=True, index=True, readonly=True)
+    state = fields.Selection(
+        [
+            ("pending", "Pendiente"),
+            ("done", "Extraído"),
+            ("error", "Error"),
+        ],
+        string="Estado",
+        default="pending",
+        required=True,
+        index=True,
+    )
+    pdf_file = fields.Binary(string="PDF", attachment=True)
+    result = fields.Text(string="Resultado (JSON)", readonly=True)
+    error = fields.Char(string="Error", readonly=True)
+
+    _sql_constraints = [
+        ("mx_csf_extraction_token_uniq", "unique(token)", "Token de extracción duplicado."),
+    ]
+
+    # ── Parámetros ────────────────────────────────────────────────────────────
+
+    @api.model
+    def _csf_param(self, key, default):
+        raw = self.env["ir.config_parameter"].sudo().get_param(f"mx_ped.csf.{key}")
+        try:
+            return int(raw) if raw not in (None, False, "") else default
+        except (TypeError, ValueError):
+            return default
+
+    @api.model
+    def _portal_max_per_min(self):
+        return self._csf_param("portal_max_per_min", _PORTAL_MAX_PER_MIN_DEFAULT)
+
+    @api.model
+    def _size_error(self, size):
+        """Mensaje de error si el PDF de `size` bytes excede el límite, o False."""
+        max_mb = self._csf_param("max_pdf_mb", _MAX_PDF_MB_DEFAULT)
+        if max_mb > 0 and size > max_mb * 1024 * 1024:
+            return "El archivo excede el límite de %s MB." % max_mb
+        return False
+
+    # ── Caché ─────────────────────────────────────────────────────────────────
+
+    @api.model
+    def _cached_result(self, sha256):
+        vals = csf_service.cached_values(sha256)
+        if vals is not None:
+            return vals
+        done = self.search([
+            ("sha256", "=", sha256),
+            ("state", "=", "done"),
+            ("create_date", ">=", fields.Datetime.now() - timedelta(hours=_RESULT_TTL_HOURS)),
+        ], limit=1)
+        return json.loads(done.result) if done else None
+
+    @api.model
+    def _extract_values(self, content):
+        """Extracción síncrona con caché (memoria del worker y trabajos terminados).
+
+        No crea filas: se llama en cada onchange del contacto.
+        """
+        sha256 = hashlib.sha256(content).hexdigest()
+        vals = self._cached_result(sha256)
+        if vals is not None:
+            return vals
+        return csf_service.extract_values(content, sha256=sha256)
+
+    # ── Modo asíncrono ────────────────────────────────────────────────────────
+
+    @api.model
+    def _submit(self, content):
+        """Encola la extracción; responde de inmediato si ya está en caché."""
+        error = self._size_error(len(content))
+        if error:
+            return {"state": "error", "error": error}
+        sha256 = hashlib.sha256(content).hexdigest()
+        vals = self._cached_result(sha256)
+        if vals is not None:
+            return {"state": "done", "data": vals}
+        job = self.search([("sha256", "=", sha256), ("state", "=", "pending")], limit=1)
+        if not job:
+            max_pending = self._csf_param("max_pending", _MAX_PENDING_DEFAULT)
+            if max_pending > 0 and self.search_count([("state", "=", "pending")]) >= max_pending:
+                return {"state": "error", "error": "Hay demasiadas extracciones en proceso; intenta más tarde."}
+            job = self.create({"sha256": sha256, "pdf_file": base64.b64encode(content)})
+            cron = self.env.ref("modulo_aduana_odoo.cron_procesar_extracciones_csf", raise_if_not_found=False)
+            if cron:
+                cron.sudo()._trigger()
+        return {"state": "pending", "job": job.token}
+
+    @api.model
+    def _status(self, token):
+        job = self.search([("token", "=", token)], limit=1) if token else self.browse()
+        if not job:
+            return {"state": "error", "error": "Extracción no encontrada"}
+        if job.state == "done":
+            return {"state": "done", "data": json.loads(job.result or "{}")}
+        if job.state == "error":
+            return {"state": "error", "error": job.error}
+        return {"state": "pending", "job": job.token}
+
+    @api.model
+    def cron_procesar_extracciones_csf(self, limit=10):
+        jobs = self.search([("state", "=", "pending")], order="id", limit=limit)
+        for job in jobs:
+            try:
+                vals = csf_service.extract_values(base64.b64decode(job.pdf_file or b""), sha256=job.sha256)
+            except Exception:
+                _logger.exception("Error procesando CSF (extracción %s)", job.id)
+                vals = {}
+            if vals:
+                job.write({"state": "done", "result": json.dumps(vals), "pdf_file": False})
+            else:
+                job.write({
+                    "state": "error",
+                    "error": "No se pudo extraer información del CSF. Verifica que el PDF tenga código QR válido.",
+                    "pdf_file": False,
+                })
+        if len(jobs) >= limit:
+            self.env.ref("modulo_aduana_odoo.cron_procesar_extracciones_csf")._trigger()
+        return True
+
+    @api.model
+    def cron_limpiar_extracciones_csf(self):
+        """Borra trabajos terminados viejos y expira los pendientes estancados."""
+        now = fields.Datetime.now()
+        self.search([
+            ("state", "!=", "pending"),
+            ("write_date", "<", now - timedelta(hours=_RETENTION_HOURS)),
+        ]).unlink()
+        self.search([
+            ("state", "=", "pending"),
+            ("create_date", "<", now - timedelta(hours=_PENDING_TTL_HOURS)),
+        ]).write({
+            "state": "error",
+            "error": "La extracción expiró. Vuelve a subir el CSF.",
+            "pdf_file": False,
+        })
+        return True
@@ -22,7 +22,6 @@ Flujo:
 
 import os
 import time
-import base64 as _base64
 from datetime import datetime
 from lxml import etree
 
@@ -393,15 +392,12 @@ class MxDoda(models.Model):
 
         cred = self.credencial_id
         try:
-            cert_bytes = _base64.b64decode(cred.cert_file)
-            key_bytes = _base64.b64decode(cred.key_file)
-        except Exception as exc:
+            private_key, cert_b64 = self._firma_get_material(cred)
+        except (ValueError, TypeError) as exc:
             raise UserError(_("Error al leer la e.firma: %s") % exc) from exc
 
-        private_key = self._firma_load_private_key(key_bytes, cred.key_password)
         cadena_original = self._build_cadena_original_doda()
         firma_b64 = self._firma_sign_b64(private_key, cadena_original)
-        cert_b64 = self._firma_cert_to_b64(cert_bytes)
 
         xml_str = self._build_doda_xml(firma_b64, cert_b64, cadena_original)
         self.write({
@@ -520,15 +516,12 @@ class MxDoda(models.Model):
 
         cred = self.credencial_id
         try:
-            cert_bytes = _base64.b64decode(cred.cert_file)
-            key_bytes = _base64.b64decode(cred.key_file)
-        except Exception as exc:
+            private_key, cert_b64 = self._firma_get_material(cred)
+        except (ValueError, TypeError) as exc:
             raise UserError(_("Error al leer la e.firma: %s") % exc) from exc
 
-        private_key = self._firma_load_private_key(key_bytes, cred.key_password)
         cadena = f"|{self.numero_operacion_vucem}|{cred.ws_username}|"
         firma_b64 = self._firma_sign_b64(private_key, cadena)
-        cert_b64 = self._firma_cert_to_b64(cert_bytes)
 
         ambiente = cred.ambiente or "pruebas"
         consulta_endpoint = VUCEM_DODA_CONSULTA_URLS.get(ambiente, VUCEM_DODA_CONSULTA_URLS["pruebas"])
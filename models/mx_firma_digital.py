@@ -15,12 +15,41 @@ Orden de campos en la cadena para mercancías (confirmado en XMLs de ejemplo ofi
 """
 import base64
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from odoo import models
 from odoo.exceptions import UserError
 
 _logger = logging.getLogger(__name__)
 
+# ── Caché de llaves por worker ───────────────────────────────────────────────
+# Descifrar el .key del SAT (PKCS#8 cifrado con PBKDF) es deliberadamente lento;
+# en lotes de COVEs dominaba el CPU.  Se cachea la llave ya cargada por
+# credencial, con la write_date como parte de la clave para que cualquier
+# cambio en la credencial (en este u otro worker) invalide la entrada.
+_KEY_CACHE_TTL = 300  # segundos
+_KEY_CACHE = {}
+_KEY_CACHE_LOCK = threading.Lock()
+
+
+# Firma en paralelo (sign_many): hilos = núcleos; por debajo del umbral la
+# sobrecarga del pool no compensa.
+_SIGN_MAX_WORKERS = os.cpu_count() or 1
+_SIGN_PARALLEL_MIN = 8
+
+
+def _firma_cache_wipe(dbname, credencial_ids=None):
+    """Elimina del caché las llaves de las credenciales indicadas (o todas)."""
+    with _KEY_CACHE_LOCK:
+        for cache_key in list(_KEY_CACHE):
+            if cache_key[0] != dbname:
+                continue
+            if credencial_ids is None or cache_key[1] in credencial_ids:
+                del _KEY_CACHE[cache_key]
+
 # ── Importaciones opcionales ─────────────────────────────────────────────────
 try:
     from cryptography.hazmat.primitives import hashes, serialization
@@ -69,6 +98,98 @@ class MxFirmaDigital(models.AbstractModel):
                 f"Detalle: {exc}"
             ) from exc
 
+    def _firma_get_material(self, credencial):
+        """Devuelve (private_key, cert_b64) de la credencial, usando el caché.
+
+        La entrada se identifica por (db, id, write_date) y expira tras
+        _KEY_CACHE_TTL segundos; la escritura de la credencial la borra.
+        """
+        self._firma_check_crypto()
+        if not credencial.cert_file:
+            raise UserError("La credencial no tiene certificado (.cer) cargado.")
+        if not credencial.key_file:
+            raise UserError("La credencial no tiene llave privada (.key) cargada.")
+
+        cache_key = (self.env.cr.dbname, credencial.id, str(credencial.write_date))
+        now = time.monotonic()
+        with _KEY_CACHE_LOCK:
+            hit = _KEY_CACHE.get(cache_key)
+            if hit and hit[2] > now:
+                return hit[0], hit[1]
+
+        cert_b64 = self._firma_cert_to_b64(base64.b64decode(credencial.cert_file))
+        private_key = self._firma_load_private_key(
+            base64.b64decode(credencial.key_file), credencial.key_password,
+        )
+        with _KEY_CACHE_LOCK:
+            # Entradas vencidas o de write_date anteriores de la misma credencial
+            for old_key in [
+                k for k, v in _KEY_CACHE.items()
+                if v[2] <= now or (k[0] == cache_key[0] and k[1] == cache_key[1])
+            ]:
+                del _KEY_CACHE[old_key]
+            _KEY_CACHE[cache_key] = (private_key, cert_b64, now + _KEY_CACHE_TTL)
+        return private_key, cert_b64
+
+    def sign_many(self, credencial, cadenas, algo="sha1"):
+        """Firma varias cadenas con una sola carga de la llave, en paralelo.
+
+        La firma RSA es CPU-bound y `cryptography` libera el GIL, así que un
+        pool de hilos escala con los núcleos.  Los hilos solo tocan la llave
+        ya cargada (nunca el ORM).  Lotes pequeños se firman en serie.
+
+        Args:
+            credencial: record mx.ped.credencial.ws
+            cadenas   : lista de cadenas originales (str)
+            algo      : "sha1" (COVE/DODA) o "sha256" (MV)
+
+        Returns:
+            tuple (lista de firmas Base64 en el mismo orden, cert_b64)
+        """
+        signer = self._firma_sign_b64_sha256 if algo == "sha256" else self._firma_sign_b64
+        private_key, cert_b64 = self._firma_get_material(credencial)
+        cadenas = list(cadenas)
+        workers = min(_SIGN_MAX_WORKERS, len(cadenas))
+        if len(cadenas) < _SIGN_PARALLEL_MIN or workers < 2:
+            return [signer(private_key, cadena) for cadena in cadenas], cert_b64
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            firmas = list(pool.map(lambda cadena: signer(private_key, cadena), cadenas))
+        return firmas, cert_b64
+
+    def _firma_benchmark(self, credencial, n=200, algo="sha1"):
+        """Micro-benchmark de firma: serie vs. sign_many.
+
+        Uso (odoo shell):
+            env["mx.firma.digital"]._firma_benchmark(env["mx.ped.credencial.ws"].browse(1))
+
+        Returns:
+            dict con firmas/segundo en serie, en paralelo y por núcleo
+        """
+        signer = self._firma_sign_b64_sha256 if algo == "sha256" else self._firma_sign_b64
+        private_key, _cert = self._firma_get_material(credencial)
+        cadenas = [f"|BENCH|{i:06d}|{'X' * 400}|" for i in range(n)]
+
+        t0 = time.perf_counter()
+        for cadena in cadenas:
+            signer(private_key, cadena)
+        serial = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        self.sign_many(credencial, cadenas, algo=algo)
+        parallel = time.perf_counter() - t0
+
+        cores = os.cpu_count() or 1
+        result = {
+            "firmas": n,
+            "nucleos": cores,
+            "hilos": min(_SIGN_MAX_WORKERS, n),
+            "serie_por_seg": round(n / serial, 1) if serial else 0.0,
+            "paralelo_por_seg": round(n / parallel, 1) if parallel else 0.0,
+            "paralelo_por_nucleo": round(n / parallel / cores, 1) if parallel else 0.0,
+        }
+        _logger.info("Benchmark firma %s: %s", algo, result)
+        return result
+
     @staticmethod
     def _firma_cert_to_b64(cert_bytes):
         """Convierte los bytes del certificado .cer a Base64.
@@ -400,20 +521,9 @@ class MxFirmaDigital(models.AbstractModel):
         Returns:
             dict con claves: cadena_original, certificado_b64, firma_b64
         """
-        self._firma_check_crypto()
-
-        if not credencial.cert_file:
-            raise UserError("La credencial no tiene certificado (.cer) cargado.")
-        if not credencial.key_file:
-            raise UserError("La credencial no tiene llave privada (.key) cargada.")
-
-        cert_bytes = base64.b64decode(credencial.cert_file)
-        key_bytes = base64.b64decode(credencial.key_file)
-
-        private_key = self._firma_load_private_key(key_bytes, credencial.key_password)
+        private_key, cert_b64 = self._firma_get_material(credencial)
         cadena = self._build_cadena_mv(mv)
         firma_b64 = self._firma_sign_b64_sha256(private_key, cadena)
-        cert_b64 = self._firma_cert_to_b64(cert_bytes)
 
         return {
             "cadena_original": cadena,
@@ -423,12 +533,8 @@ class MxFirmaDigital(models.AbstractModel):
 
     def _firmar_mv_cadena(self, cadena_str, credencial):
         """Firma una cadena arbitraria con SHA256withRSA (para actualizarManifestacion)."""
-        self._firma_check_crypto()
-        cert_bytes = base64.b64decode(credencial.cert_file)
-        key_bytes = base64.b64decode(credencial.key_file)
-        private_key = self._firma_load_private_key(key_bytes, credencial.key_password)
+        private_key, cert_b64 = self._firma_get_material(credencial)
         firma_b64 = self._firma_sign_b64_sha256(private_key, cadena_str)
-        cert_b64 = self._firma_cert_to_b64(cert_bytes)
         return {"certificado_b64": cert_b64, "firma_b64": firma_b64}
 
     # ── Método principal: firmar COVE completo ────────────────────────────────
@@ -444,20 +550,9 @@ class MxFirmaDigital(models.AbstractModel):
             dict con claves: cadena_original, certificado_b64, firma_b64
             (certificado y firma en Base64 conforme xsd:base64Binary del XSD oficial)
         """
-        self._firma_check_crypto()
-
-        if not credencial.cert_file:
-            raise UserError("La credencial no tiene certificado (.cer) cargado.")
-        if not credencial.key_file:
-            raise UserError("La credencial no tiene llave privada (.key) cargada.")
-
-        cert_bytes = base64.b64decode(credencial.cert_file)
-        key_bytes = base64.b64decode(credencial.key_file)
-
-        private_key = self._firma_load_private_key(key_bytes, credencial.key_password)
+        private_key, cert_b64 = self._firma_get_material(credencial)
         cadena = self._build_cadena_cove(cove)
         firma_b64 = self._firma_sign_b64(private_key, cadena)
-        cert_b64 = self._firma_cert_to_b64(cert_bytes)
 
         return {
             "cadena_original": cadena,
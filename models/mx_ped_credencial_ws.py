@@ -6,6 +6,11 @@ import requests
 from odoo import api, fields, models
 from odoo.exceptions import ValidationError
 
+from .mx_firma_digital import _firma_cache_wipe
+
+# Campos cuya modificación invalida la llave cacheada en mx.firma.digital
+_FIRMA_FIELDS = {"cert_file", "key_file", "key_password", "active"}
+
 
 class MxPedCredencialWs(models.Model):
     _name = "mx.ped.credencial.ws"
@@ -102,6 +107,16 @@ class MxPedCredencialWs(models.Model):
             if dup:
                 raise ValidationError("Ya existe otra credencial activa para este agente, empresa y ambiente.")
 
+    def write(self, vals):
+        res = super().write(vals)
+        if _FIRMA_FIELDS & set(vals):
+            _firma_cache_wipe(self.env.cr.dbname, set(self.ids))
+        return res
+
+    def unlink(self):
+        _firma_cache_wipe(self.env.cr.dbname, set(self.ids))
+        return super().unlink()
+
     def _avc_endpoint(self, path):
         self.ensure_one()
         base = (self.avc_api_base_url or "").strip().rstrip("/")
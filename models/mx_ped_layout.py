@@ -1,10 +1,99 @@
 # -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Tuple
+
 from odoo import api, fields, models
 from odoo.exceptions import ValidationError
 
+# ── Tabla de búsqueda por versión de layout ──────────────────────────────────
+# Se comparte entre operaciones y peticiones del worker; la llave es la firma
+# del layout (write_date y conteos de registros/campos), así que cualquier
+# edición en otro worker produce una tabla nueva.  Dentro de la transacción
+# se memoiza en cr.cache; los create/write/unlink de layouts descartan ambas.
+_LOOKUP_CACHE_SIZE = 32
+_LOOKUP_CACHE = OrderedDict()
+_LOOKUP_CACHE_LOCK = threading.Lock()
+_LOOKUP_CR_KEY = "mx_ped_layout_lookup"
+
+
+@dataclass(frozen=True)
+class LayoutRegistroDesc:
+    """Registro del layout con sus campos ya ordenados (solo ids)."""
+    registro_id: int
+    codigo: str
+    # Orden de exportación: orden, luego pos_ini.
+    campo_ids: Tuple[int, ...]
+    # Orden posicional: pos_ini, luego orden.
+    campo_ids_posicion: Tuple[int, ...]
+
+
+@dataclass(frozen=True)
+class LayoutLookup:
+    """codigo → registro vigente (el de menor orden) y registro_id → descriptor.
+
+    `fuentes`: campo_id → (nombre, campo origen, modelo origen), la entrada
+    con la que la operación compila el acceso al valor del campo.
+    """
+    por_codigo: Mapping[str, LayoutRegistroDesc]
+    por_id: Mapping[int, LayoutRegistroDesc]
+    fuentes: Mapping[int, Tuple[str, str, str]]
+
+
+def _lookup_cache_get(key):
+    with _LOOKUP_CACHE_LOCK:
+        if key not in _LOOKUP_CACHE:
+            return None
+        _LOOKUP_CACHE.move_to_end(key)
+        return _LOOKUP_CACHE[key]
+
+
+def _lookup_cache_put(key, value):
+    with _LOOKUP_CACHE_LOCK:
+        _LOOKUP_CACHE[key] = value
+        _LOOKUP_CACHE.move_to_end(key)
+        while len(_LOOKUP_CACHE) > _LOOKUP_CACHE_SIZE:
+            _LOOKUP_CACHE.popitem(last=False)
+
+
+def _lookup_cache_wipe():
+    with _LOOKUP_CACHE_LOCK:
+        _LOOKUP_CACHE.clear()
+
+
+class MxPedLayoutLookupMixin(models.AbstractModel):
+    _name = "mx.ped.layout.lookup.mixin"
+    _description = "Invalida la tabla de búsqueda del layout"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self._lookup_invalidate()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        self._lookup_invalidate()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self._lookup_invalidate()
+        return res
+
+    @api.model
+    def _lookup_invalidate(self):
+        # La firma usa write_date, que no cambia dentro de la misma
+        # transacción: se descarta también la copia del worker.
+        _lookup_cache_wipe()
+        self.env.cr.cache.pop(_LOOKUP_CR_KEY, None)
+
 
 class MxPedLayout(models.Model):
     _name = "mx.ped.layout"
+    _inherit = ["mx.ped.layout.lookup.mixin"]
     _description = "Layout de Pedimento"
     _order = "name asc, id asc"
 
@@ -60,6 +149,80 @@ class MxPedLayout(models.Model):
     def write(self, vals):
         return super().write(self._normalize_separators(vals))
 
+    def _get_lookup(self):
+        """LayoutLookup de este layout (una consulta de firma por transacción)."""
+        self.ensure_one()
+        cr = self.env.cr
+        memo = cr.cache.setdefault(_LOOKUP_CR_KEY, {})
+        if self.id in memo:
+            return memo[self.id]
+        key = self._lookup_stamp()
+        lookup = _lookup_cache_get(key)
+        if lookup is None:
+            lookup = self._build_lookup()
+            _lookup_cache_put(key, lookup)
+        memo[self.id] = lookup
+        return lookup
+
+    def _lookup_stamp(self):
+        """Firma de la tabla de búsqueda: write_date y conteo de registros y campos."""
+        self.ensure_one()
+        cr = self.env.cr
+        self.env["mx.ped.layout.registro"].flush_model()
+        self.env["mx.ped.layout.campo"].flush_model()
+        self.flush_recordset(["write_date"])
+        cr.execute("""
+            SELECT l.write_date,
+                   (SELECT COUNT(*) FROM mx_ped_layout_registro r WHERE r.layout_id = l.id),
+                   (SELECT MAX(r.write_date) FROM mx_ped_layout_registro r WHERE r.layout_id = l.id),
+                   COUNT(c.id),
+                   MAX(c.write_date)
+              FROM mx_ped_layout l
+              LEFT JOIN mx_ped_layout_registro r ON r.layout_id = l.id
+              LEFT JOIN mx_ped_layout_campo c ON c.registro_id = r.id
+             WHERE l.id = %s
+             GROUP BY l.id
+        """, [self.id])
+        return (cr.dbname, self.id) + tuple(str(value) for value in (cr.fetchone() or ()))
+
+    def _build_lookup(self):
+        self.ensure_one()
+        cr = self.env.cr
+        cr.execute("""
+            SELECT r.id, r.codigo, r.orden, c.id, c.orden, c.pos_ini,
+                   c.nombre, COALESCE(f.name, c.source_field), c.source_model
+              FROM mx_ped_layout_registro r
+              LEFT JOIN mx_ped_layout_campo c ON c.registro_id = r.id
+              LEFT JOIN ir_model_fields f ON f.id = c.source_field_id
+             WHERE r.layout_id = %s
+        """, [self.id])
+        registros = {}
+        campos = {}
+        fuentes = {}
+        for reg_id, codigo, reg_orden, campo_id, orden, pos_ini, nombre, source_name, source_model in cr.fetchall():
+            registros[reg_id] = (codigo or "", reg_orden or 0)
+            if campo_id:
+                campos.setdefault(reg_id, []).append((campo_id, orden or 0, pos_ini))
+                fuentes[campo_id] = (nombre or "", source_name or "", source_model or "")
+        por_id = {}
+        for reg_id, (codigo, _orden) in registros.items():
+            # Mismo desempate que `_order` del campo: pos_ini (nulos al final), id.
+            base = sorted(campos.get(reg_id, []), key=lambda c: (c[2] is None, c[2] or 0, c[0]))
+            por_id[reg_id] = LayoutRegistroDesc(
+                registro_id=reg_id,
+                codigo=codigo,
+                campo_ids=tuple(c[0] for c in sorted(base, key=lambda c: c[1] or c[2] or 0)),
+                campo_ids_posicion=tuple(c[0] for c in sorted(base, key=lambda c: c[2] or c[1] or 0)),
+            )
+        por_codigo = {}
+        for reg_id in sorted(registros, key=lambda rid: (registros[rid][1], registros[rid][0], rid), reverse=True):
+            por_codigo[registros[reg_id][0]] = por_id[reg_id]
+        return LayoutLookup(
+            por_codigo=MappingProxyType(por_codigo),
+            por_id=MappingProxyType(por_id),
+            fuentes=MappingProxyType(fuentes),
+        )
+
     def init(self):
         """Migración en caliente: corrige separadores literales \\n en layouts existentes."""
         self.env.cr.execute(
@@ -70,6 +233,7 @@ class MxPedLayout(models.Model):
 
 class MxPedLayoutRegistro(models.Model):
     _name = "mx.ped.layout.registro"
+    _inherit = ["mx.ped.layout.lookup.mixin"]
     _description = "Layout - Registro"
     _order = "orden asc, codigo asc, id asc"
     _rec_name = "codigo"
@@ -105,6 +269,7 @@ class MxPedLayoutRegistro(models.Model):
 
 class MxPedLayoutCampo(models.Model):
     _name = "mx.ped.layout.campo"
+    _inherit = ["mx.ped.layout.lookup.mixin"]
     _description = "Layout - Campo"
     _order = "pos_ini asc, id asc"
     _rec_name = "nombre"
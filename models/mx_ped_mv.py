@@ -451,28 +451,37 @@ class MxPedMv(models.Model):
     # ── Acciones de botón ─────────────────────────────────────────────────────
 
     def action_firmar(self):
-        """Genera cadena original y firma la MV con la e.firma del importador."""
-        self.ensure_one()
-        if self.estatus != "borrador":
-            raise UserError("Solo se puede firmar una MV en estado Borrador.")
-        if not self.credencial_id:
-            raise UserError("Selecciona una Credencial WS antes de firmar.")
-        if not self.cove_line_ids:
-            raise UserError("Agrega al menos un COVE a la MV antes de firmar.")
-
-        resultado = self._firmar_mv(self, self.credencial_id)
-        self.write({
-            "certificado_b64": resultado["certificado_b64"],
-            "cadena_original": resultado["cadena_original"],
-            "firma_b64": resultado["firma_b64"],
-            "estatus": "firmada",
-        })
+        """Genera cadena original y firma la(s) MV con la e.firma del importador.
+
+        Con varias MVs seleccionadas, las cadenas de cada credencial se firman
+        en un solo lote (sign_many).
+        """
+        for mv in self:
+            if mv.estatus != "borrador":
+                raise UserError("Solo se puede firmar una MV en estado Borrador.")
+            if not mv.credencial_id:
+                raise UserError("Selecciona una Credencial WS antes de firmar.")
+            if not mv.cove_line_ids:
+                raise UserError("Agrega al menos un COVE a la MV antes de firmar.")
+
+        for credencial in self.credencial_id:
+            mvs = self.filtered(lambda m: m.credencial_id == credencial)
+            cadenas = [mv._build_cadena_mv(mv) for mv in mvs]
+            firmas, cert_b64 = self.sign_many(credencial, cadenas, algo="sha256")
+            for mv, cadena, firma_b64 in zip(mvs, cadenas, firmas):
+                mv.write({
+                    "certificado_b64": cert_b64,
+                    "cadena_original": cadena,
+                    "firma_b64": firma_b64,
+                    "estatus": "firmada",
+                })
         return {
             "type": "ir.actions.client",
             "tag": "display_notification",
             "params": {
                 "title": "MV firmada",
-                "message": "La cadena original y firma se generaron correctamente.",
+                "message": "La cadena original y firma se generaron correctamente."
+                if len(self) == 1 else f"Se firmaron {len(self)} MVs.",
                 "type": "success",
             },
         }
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 import base64
+import functools
+import heapq
 import io
 import json
+import logging
+import math
 import re
 import unicodedata
 import zipfile
-from collections import Counter
+from collections import Counter, defaultdict
 from datetime import date, datetime
 import xml.etree.ElementTree as ET
 
@@ -14,10 +18,133 @@ import requests
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError, ValidationError
 
-try:
-    from PyPDF2 import PdfReader
-except Exception:  # pragma: no cover
-    PdfReader = None
+from . import bl_parser
+from . import country_resolver as paises
+from . import mx_ped_validacion_wizard as validacion
+from . import rulepack_simulator as simulador
+from .bl_parser import PdfReader
+from .mx_ped_registro import extract_partida_number, valores_hash
+
+_logger = logging.getLogger(__name__)
+
+
+def _prorate_amounts(total, ratios, tiebreak=None):
+    """Reparte `total` (2 decimales) según `ratios` con residuo mayor.
+
+    Cada parte se redondea a centavos y los centavos sobrantes se asignan a
+    las partes con mayor residuo (desempate por `tiebreak`, luego índice),
+    de modo que la suma de las partes sea exactamente round(total·Σratios, 2)
+    y el resultado sea reproducible.
+    """
+    if not ratios:
+        return []
+    sign = -1 if (total or 0.0) < 0 else 1
+    exact = [abs(total or 0.0) * 100.0 * (ratio or 0.0) for ratio in ratios]
+    cents = [int(math.floor(value + 1e-9)) for value in exact]
+    target = int(math.floor(sum(exact) + 0.5 + 1e-9))
+    tiebreak = tiebreak or [0] * len(ratios)
+    order = sorted(
+        range(len(ratios)),
+        key=lambda i: (-(exact[i] - cents[i]), tiebreak[i], i),
+    )
+    for i in order[:max(0, target - sum(cents))]:
+        cents[i] += 1
+    return [sign * c / 100.0 for c in cents]
+
+
+# ── Enlace campo de layout → valor del lead ──────────────────────────────────
+_LEAD_FIELD_ALIASES = {
+    "aduana": "aduana_clave",
+    "patente": "patente",
+    "clave_pedimento": "clave_pedimento",
+    "tipo_operacion": "tipo_operacion",
+    "tipo_movimiento": "tipo_movimiento",
+    "regimen": "regimen",
+    "incoterm": "incoterm",
+    "moneda": "currency_id",
+    "pais_origen": "x_pais_origen_id",
+    "pais_destino": "x_pais_destino_id",
+    "bultos": "total_packages_line",
+    "bultos_totales": "total_packages_line",
+    "numero_total_de_bultos": "total_packages_line",
+    "peso_bruto": "total_gross_weight",
+    "peso_bruto_total": "total_gross_weight",
+    "peso_bruto_total_de_la_mercancia": "total_gross_weight",
+    "peso_neto": "total_net_weight",
+    "peso_neto_total": "total_net_weight",
+    "peso_neto_total_de_la_mercancia": "total_net_weight",
+    "valor_factura": "x_valor_factura",
+    "valor_aduana": "x_valor_aduana_estimado",
+    "folio_operacion": "x_folio_operacion",
+    "referencia_cliente": "x_referencia_cliente",
+    "aduana_seccion_entrada_salida": "aduana_seccion_entrada_salida",
+    "medio_transporte_salida": "x_medio_transporte_salida",
+    "tipo_contenedor": "x_tipo_contenedor_id",
+    "clave_tipo_contenedor": "x_tipo_contenedor_id",
+    "acuse_validacion": "acuse_validacion",
+    "curp_agente": "curp_agente",
+    "rfc_importador_exportador": "participante_rfc",
+    "curp_importador_exportador": "participante_curp",
+    "nombre_importador_exportador": "participante_nombre",
+    "comprador": "x_comprador_id",
+    "nombre_proveedor_comprador": "x_counterparty_name_505",
+}
+_TOTALES_OPERACION = frozenset({"total_packages_line", "total_gross_weight", "total_net_weight"})
+_SOURCE_MODELS_LEAD = frozenset({
+    "lead", "cliente", "importador", "exportador", "proveedor", "comprador", "contraparte", "transportista",
+})
+
+
+def _norm_source_name(name):
+    return (name or "").lower().replace(" ", "").replace("_", "")
+
+
+_LEAD_FIELD_ALIASES_BY_NORM = {_norm_source_name(key): value for key, value in _LEAD_FIELD_ALIASES.items()}
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile_source_binding(field_name, source_field=None, source_model=None):
+    """(tipo, campo origen, modelo origen) de un campo de layout que se llena desde el lead.
+
+    Resuelve una sola vez alias, normalización de nombres y modelo origen;
+    `_value_for_source_binding` solo lee el valor.  tipo: "record",
+    "tipo_operacion", "tipo_movimiento", "origen_destino" o "none".
+    """
+    source = source_field or _LEAD_FIELD_ALIASES.get(
+        field_name, _LEAD_FIELD_ALIASES_BY_NORM.get(_norm_source_name(field_name), field_name)
+    )
+    source_model = source_model or "lead"
+
+    field_norm = _norm_source_name(field_name)
+    source_norm_hint = _norm_source_name(source)
+    if source == field_name:
+        if "pesobruto" in field_norm:
+            source = "total_gross_weight"
+        elif "pesoneto" in field_norm:
+            source = "total_net_weight"
+        elif "bulto" in field_norm or "paquete" in field_norm:
+            source = "total_packages_line"
+    elif "pesobruto" in source_norm_hint:
+        source = "total_gross_weight"
+    elif "pesoneto" in source_norm_hint:
+        source = "total_net_weight"
+    elif "bulto" in source_norm_hint or "paquete" in source_norm_hint:
+        source = "total_packages_line"
+
+    source_norm = _norm_source_name(source)
+    if source_norm in ("tipooperacion", "xtipooperacion"):
+        return ("tipo_operacion", "x_tipo_operacion", "lead")
+    if source_norm in ("tipomovimiento", "xtipomovimiento"):
+        return ("tipo_movimiento", source, source_model)
+    if source_norm in ("origendestino", "xorigendestino", "xorigendestinomercancia"):
+        return ("origen_destino", source, "lead")
+    if source_model == "operacion" or source in _TOTALES_OPERACION:
+        return ("record", source, "operacion")
+    if source_model == "partida":
+        return ("none", source, "partida")
+    if source_model not in _SOURCE_MODELS_LEAD:
+        source_model = "lead"
+    return ("record", source, source_model)
 
 
 class MxPedOperacion(models.Model):
@@ -314,6 +441,15 @@ class MxPedOperacion(models.Model):
         string="Semáforo",
     )
 
+    # ==========================
+    # Pre-validación en lote (dashboard)
+    # ==========================
+    # Se escriben por SQL (_guardar_resumen_validacion) para no mover
+    # write_date, que forma parte de la firma del caché de validación.
+    validacion_errores = fields.Integer(string="Errores de validación", readonly=True, copy=False, index=True)
+    validacion_advertencias = fields.Integer(string="Advertencias de validación", readonly=True, copy=False, index=True)
+    validacion_fecha = fields.Datetime(string="Validada el", readonly=True, copy=False, index=True)
+
     # Moneda
     currency_id = fields.Many2one(
         "res.currency",
@@ -444,8 +580,20 @@ class MxPedOperacion(models.Model):
         compute="_compute_strict_mode_effective",
         store=False,
     )
-    rule_trace_json = fields.Json(string="Trazabilidad de reglas", readonly=True, copy=False)
+    rule_trace_id = fields.Many2one(
+        "mx.ped.rule.trace",
+        string="Traza de reglas vigente",
+        readonly=True,
+        copy=False,
+        ondelete="set null",
+    )
+    rule_trace_json = fields.Json(string="Trazabilidad de reglas", compute="_compute_rule_trace_json")
     rule_trace_at = fields.Datetime(string="Ultima evaluación de reglas", readonly=True, copy=False)
+    rule_context_data = fields.Json(
+        string="Contexto de reglas (fracciones y formas de pago)",
+        compute="_compute_rule_context_data",
+        store=False,
+    )
     show_acuse_ui = fields.Boolean(
         string="Mostrar acuse",
         compute="_compute_process_ui_flags",
@@ -912,8 +1060,8 @@ class MxPedOperacion(models.Model):
                 if latest_layout:
                     vals["layout_id"] = latest_layout.id
         records = super().create(vals_list)
+        records._assign_resolved_rulepacks()
         for rec in records:
-            rec.rulepack_id = rec._resolve_rulepack()
             rec.estructura_regla_id = rec._resolve_estructura_regla()
             if not rec.ws_credencial_id:
                 rec.ws_credencial_id = rec._resolve_ws_credencial().id or False
@@ -950,8 +1098,8 @@ class MxPedOperacion(models.Model):
             "observaciones",
         }
         if trigger_fields.intersection(vals.keys()):
+            self._assign_resolved_rulepacks()
             for rec in self:
-                rec.rulepack_id = rec._resolve_rulepack()
                 rec.estructura_regla_id = rec._resolve_estructura_regla()
         if (
             not self.env.context.get("skip_auto_generated_refresh")
@@ -1279,29 +1427,7 @@ class MxPedOperacion(models.Model):
         return False
 
     def _extract_partida_number(self, payload):
-        payload = payload or {}
-        if not isinstance(payload, dict):
-            return None
-
-        candidates = {
-            "partida",
-            "numero_partida",
-            "num_partida",
-            "partida_numero",
-            "secuencia_partida",
-            "partida_seq",
-        }
-        for key, value in payload.items():
-            key_norm = str(key or "").strip().lower()
-            if key_norm not in candidates:
-                continue
-            if isinstance(value, int):
-                return value
-            if isinstance(value, str):
-                digits = "".join(ch for ch in value if ch.isdigit())
-                if digits:
-                    return int(digits)
-        return None
+        return extract_partida_number(payload)
 
     def _get_partida_numbers_for_validation(self):
         self.ensure_one()
@@ -1309,12 +1435,7 @@ class MxPedOperacion(models.Model):
         if numbers:
             return sorted(set(numbers))
 
-        inferred = []
-        for reg in self.registro_ids:
-            num = self._extract_partida_number(reg.valores)
-            if num:
-                inferred.append(num)
-        return sorted(set(inferred))
+        return sorted({num for num in self.registro_ids.mapped("partida_numero") if num})
 
     def _get_partida_meta_map(self):
         self.ensure_one()
@@ -1330,19 +1451,20 @@ class MxPedOperacion(models.Model):
     def _resolve_rulepack(self):
         self.ensure_one()
         op_date = self.fecha_operacion or fields.Date.context_today(self)
-        packs = self.env["mx.ped.rulepack"].search(
-            [
-                ("active", "=", True),
-                ("state", "=", "active"),
-                ("fecha_inicio", "<=", op_date),
-                "|",
-                ("fecha_fin", "=", False),
-                ("fecha_fin", ">=", op_date),
-            ],
-            order="priority desc, fecha_inicio desc, id desc",
-            limit=1,
+        Rulepack = self.env["mx.ped.rulepack"]
+        return Rulepack.browse(Rulepack._resolve_many([op_date])[op_date] or [])
+
+    def _assign_resolved_rulepacks(self):
+        """rulepack_id de cada operación con una sola búsqueda en el índice de vigencia."""
+        today = fields.Date.context_today(self)
+        por_fecha = self.env["mx.ped.rulepack"]._resolve_many(
+            [rec.fecha_operacion or today for rec in self]
         )
-        return packs[:1]
+        grupos = defaultdict(list)
+        for rec in self:
+            grupos[por_fecha[rec.fecha_operacion or today]].append(rec.id)
+        for pack_id, ids in grupos.items():
+            self.browse(ids).rulepack_id = pack_id
 
     def _get_rulepack_effective(self):
         self.ensure_one()
@@ -1463,75 +1585,78 @@ class MxPedOperacion(models.Model):
                 score += 5
         return score
 
+    @api.depends(
+        "partida_ids.fraccion_id",
+        "partida_ids.fraccion_id.capitulo",
+        "partida_ids.forma_pago_sugerida_id.code",
+        "contribucion_global_ids.forma_pago_code",
+        "partida_contribucion_ids.forma_pago_code",
+        "documento_ids.forma_pago_code",
+        "documento_ids.registro_codigo",
+        "formas_pago_claves",
+    )
+    def _compute_rule_context_data(self):
+        """Fracciones, capítulos y formas de pago de todo el recordset en una consulta.
+
+        Al ser un campo no almacenado vive en el caché del ORM: se calcula una
+        vez por transacción para todo el prefetch y el ORM lo invalida cuando
+        cambia cualquiera de sus dependencias.
+        """
+        stored = self.filtered(lambda r: isinstance(r.id, int))
+        snaps = {}
+        if stored:
+            # Solo las tablas que lee el snapshot
+            self.flush_model([
+                "name", "fecha_operacion", "rulepack_id", "tipo_movimiento", "tipo_operacion",
+                "regimen", "clave_pedimento_id", "es_rectificacion", "formas_pago_claves",
+            ])
+            self.env["mx.ped.clave"].flush_model(["is_virtual", "tipo_movimiento_id"])
+            self.env["mx.ped.tipo.movimiento"].flush_model(["code"])
+            self.env["mx.ped.partida"].flush_model(["operacion_id", "fraccion_id", "forma_pago_sugerida_id"])
+            self.env["mx.tigie.maestra"].flush_model(["capitulo"])
+            self.env["mx.forma.pago"].flush_model(["code"])
+            self.env["mx.ped.contribucion.global"].flush_model(["operacion_id", "forma_pago_code"])
+            self.env["mx.ped.partida.contribucion"].flush_model(["operacion_id", "forma_pago_code"])
+            self.env["mx.ped.documento"].flush_model(["operacion_id", "registro_codigo", "forma_pago_code"])
+            snaps = {snap["id"]: snap for snap in simulador.snapshot_operaciones(self.env.cr, stored.ids)}
+        for rec in self:
+            snap = snaps.get(rec.id)
+            if snap is None:
+                # Registros en onchange (NewId): recorrido ORM.
+                partidas = rec.partida_ids.filtered("fraccion_id")
+                snap = {
+                    "fraccion_ids": set(partidas.fraccion_id.ids),
+                    "fraccion_capitulos": {cap for cap in partidas.fraccion_id.mapped("capitulo") if cap},
+                    "declared_formas_pago": {
+                        str(code).strip()
+                        for code in rec._get_declared_formas_pago_codes()
+                        if str(code).strip()
+                    },
+                }
+            rec.rule_context_data = {
+                key: sorted(snap[key])
+                for key in ("fraccion_ids", "fraccion_capitulos", "declared_formas_pago")
+            }
+
     def _build_rule_context(self, escenario_code=None):
         self.ensure_one()
         clave = self.clave_pedimento_id
-        mov = self._get_tipo_movimiento_effective()
-        fraccion_ids = {p.fraccion_id.id for p in self.partida_ids if p.fraccion_id}
-        fraccion_capitulos = {p.fraccion_id.capitulo for p in self.partida_ids if p.fraccion_id and p.fraccion_id.capitulo}
-        declared_formas_pago = {
-            str(code).strip()
-            for code in self._get_declared_formas_pago_codes()
-            if str(code).strip()
-        }
+        data = self.rule_context_data or {}
         return {
-            "tipo_movimiento": mov,
+            "tipo_movimiento": self._get_tipo_movimiento_effective(),
             "tipo_operacion": self.tipo_operacion or "",
             "regimen": self.regimen or "",
             "clave_id": clave.id if clave else False,
             "is_virtual": bool(clave and clave.is_virtual),
             "escenario": escenario_code or "",
-            "fraccion_ids": fraccion_ids,
-            "fraccion_capitulos": fraccion_capitulos,
-            "declared_formas_pago": declared_formas_pago,
+            "fraccion_ids": set(data.get("fraccion_ids") or ()),
+            "fraccion_capitulos": set(data.get("fraccion_capitulos") or ()),
+            "declared_formas_pago": set(data.get("declared_formas_pago") or ()),
             "es_rectificacion": bool(self.es_rectificacion),
         }
 
     def _rule_condition_match(self, rule, context):
-        mov_code = rule.tipo_movimiento_id.code if getattr(rule, "tipo_movimiento_id", False) else False
-        if mov_code and mov_code != context.get("tipo_movimiento"):
-            return False
-        if getattr(rule, "tipo_operacion", False) and rule.tipo_operacion not in ("", "ambas"):
-            if rule.tipo_operacion != context.get("tipo_operacion"):
-                return False
-        if getattr(rule, "regimen", False) and rule.regimen not in ("", "cualquiera"):
-            if rule.regimen != context.get("regimen"):
-                return False
-        if getattr(rule, "clave_pedimento_id", False) and rule.clave_pedimento_id.id != context.get("clave_id"):
-            return False
-        if getattr(rule, "is_virtual", False) and rule.is_virtual != "any":
-            expected_virtual = (rule.is_virtual == "yes")
-            if expected_virtual != bool(context.get("is_virtual")):
-                return False
-        rule_es_rect = getattr(rule, "es_rectificacion", "any") or "any"
-        if rule_es_rect != "any":
-            expected_rect = (rule_es_rect == "yes")
-            if expected_rect != bool(context.get("es_rectificacion")):
-                return False
-        if hasattr(rule, "escenario_code") and rule.escenario_code and rule.escenario_code != "any":
-            if rule.escenario_code != context.get("escenario"):
-                return False
-        if hasattr(rule, "fraccion_id") and rule.fraccion_id:
-            if rule.fraccion_id.id not in (context.get("fraccion_ids") or set()):
-                return False
-        if hasattr(rule, "fraccion_capitulo") and (rule.fraccion_capitulo or "").strip():
-            cap = (rule.fraccion_capitulo or "").strip()
-            if cap not in (context.get("fraccion_capitulos") or set()):
-                return False
-        forma_pago_match = getattr(rule, "forma_pago_match", "any") or "any"
-        forma_pago_code = ""
-        if getattr(rule, "forma_pago_id", False):
-            forma_pago_code = str(rule.forma_pago_id.code or "").strip()
-        if not forma_pago_code:
-            forma_pago_code = str(getattr(rule, "forma_pago_code", "") or "").strip()
-        declared = context.get("declared_formas_pago") or set()
-        if forma_pago_match == "present":
-            if not forma_pago_code or forma_pago_code not in declared:
-                return False
-        elif forma_pago_match == "absent":
-            if forma_pago_code and forma_pago_code in declared:
-                return False
-        return True
+        return simulador.condition_match(simulador.compile_conditions(rule), context)
 
     def _select_rulepack_scenario(self):
         self.ensure_one()
@@ -2237,7 +2362,7 @@ class MxPedOperacion(models.Model):
     def _build_sync_payload_from_layout(self, layout_reg, source, code):
         """Construye payload usando campo.nombre y heuristicas por codigo."""
         values = {}
-        fields_by_order = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+        fields_by_order = self._get_layout_campos(layout_reg, por_posicion=True)
 
         def _read_attr(obj, name):
             if not obj or not name:
@@ -2398,31 +2523,46 @@ class MxPedOperacion(models.Model):
                     "valores": payload,
                 })
 
-        by_key = {}
-        stale = self.env["mx.ped.registro"]
-        for reg in self.registro_ids.filtered(lambda r: (r.codigo or "") in {"509", "510", "557", "514"}):
-            vals = reg.valores or {}
-            if isinstance(vals, dict) and vals.get("__sync_origin") == "tecnico" and vals.get("__sync_key"):
-                by_key[vals.get("__sync_key")] = reg
-                stale |= reg
+        managed = self.registro_ids.filtered(
+            lambda r: (r.codigo or "") in {"509", "510", "557", "514"}
+            and r.sync_origin == "tecnico"
+            and r.sync_key
+        )
+        self._upsert_registros(managed, desired)
 
-        used = self.env["mx.ped.registro"]
-        reg_model = self.env["mx.ped.registro"]
+    def _upsert_registros(self, managed, desired):
+        """Sincroniza los registros `managed` con `desired` por llave de sincronización.
+
+        Un solo create multi-fila para las llaves nuevas, un UPDATE agrupado
+        para las filas cuya secuencia o hash de valores cambió (las idénticas
+        no se tocan) y un unlink para las llaves que ya no existen.  Son
+        registros derivados: no generan mensajes de auditoría por fila.
+        """
+        self.ensure_one()
+        Registro = self.env["mx.ped.registro"].with_context(skip_aduana_audit=True)
+        by_key = {reg.sync_key: reg for reg in managed if reg.sync_key}
+        to_create = []
+        to_update = []
+        used_ids = set()
         for item in desired:
             reg = by_key.get(item["key"])
-            if reg:
-                reg.write({"secuencia": item["secuencia"], "valores": item["valores"]})
-                used |= reg
-            else:
-                created = reg_model.create({
+            if not reg:
+                to_create.append({
                     "operacion_id": self.id,
                     "codigo": item["codigo"],
                     "secuencia": item["secuencia"],
                     "valores": item["valores"],
                 })
-                used |= created
-
-        (stale - used).unlink()
+                continue
+            used_ids.add(reg.id)
+            if reg.secuencia != item["secuencia"] or reg.valores_hash != valores_hash(item["valores"]):
+                to_update.append((reg.id, item["secuencia"], item["valores"]))
+        if to_create:
+            Registro.create(to_create)
+        Registro._bulk_update_valores(to_update)
+        stale = managed.filtered(lambda r: r.id not in used_ids)
+        if stale:
+            stale.with_context(skip_aduana_audit=True).unlink()
 
     def _apply_registro_diff(self, desired):
         """Aplica un diff inteligente sobre registro_ids.
@@ -2448,22 +2588,12 @@ class MxPedOperacion(models.Model):
         """
         self.ensure_one()
         TECNICO_CODES = {"509", "510", "557", "514"}
-        reg_model = self.env["mx.ped.registro"]
-
-        # Separar registros existentes por categoría
-        auto_regs = self.env["mx.ped.registro"]   # gestionados por este método
-        manual_regs = self.env["mx.ped.registro"]  # creados manualmente (sin origin)
-        legacy_regs = self.env["mx.ped.registro"]  # sin origin, no técnicos
 
-        for reg in self.registro_ids:
-            if (reg.codigo or "") in TECNICO_CODES:
-                continue  # los técnicos son responsabilidad de _sync_registro_ids_from_tecnicos
-            vals = reg.valores or {}
-            origin = vals.get("__sync_origin") if isinstance(vals, dict) else None
-            if origin == "auto":
-                auto_regs |= reg
-            else:
-                legacy_regs |= reg
+        # Separar registros existentes por categoría; los técnicos son
+        # responsabilidad de _sync_registro_ids_from_tecnicos.
+        no_tecnicos = self.registro_ids.filtered(lambda r: (r.codigo or "") not in TECNICO_CODES)
+        auto_regs = no_tecnicos.filtered(lambda r: r.sync_origin == "auto")  # gestionados por este método
+        legacy_regs = no_tecnicos - auto_regs  # sin origin, no técnicos
 
         # Migración de primera ejecución: si no hay registros "auto" todavía
         # pero sí hay legacy no-técnicos, los borramos para que el diff los recree
@@ -2472,36 +2602,8 @@ class MxPedOperacion(models.Model):
             legacy_regs.unlink()
             auto_regs = self.env["mx.ped.registro"]
 
-        # Índice por __sync_key para búsqueda O(1)
-        by_key = {}
-        for reg in auto_regs:
-            vals = reg.valores or {}
-            if isinstance(vals, dict) and vals.get("__sync_key"):
-                by_key[vals["__sync_key"]] = reg
-
-        used = self.env["mx.ped.registro"]
-        for item in desired:
-            reg = by_key.get(item["key"])
-            if reg:
-                # Actualizar solo si algo cambió (evita writes innecesarios)
-                needs_update = (
-                    reg.secuencia != item["secuencia"]
-                    or reg.valores != item["valores"]
-                )
-                if needs_update:
-                    reg.write({"secuencia": item["secuencia"], "valores": item["valores"]})
-                used |= reg
-            else:
-                created = reg_model.create({
-                    "operacion_id": self.id,
-                    "codigo":       item["codigo"],
-                    "secuencia":    item["secuencia"],
-                    "valores":      item["valores"],
-                })
-                used |= created
-
-        # Eliminar registros "auto" que ya no están en desired
-        (auto_regs - used).unlink()
+        # Altas, cambios (por hash) y bajas de los registros "auto" en bloque
+        self._upsert_registros(auto_regs, desired)
 
     def _relax_technical_required_states(self, states):
         """Relaja min/required en registros cuando no hay fuente de datos."""
@@ -2657,9 +2759,9 @@ class MxPedOperacion(models.Model):
             })
         return normalized
 
-    def _normalize_clave_rules(self, source_weight):
+    def _normalize_clave_rules(self, source_weight, clave=None):
         normalized = []
-        clave = self.clave_pedimento_id
+        clave = clave if clave is not None else self.clave_pedimento_id
         if not clave:
             return normalized
         for line in clave.registro_policy_ids.sorted(lambda l: (-l.priority, l.sequence, l.id)):
@@ -2830,38 +2932,14 @@ class MxPedOperacion(models.Model):
             code = (reg.codigo or "").strip()
             if not code:
                 continue
-            partida_num = self._extract_partida_number(reg.valores)
+            partida_num = reg.partida_numero or None
             self._apply_field_rules_to_vals(code, reg.valores or {}, partida_num=partida_num, validate_only=True)
 
     def _rule_sort_key(self, item):
-        return (
-            -(item.get("priority") or 0),
-            -(item.get("specificity_score") or 0),
-            -(item.get("source_weight") or 0),
-            item.get("rule_id") or 0,
-        )
+        return simulador.rule_sort_key(item)
 
     def _apply_rule_to_state(self, state, rule_item):
-        policy = rule_item.get("policy")
-        min_occ = max(rule_item.get("min") or 0, 0)
-        max_occ = max(rule_item.get("max") or 0, 0)
-        identifier = (rule_item.get("identifier") or "").strip().upper()
-
-        if policy == "forbidden":
-            state["forbidden"] = True
-            state["required"] = False
-            state["min"] = 0
-            state["max"] = 0
-        elif policy == "required" and not state.get("forbidden"):
-            state["required"] = True
-            state["min"] = max(state["min"], max(min_occ, 1))
-        elif policy == "optional" and not state.get("forbidden"):
-            state["min"] = max(state["min"], min_occ)
-
-        if max_occ and not state.get("forbidden"):
-            state["max"] = max_occ if not state["max"] else min(state["max"], max_occ)
-        if identifier:
-            state["identifier"] = identifier
+        simulador.apply_rule_to_state(state, rule_item)
 
     def _build_record_plan(self):
         """Construye plan determinista: normaliza reglas, aplica precedencias y guarda explicabilidad."""
@@ -3027,7 +3105,7 @@ class MxPedOperacion(models.Model):
         if order_map is None:
             order_map = self._get_record_order_map()
         rule_sequence = order_map.get(code)
-        partida_num = self._extract_partida_number(reg.valores) or 0
+        partida_num = reg.partida_numero or 0
         if rule_sequence and rule_sequence > 0:
             return (rule_sequence, code, partida_num, reg.secuencia or 0, reg.id)
         layout_reg = self._get_layout_registro(code)
@@ -3064,10 +3142,29 @@ class MxPedOperacion(models.Model):
             "trace": trace_rows,
             "errors": plan.get("errors") or [],
         }
-        self.with_context(skip_rule_trace_write=True).write({
-            "rule_trace_json": trace_payload,
-            "rule_trace_at": fields.Datetime.now(),
-        })
+        trace_model = self.env["mx.ped.rule.trace"].sudo()
+        content_hash = trace_model._content_hash(trace_payload)
+        trace = self.sudo().rule_trace_id
+        if not trace or trace.content_hash != content_hash:
+            trace = trace_model.create({
+                "operacion_id": self.id,
+                "content_hash": content_hash,
+                "rulepack_id": trace_payload["meta"]["rulepack_id"],
+                "payload": trace_payload,
+            })
+        # Puntero y fecha por SQL: sin auditoría ni tracking en cada evaluación.
+        # Antes se escriben los valores pendientes del ORM para que no pisen el UPDATE.
+        self.flush_recordset(["rule_trace_id", "rule_trace_at"])
+        self.env.cr.execute(
+            "UPDATE mx_ped_operacion SET rule_trace_id = %s, rule_trace_at = %s WHERE id = %s",
+            [trace.id, fields.Datetime.now(), self.id],
+        )
+        self.invalidate_recordset(["rule_trace_id", "rule_trace_at", "rule_trace_json"])
+
+    @api.depends("rule_trace_id")
+    def _compute_rule_trace_json(self):
+        for rec in self:
+            rec.rule_trace_json = rec.rule_trace_id.sudo()._get_payload() if rec.rule_trace_id else False
 
     def _get_stage_allowed_codes(self, stage):
         self.ensure_one()
@@ -3167,7 +3264,7 @@ class MxPedOperacion(models.Model):
                 per_partida_has_identifier = {}
                 for reg in self.registro_ids:
                     code = (reg.codigo or "").strip()
-                    partida_num = self._extract_partida_number(reg.valores)
+                    partida_num = reg.partida_numero or None
                     if not partida_num:
                         continue
                     per_partida_counts[(partida_num, code)] = per_partida_counts.get((partida_num, code), 0) + 1
@@ -3483,10 +3580,25 @@ class MxPedOperacion(models.Model):
         self.ensure_one()
         if not self.layout_id:
             raise UserError(_("Falta seleccionar un layout en la operación."))
-        matches = self.layout_id.registro_ids.filtered(lambda r: r.codigo == codigo)
-        if not matches:
+        desc = self.layout_id._get_lookup().por_codigo.get(codigo)
+        if not desc:
             raise UserError(_("No existe layout para el registro %s.") % codigo)
-        return matches.sorted(lambda r: r.orden or 0)[0]
+        return self.env["mx.ped.layout.registro"].browse(desc.registro_id)
+
+    def _get_layout_campos(self, layout_reg, por_posicion=False):
+        """Campos del registro de layout ya ordenados (tabla de búsqueda del layout).
+
+        Orden de exportación: orden y luego pos_ini; `por_posicion`: pos_ini
+        y luego orden.
+        """
+        desc = layout_reg.layout_id._get_lookup().por_id.get(layout_reg.id)
+        if not desc:
+            return layout_reg.campo_ids.sorted(
+                (lambda c: c.pos_ini or c.orden or 0) if por_posicion else (lambda c: c.orden or c.pos_ini or 0)
+            )
+        return self.env["mx.ped.layout.campo"].browse(
+            desc.campo_ids_posicion if por_posicion else desc.campo_ids
+        )
 
     def _format_txt_value(self, campo, val):
         if val == self._LAYOUT_EMPTY:
@@ -3561,68 +3673,39 @@ class MxPedOperacion(models.Model):
         if len(token) <= max_len:
             return token
 
-        upper = token.upper()
-        country_model = self.env["res.country"].sudo()
-
-        country = country_model.search([("code", "=", upper)], limit=1)
-        if not country:
-            country = country_model.search([("name", "=ilike", token)], limit=1)
-        if not country:
-            country = country_model.search([("name", "ilike", token)], limit=1)
-
-        if country and country.code:
-            code = country.code.strip().upper()
-            if len(code) <= max_len:
-                return code
+        code = paises.get_map(self.env.cr).resolve(token)
+        if code and len(code) <= max_len:
+            return code
 
         # Ultimo recurso: truncar para no romper exportacion.
         return token[:max_len]
 
     def _build_txt_line(self, layout_registro, valores, partida_num=None):
+        doc = self._build_registro_doc(layout_registro, valores, partida_num=partida_num)
+        return doc.to_line(layout_registro.layout_id.field_separator or "|")
+
+    def _build_registro_doc(self, layout_registro, valores, partida_num=None):
+        """RegistroDoc con los campos ya formateados (reglas de campo aplicadas)."""
+        from .pedimento_proforma_v2 import RegistroDoc
+
         layout = layout_registro.layout_id
-        campos = layout_registro.campo_ids.sorted(lambda c: c.orden or c.pos_ini or 0)
+        campos = self._get_layout_campos(layout_registro)
         effective_vals = self._apply_field_rules_to_vals(
             layout_registro.codigo,
             dict(valores or {}),
             partida_num=partida_num,
         )
+        fixed = layout.export_format != "pipe"
 
-        if layout.export_format == "pipe":
-            parts = []
-            for campo in campos:
-                val = effective_vals.get(campo.nombre)
-                if (val is None or val == "" or val is False) and layout_registro.codigo == "501":
-                    val = self._get_501_field_fallback_value(campo)
-                if val in (None, ""):
-                    if campo.default:
-                        val = campo.default
-                    elif campo.requerido:
-                        raise UserError(
-                            _("Falta el campo requerido %s en registro %s.")
-                            % (campo.nombre, layout_registro.codigo)
-                        )
-                    else:
-                        val = ""
-
-                txt = self._format_txt_value(campo, val)
-                if campo.longitud and len(txt) > campo.longitud:
-                    raise UserError(
-                        _("El campo %s excede la longitud %s.")
-                        % (campo.nombre, campo.longitud)
-                    )
-                parts.append(txt)
-
-            return (layout.field_separator or "|").join(parts)
-
-        line = [" "] * 2000
-        max_pos = 0
+        parts = []
+        posiciones = []
         for campo in campos:
-            if not campo.pos_ini or not campo.pos_fin:
+            if fixed and (not campo.pos_ini or not campo.pos_fin):
                 raise UserError(
                     _("El campo %s del registro %s no tiene posiciones válidas.")
                     % (campo.nombre, layout_registro.codigo)
                 )
-            length = campo.longitud or (campo.pos_fin - campo.pos_ini + 1)
+            length = (campo.longitud or (campo.pos_fin - campo.pos_ini + 1)) if fixed else campo.longitud
 
             val = effective_vals.get(campo.nombre)
             if (val is None or val == "" or val is False) and layout_registro.codigo == "501":
@@ -3639,26 +3722,21 @@ class MxPedOperacion(models.Model):
                     val = ""
 
             txt = self._format_txt_value(campo, val)
-
-            if len(txt) > length:
+            if length and len(txt) > length:
                 raise UserError(
                     _("El campo %s excede la longitud %s.")
                     % (campo.nombre, length)
                 )
-
-            if campo.tipo in ("A", "AN", "F"):
-                txt = txt.ljust(length)
-            else:
-                txt = txt.rjust(length, "0")
-
-            pos_ini = campo.pos_ini - 1
-            pos_fin = pos_ini + length
-            if pos_fin > len(line):
-                line.extend([" "] * (pos_fin - len(line)))
-            line[pos_ini:pos_fin] = list(txt)
-            max_pos = max(max_pos, pos_fin)
-
-        return "".join(line[:max_pos])
+            parts.append(txt)
+            if fixed:
+                posiciones.append((campo.pos_ini, length, campo.tipo in ("A", "AN", "F")))
+
+        return RegistroDoc(
+            codigo=str(layout_registro.codigo or ""),
+            campos=tuple(parts),
+            posiciones=tuple(posiciones) if fixed else None,
+            nombres=tuple(campo.nombre or "" for campo in campos),
+        )
 
     def _get_501_field_fallback_value(self, campo):
         self.ensure_one()
@@ -3682,20 +3760,55 @@ class MxPedOperacion(models.Model):
         Usado para registros auto-inyectados (502/503/504) que no tienen entrada en el layout activo.
         """
         sep = (self.layout_id.field_separator or "|") if self.layout_id else "|"
-        parts = [str(v) if v not in (None, False) else "" for v in (valores or {}).values()]
-        return sep.join(parts)
+        return self._build_registro_doc_pipe_direct(codigo, valores).to_line(sep)
+
+    def _build_registro_doc_pipe_direct(self, codigo, valores):
+        from .pedimento_proforma_v2 import RegistroDoc
+
+        valores = valores or {}
+        parts = [str(v) if v not in (None, False) else "" for v in valores.values()]
+        return RegistroDoc(codigo=str(codigo or ""), campos=tuple(parts), nombres=tuple(str(k) for k in valores))
 
     def _build_export_lines_from_registros(self, registros):
         self.ensure_one()
-        lines = []
+        sep = (self.layout_id.field_separator or "|") if self.layout_id else "|"
+        return [doc.to_line(sep) for doc in self._build_registro_docs(registros)]
+
+    def _build_registro_docs(self, registros):
+        self.ensure_one()
+        docs = []
         for reg in registros:
             layout_reg = self._get_layout_registro(reg.codigo)
-            partida_num = self._extract_partida_number(reg.valores)
+            partida_num = reg.partida_numero or None
             if layout_reg:
-                lines.append(self._build_txt_line(layout_reg, reg.valores, partida_num=partida_num))
+                docs.append(self._build_registro_doc(layout_reg, reg.valores, partida_num=partida_num))
             else:
-                lines.append(self._build_txt_line_pipe_direct(reg.codigo, reg.valores))
-        return lines
+                docs.append(self._build_registro_doc_pipe_direct(reg.codigo, reg.valores))
+        return docs
+
+    def _get_pedimento_documento(self, fresh=False):
+        """PedimentoDocumento de la operación (registros ordenados y formateados).
+
+        Es la única fuente del TXT y de lo declarado en la proforma.  La
+        proforma lo lee del caché por firma de la operación (incluye layout,
+        rulepack y catálogos); el export TXT pasa fresh=True, lo arma de nuevo
+        y deja esa versión en el caché.
+        """
+        from .pedimento_proforma_v2 import PedimentoDocumento
+
+        self.ensure_one()
+        key = ("documento",) + self._validacion_stamp()
+        doc = None if fresh else validacion.cache_get(key)
+        if doc is None:
+            order_map = self._get_record_order_map()
+            registros = self.registro_ids.sorted(lambda r: self._registro_export_sort_key(r, order_map=order_map))
+            doc = PedimentoDocumento(
+                registros=self._build_registro_docs(registros),
+                field_sep=(self.layout_id.field_separator or "|") if self.layout_id else "|",
+                record_sep=self._get_record_separator(),
+            )
+            validacion.cache_put(key, doc)
+        return doc
 
     def _build_remesa_txt_member_name(self, remesa, suffix=".txt"):
         self.ensure_one()
@@ -3727,70 +3840,143 @@ class MxPedOperacion(models.Model):
             })
         return registros
 
-    def _get_remesa_557_registros(self, remesa):
-        """Genera registros 557 pro-rateados por valor/cantidad para una remesa.
+    def _get_remesas_exportables(self):
+        """Remesas activas del consolidado en orden de exportación."""
+        self.ensure_one()
+        return self.remesa_ids.filtered("active").sorted(lambda r: (r.sequence or 0, r.id))
 
-        Cada contribucion de cada partida asignada a la remesa se incluye con
-        importe y base proporcionales a la fraccion de valor USD (o cantidad si
-        value_usd es cero) que corresponde a esta remesa respecto al total de
-        la partida.  La tasa porcentual se mantiene intacta.
+    def _get_remesa_prorate(self, remesa, prorate=None):
+        """Matriz de prorrateo que incluye a `remesa`.
+
+        Se arma siempre sobre todas las remesas activas (más `remesa` si no
+        lo está): los centavos de _prorate_amounts se reparten entre todas,
+        así que prorratear una remesa sola daría otros importes.
         """
         self.ensure_one()
-        layout_reg = self._get_layout_registro("557")
-        if not layout_reg:
-            return []
-
-        registros = []
-        secuencia = 0
-        ordered_rel = remesa.partida_rel_ids.sorted(
+        if prorate is not None and remesa.id in prorate["rows"]:
+            return prorate
+        return self._build_remesa_prorate(self._get_remesas_exportables() | remesa)
+
+    def _build_remesa_prorate(self, remesas):
+        """Etapa de prorrateo: matriz remesa × partida calculada una sola vez.
+
+        Lee las asignaciones (mx.ped.consolidado.remesa.partida) de todas las
+        remesas en bloque, calcula el ratio de cada (remesa, partida) —valor
+        USD, o cantidad si la partida no tiene valor— y prorratea importe/base
+        de cada contribución con _prorate_amounts, para que la suma de las
+        remesas cuadre con la contribución del pedimento.
+
+        Returns:
+            dict con:
+              rows      : {remesa_id: [fila]} en orden de exportación; fila =
+                          {rel, partida, ratio, quantity, value_usd}
+              contrib   : {(remesa_id, contrib_id): {"importe", "base"}}
+              contribs  : {partida_id: contribuciones ordenadas}
+              payload_557 / partida_values / campo_kinds: cachés compartidos
+        """
+        self.ensure_one()
+        rels = self.env["mx.ped.consolidado.remesa.partida"].search([("remesa_id", "in", remesas.ids)])
+        rels = rels.sorted(
             lambda rel: (
                 (rel.partida_id.numero_partida or 0) if rel.partida_id else 0,
                 rel.sequence or 0,
                 rel.id,
             )
         )
-
-        for remesa_rel in ordered_rel:
-            partida = remesa_rel.partida_id
+        rows = {remesa.id: [] for remesa in remesas}
+        by_partida = {}
+        for rel in rels:
+            partida = rel.partida_id
             if not partida:
                 continue
-
-            # ── Calcular ratio de prorrateo ──────────────────────────────
             total_value = partida.value_usd or 0.0
             total_qty = partida.quantity or 0.0
-            remesa_value = remesa_rel.value_usd or 0.0
-            remesa_qty = remesa_rel.quantity or 0.0
-
             if total_value > 0:
-                ratio = remesa_value / total_value
+                ratio = (rel.value_usd or 0.0) / total_value
             elif total_qty > 0:
-                ratio = remesa_qty / total_qty
+                ratio = (rel.quantity or 0.0) / total_qty
             else:
                 ratio = 1.0
-
-            # ── Una linea 557 por cada contribucion de esta partida ──────
+            row = {
+                "rel": rel,
+                "partida": partida,
+                "ratio": ratio,
+                "quantity": rel.quantity,
+                "value_usd": rel.value_usd,
+            }
+            rows[rel.remesa_id.id].append(row)
+            by_partida.setdefault(partida.id, []).append(row)
+
+        remesa_rank = {remesa.id: (remesa.sequence or 0, remesa.id) for remesa in remesas}
+        contrib_shares = {}
+        contribs_by_partida = {}
+        for partida_id, partida_rows in by_partida.items():
+            partida = partida_rows[0]["partida"]
             contribs = partida.contribucion_ids.filtered(
                 lambda c: c.operacion_id == self
             ).sorted(lambda c: (c.sequence or 0, c.id))
-
+            contribs_by_partida[partida_id] = contribs
+            ratios = [row["ratio"] for row in partida_rows]
+            tiebreak = [remesa_rank[row["rel"].remesa_id.id] for row in partida_rows]
             for contrib in contribs:
+                importes = _prorate_amounts(contrib.importe or 0.0, ratios, tiebreak)
+                bases = (
+                    _prorate_amounts(contrib.base or 0.0, ratios, tiebreak)
+                    if (contrib.base or 0.0) > 0 else [None] * len(ratios)
+                )
+                for row, importe, base in zip(partida_rows, importes, bases):
+                    contrib_shares[(row["rel"].remesa_id.id, contrib.id)] = {"importe": importe, "base": base}
+
+        return {
+            "rows": rows,
+            "contrib": contrib_shares,
+            "contribs": contribs_by_partida,
+            "payload_557": {},
+            "partida_values": {},
+            "campo_kinds": {},
+        }
+
+    def _get_remesa_557_registros(self, remesa, prorate=None):
+        """Genera registros 557 pro-rateados por valor/cantidad para una remesa.
+
+        Cada contribucion de cada partida asignada a la remesa se incluye con
+        importe y base proporcionales a la fraccion de valor USD (o cantidad si
+        value_usd es cero) que corresponde a esta remesa respecto al total de
+        la partida.  La tasa porcentual se mantiene intacta.  Los montos vienen
+        de la matriz de _build_remesa_prorate.
+        """
+        self.ensure_one()
+        layout_reg = self._get_layout_registro("557")
+        if not layout_reg:
+            return []
+        prorate = self._get_remesa_prorate(remesa, prorate)
+
+        registros = []
+        secuencia = 0
+        for row in prorate["rows"].get(remesa.id, []):
+            partida = row["partida"]
+            fraccion = partida.fraccion_arancelaria or (partida.fraccion_id.code if partida.fraccion_id else "")
+
+            # ── Una linea 557 por cada contribucion de esta partida ──────
+            for contrib in prorate["contribs"].get(partida.id, []):
                 secuencia += 1
-                # Payload base usando la misma heuristica que el flujo normal
-                payload = self._build_sync_payload_from_layout(layout_reg, contrib, "557")
+                # Payload base (igual para todas las remesas) usando la misma
+                # heuristica que el flujo normal
+                if contrib.id not in prorate["payload_557"]:
+                    prorate["payload_557"][contrib.id] = self._build_sync_payload_from_layout(layout_reg, contrib, "557")
+                payload = dict(prorate["payload_557"][contrib.id])
 
                 # Sobrescribir importe y base con los valores prorrateados.
                 # La tasa (porcentaje) no se proratea, es una propiedad de la
                 # fraccion arancelaria y aplica igual independientemente de la
                 # cantidad de cada remesa.
-                payload["importe"] = round((contrib.importe or 0.0) * ratio, 2)
-                if (contrib.base or 0.0) > 0:
-                    payload["base"] = round((contrib.base or 0.0) * ratio, 2)
+                share = prorate["contrib"][(remesa.id, contrib.id)]
+                payload["importe"] = share["importe"]
+                if share["base"] is not None:
+                    payload["base"] = share["base"]
 
                 # Garantizar fraccion y numero de partida correctos
-                payload["fraccion_arancelaria"] = (
-                    partida.fraccion_arancelaria
-                    or (partida.fraccion_id.code if partida.fraccion_id else "")
-                )
+                payload["fraccion_arancelaria"] = fraccion
                 payload["numero_partida"] = partida.numero_partida or 0
 
                 registros.append({
@@ -3801,49 +3987,70 @@ class MxPedOperacion(models.Model):
 
         return registros
 
-    def _remesa_partida_override_value(self, campo, remesa_rel, base_val):
-        self.ensure_one()
-        partida = remesa_rel.partida_id
+    _REMESA_QUANTITY_TOKENS = frozenset({
+        "quantity",
+        "cantidad",
+        "cantidadumt",
+        "cantidadumc",
+        "cantidadcomercial",
+        "cantidadtarifa",
+    })
+    _REMESA_VALUE_USD_TOKENS = frozenset({
+        "valueusd",
+        "valorusd",
+        "valaduanausd",
+        "valoraduanausd",
+    })
+    _REMESA_VALUE_MXN_TOKENS = frozenset({
+        "valuemxn",
+        "valormxn",
+    })
+
+    def _remesa_campo_kind(self, campo):
+        """Clasifica un campo de layout 55x: qué columna de la remesa lo reemplaza."""
         source_name = (campo.source_field_id.name if getattr(campo, "source_field_id", False) else campo.source_field) or ""
         token = self._norm_layout_token(f"{campo.nombre} {source_name}")
         source_norm = self._norm_layout_token(source_name)
-        tipo_cambio = self.lead_id.x_tipo_cambio or 0.0
-
-        quantity_tokens = {
-            "quantity",
-            "cantidad",
-            "cantidadumt",
-            "cantidadumc",
-            "cantidadcomercial",
-            "cantidadtarifa",
-        }
-        value_usd_tokens = {
-            "valueusd",
-            "valorusd",
-            "valaduanausd",
-            "valoraduanausd",
-        }
-        value_mxn_tokens = {
-            "valuemxn",
-            "valormxn",
-        }
+        if source_norm in self._REMESA_QUANTITY_TOKENS or ("cantidad" in token and "precio" not in token):
+            return "quantity"
+        if source_norm in self._REMESA_VALUE_USD_TOKENS or ("valor" in token and "usd" in token):
+            return "value_usd"
+        if source_norm in self._REMESA_VALUE_MXN_TOKENS or ("valor" in token and "mxn" in token):
+            return "value_mxn"
+        return False
 
-        if source_norm in quantity_tokens or ("cantidad" in token and "precio" not in token):
+    def _remesa_partida_override_value(self, campo, remesa_rel, base_val, kind=None):
+        self.ensure_one()
+        kind = self._remesa_campo_kind(campo) if kind is None else kind
+        if kind == "quantity":
             return remesa_rel.quantity
-        if source_norm in value_usd_tokens or ("valor" in token and "usd" in token):
+        if kind == "value_usd":
             return remesa_rel.value_usd
-        if source_norm in value_mxn_tokens or ("valor" in token and "mxn" in token):
-            return (remesa_rel.value_usd or 0.0) * tipo_cambio
-
+        if kind == "value_mxn":
+            return (remesa_rel.value_usd or 0.0) * (self.lead_id.x_tipo_cambio or 0.0)
         return base_val
 
-    def _build_remesa_partida_payload(self, layout_reg, remesa_rel):
+    def _build_remesa_partida_payload(self, layout_reg, remesa_rel, prorate=None):
         self.ensure_one()
         partida = remesa_rel.partida_id
+        cache = prorate or {"partida_values": {}, "campo_kinds": {}}
+        campos = self._get_layout_campos(layout_reg, por_posicion=True)
+
+        # Valores de la partida (independientes de la remesa): una vez por partida
+        key = (layout_reg.id, partida.id)
+        if key not in cache["partida_values"]:
+            cache["partida_values"][key] = {
+                campo.id: self._field_value_for_layout(campo, partida=partida) for campo in campos
+            }
+        partida_values = cache["partida_values"][key]
+
         valores = {}
-        for campo in layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0):
-            val = self._field_value_for_layout(campo, partida=partida)
-            val = self._remesa_partida_override_value(campo, remesa_rel, val)
+        for campo in campos:
+            if campo.id not in cache["campo_kinds"]:
+                cache["campo_kinds"][campo.id] = self._remesa_campo_kind(campo)
+            val = self._remesa_partida_override_value(
+                campo, remesa_rel, partida_values[campo.id], kind=cache["campo_kinds"][campo.id],
+            )
             if val in (None, "", False) and campo.default:
                 val = campo.default
             val = self._json_safe_layout_value(val)
@@ -3851,17 +4058,16 @@ class MxPedOperacion(models.Model):
                 valores[campo.nombre] = val
         return valores
 
-    def _get_remesa_partida_registros(self, remesa, codes):
+    def _get_remesa_partida_registros(self, remesa, codes, prorate=None):
         self.ensure_one()
         code_set = {str(code).zfill(3) for code in (codes or [])}
         layout_regs = {
             reg.codigo: reg
             for reg in self.layout_id.registro_ids.filtered(lambda r: (r.codigo or "").strip() in code_set)
         }
+        prorate = self._get_remesa_prorate(remesa, prorate)
+        ordered_rel = [row["rel"] for row in prorate["rows"].get(remesa.id, [])]
         registros = []
-        ordered_rel = remesa.partida_rel_ids.sorted(
-            lambda rel: ((rel.partida_id.numero_partida or 0) if rel.partida_id else 0, rel.sequence or 0, rel.id)
-        )
         for code in sorted(code_set):
             layout_reg = layout_regs.get(code)
             if not layout_reg:
@@ -3870,55 +4076,354 @@ class MxPedOperacion(models.Model):
                 registros.append({
                     "codigo": code,
                     "secuencia": secuencia,
-                    "valores": self._build_remesa_partida_payload(layout_reg, remesa_rel),
+                    "valores": self._build_remesa_partida_payload(layout_reg, remesa_rel, prorate=prorate),
                 })
         return registros
 
-    def _build_remesa_export_registros(self, remesa):
+    # Registros que se regeneran por remesa; el resto es común a todas.
+    _REMESA_SPECIFIC_CODES = frozenset({"514", "557", "551", "552", "553", "554", "555", "556", "558"})
+    _REMESA_PARTIDA_CODES = frozenset({"551", "552", "553", "554", "555", "556", "558"})
+
+    def _prepare_remesa_export_base(self, remesas=None):
+        """Calcula una sola vez lo común a todas las remesas del consolidado.
+
+        Returns:
+            dict con:
+              order_map  : orden de registros del plan de reglas
+              layout_for : función codigo → layout registro (memoizada)
+              base       : [(sort_key, registro, línea TXT)] de los registros
+                           no específicos de remesa (500/501/502…), ya
+                           serializados y ordenados por sort_key
+              prorate    : matriz de prorrateo de `remesas` (por omisión,
+                           todas las remesas activas)
+        """
         self.ensure_one()
-        excluded_codes = {"514", "557", "551", "552", "553", "554", "555", "556", "558"}
+        if remesas is None:
+            remesas = self._get_remesas_exportables()
         order_map = self._get_record_order_map()
-        base_regs = [
-            reg for reg in self.registro_ids.sorted(lambda r: self._registro_export_sort_key(r, order_map=order_map))
-            if (reg.codigo or "").strip() not in excluded_codes
-        ]
-        remesa_regs = list(base_regs)
-        remesa_regs.extend(self._get_remesa_557_registros(remesa))
-        remesa_regs.extend(self._get_remesa_514_registros(remesa))
-        remesa_regs.extend(self._get_remesa_partida_registros(remesa, {"551", "552", "553", "554", "555", "556", "558"}))
-        remesa_regs.sort(
-            key=lambda r: (
-                order_map.get((r["codigo"] if isinstance(r, dict) else (r.codigo or "")).strip()) or 999999,
-                (self._get_layout_registro(r["codigo"] if isinstance(r, dict) else r.codigo).orden if self._get_layout_registro(r["codigo"] if isinstance(r, dict) else r.codigo) else 0),
-                (r["codigo"] if isinstance(r, dict) else r.codigo),
-                (r["secuencia"] if isinstance(r, dict) else (r.secuencia or 0)),
-            )
+        layout_cache = {}
+
+        def layout_for(codigo):
+            if codigo not in layout_cache:
+                layout_cache[codigo] = self._get_layout_registro(codigo)
+            return layout_cache[codigo]
+
+        base = []
+        for reg in self.registro_ids.sorted(lambda r: self._registro_export_sort_key(r, order_map=order_map)):
+            if (reg.codigo or "").strip() in self._REMESA_SPECIFIC_CODES:
+                continue
+            layout_reg = layout_for(reg.codigo)
+            if layout_reg:
+                partida_num = reg.partida_numero or None
+                line = self._build_txt_line(layout_reg, reg.valores, partida_num=partida_num)
+            else:
+                line = self._build_txt_line_pipe_direct(reg.codigo, reg.valores)
+            sort_key = self._remesa_merge_sort_key(reg.codigo, reg.secuencia, order_map, layout_for)
+            base.append((sort_key, reg, line))
+        # Orden de mezcla (sort estable): se hace una vez para todas las remesas
+        base.sort(key=lambda item: item[0])
+        return {
+            "order_map": order_map,
+            "layout_for": layout_for,
+            "base": base,
+            "prorate": self._build_remesa_prorate(remesas),
+        }
+
+    def _remesa_merge_sort_key(self, codigo, secuencia, order_map, layout_for):
+        layout_reg = layout_for(codigo)
+        return (
+            order_map.get((codigo or "").strip()) or 999999,
+            layout_reg.orden if layout_reg else 0,
+            codigo,
+            secuencia or 0,
         )
-        return remesa_regs
 
-    def _build_remesa_txt_data(self, remesa):
+    def _get_remesa_specific_registros(self, remesa, prorate=None):
         self.ensure_one()
-        registros = self._build_remesa_export_registros(remesa)
-        lines = []
-        for reg in registros:
-            if isinstance(reg, dict):
-                layout_reg = self._get_layout_registro(reg["codigo"])
-                partida_num = self._extract_partida_number(reg["valores"])
-                lines.append(self._build_txt_line(layout_reg, reg["valores"], partida_num=partida_num))
-            else:
-                layout_reg = self._get_layout_registro(reg.codigo)
-                partida_num = self._extract_partida_number(reg.valores)
-                if layout_reg:
-                    lines.append(self._build_txt_line(layout_reg, reg.valores, partida_num=partida_num))
-                else:
-                    lines.append(self._build_txt_line_pipe_direct(reg.codigo, reg.valores))
+        prorate = self._get_remesa_prorate(remesa, prorate)
+        registros = []
+        registros.extend(self._get_remesa_557_registros(remesa, prorate=prorate))
+        registros.extend(self._get_remesa_514_registros(remesa))
+        registros.extend(self._get_remesa_partida_registros(remesa, self._REMESA_PARTIDA_CODES, prorate=prorate))
+        return registros
+
+    def _merge_remesa_export(self, remesa, export_base):
+        """Mezcla los registros base con los específicos de la remesa.
+
+        Devuelve [(registro o dict, línea)] en orden de exportación.  La base
+        ya viene ordenada; solo se ordenan los registros de la remesa y se
+        mezclan con heapq.merge, que ante llaves iguales deja primero la base
+        y conserva el orden de generación (557/514/55x), igual que el sort
+        estable original.
+        """
+        layout_for = export_base["layout_for"]
+        order_map = export_base["order_map"]
+        prorate = self._get_remesa_prorate(remesa, export_base.get("prorate"))
+        specific = []
+        for reg in self._get_remesa_specific_registros(remesa, prorate=prorate):
+            layout_reg = layout_for(reg["codigo"])
+            partida_num = self._extract_partida_number(reg["valores"])
+            line = self._build_txt_line(layout_reg, reg["valores"], partida_num=partida_num)
+            key = self._remesa_merge_sort_key(reg["codigo"], reg["secuencia"], order_map, layout_for)
+            specific.append((key, reg, line))
+        specific.sort(key=lambda item: item[0])
+        merged = heapq.merge(export_base["base"], specific, key=lambda item: item[0])
+        return [(reg, line) for _key, reg, line in merged]
+
+    def _build_remesa_export_registros(self, remesa, export_base=None):
+        self.ensure_one()
+        export_base = export_base or self._prepare_remesa_export_base()
+        return [reg for reg, _line in self._merge_remesa_export(remesa, export_base)]
+
+    def _build_remesa_txt_data(self, remesa, export_base=None):
+        self.ensure_one()
+        export_base = export_base or self._prepare_remesa_export_base()
+        lines = [line for _reg, line in self._merge_remesa_export(remesa, export_base)]
         sep = self._get_record_separator()
         return sep.join(lines)
 
+    # Relaciones cuyo cambio invalida la validación cacheada
+    _VALIDACION_STAMP_RELATIONS = (
+        "partida_ids",
+        "contribucion_global_ids",
+        "partida_contribucion_ids",
+        "documento_ids",
+        "registro_ids",
+        "remesa_ids",
+        "remesa_ids.partida_rel_ids",
+        "cuenta_aduanera_ids",
+        "compensacion_line_ids",
+        "identificador_pedimento_ids",
+        "partida_identificador_ids",
+        "estructura_regla_id.line_ids",
+        "rulepack_id.scenario_ids",
+        "rulepack_id.selector_ids",
+        "rulepack_id.process_rule_ids",
+        "rulepack_id.condition_rule_ids",
+    )
+    _VALIDACION_STAMP_RECORDS = ("lead_id", "layout_id", "estructura_regla_id", "rulepack_id")
+    # Catálogos y parámetros globales que leen las reglas y el export
+    _VALIDACION_STAMP_MODELS = (
+        "ir.config_parameter",
+        "mx.tigie.maestra",
+        "mx.ped.clave.regla.registro",
+        "aduana.catalogo.clave_pedimento",
+        "aduana.catalogo.contribucion",
+        "aduana.catalogo.pais",
+        "res.country",
+    )
+
+    def _validacion_stamp(self):
+        """Firma de la operación para el caché de validación.
+
+        write_date de la operación, de los registros ligados (lead, layout,
+        estructura, rulepack) y, por relación, (número de líneas, write_date
+        más reciente): cualquier alta, baja o edición cambia la firma.  Se
+        suman la firma de la tabla de búsqueda del layout (registros y
+        campos) y la de los catálogos globales.
+        """
+        self.ensure_one()
+        stamp = [self.env.cr.dbname, self.id, str(self.write_date)]
+        for fname in self._VALIDACION_STAMP_RECORDS:
+            stamp.append(str(self[fname].write_date) if self[fname] else "")
+        stamp.extend(self._validacion_stamp_relaciones()[self.id])
+        stamp.append(self.layout_id._lookup_stamp() if self.layout_id else ())
+        stamp.append(self._validacion_stamp_global())
+        return tuple(stamp)
+
+    def _validacion_stamp_relaciones(self):
+        """{operacion_id: [(conteo, write_date más reciente) por relación]}.
+
+        Una consulta con un COUNT/MAX(write_date) agrupado por operación para
+        cada ruta de `_VALIDACION_STAMP_RELATIONS`, en vez de leer las líneas
+        por ORM.
+        """
+        queries = []
+        models_to_flush = {self._name}
+        for pos, path in enumerate(self._VALIDACION_STAMP_RELATIONS):
+            model = self
+            fnames = path.split(".")
+            first = model._fields[fnames[0]]
+            if first.type == "one2many":
+                # Arranca en la tabla hija, agrupando por su llave a la operación
+                model = self.env[first.comodel_name]
+                alias = "t0"
+                key = f'{alias}."{first.inverse_name}"'
+                sql_from = f'"{model._table}" {alias}'
+                where = f"{key} = ANY(%(ids)s)"
+                rest = fnames[1:]
+            else:
+                alias = "op"
+                key = "op.id"
+                sql_from = f'"{self._table}" op'
+                where = "op.id = ANY(%(ids)s)"
+                rest = fnames
+            models_to_flush.add(model._name)
+            for depth, fname in enumerate(rest, start=1):
+                field = model._fields[fname]
+                comodel = self.env[field.comodel_name]
+                child = f"t{depth}"
+                if field.type == "one2many":
+                    cond = f'{child}."{field.inverse_name}" = {alias}.id'
+                else:
+                    cond = f'{child}.id = {alias}."{fname}"'
+                sql_from += f' JOIN "{comodel._table}" {child} ON {cond}'
+                model, alias = comodel, child
+                models_to_flush.add(model._name)
+            queries.append(
+                f"(SELECT {pos} AS pos, {key} AS op_id, COUNT(DISTINCT {alias}.id), MAX({alias}.write_date)"
+                f" FROM {sql_from} WHERE {where} GROUP BY {key})"
+            )
+        for model_name in models_to_flush:
+            self.env[model_name].flush_model()
+        empty = (0, "")
+        result = {op_id: [empty] * len(queries) for op_id in self.ids}
+        stored_ids = [op_id for op_id in self.ids if isinstance(op_id, int)]
+        if not stored_ids:
+            return result
+        self.env.cr.execute(" UNION ALL ".join(queries), {"ids": stored_ids})
+        for pos, op_id, count, last in self.env.cr.fetchall():
+            result[op_id][pos] = (count, str(last) if last else "")
+        return result
+
+    @api.model
+    def _validacion_stamp_global(self):
+        """(conteo, write_date más reciente) de cada catálogo global; una consulta por transacción."""
+        cr = self.env.cr
+        stamp = cr.cache.get("mx_ped_validacion_stamp_global")
+        if stamp is None:
+            tables = []
+            for model_name in self._VALIDACION_STAMP_MODELS:
+                if model_name in self.env:
+                    self.env[model_name].flush_model()
+                    tables.append(self.env[model_name]._table)
+            cr.execute(" UNION ALL ".join(
+                "(SELECT %d, COUNT(*), MAX(write_date) FROM %s)" % (pos, table)
+                for pos, table in enumerate(tables)
+            ))
+            stamp = tuple((count, str(last)) for _pos, count, last in sorted(cr.fetchall()))
+            cr.cache["mx_ped_validacion_stamp_global"] = stamp
+        return stamp
+
+    def _get_validacion_resultado(self):
+        """Líneas de validación (dicts) cacheadas por firma de la operación."""
+        self.ensure_one()
+        key = ("lineas", self.env.lang) + self._validacion_stamp()
+        lineas = validacion.cache_get(key)
+        if lineas is None:
+            lineas = validacion.run_checks(self)
+            validacion.cache_put(key, lineas)
+        return [dict(linea) for linea in lineas]
+
+    def _validacion_estructura_cacheada(self, method_name):
+        """Resultado cacheado de un _validate_* de registros: mensaje de error o False.
+
+        Lo usa el wizard de validación; los exports validan en vivo
+        (`_check_registros_exportables`).
+        """
+        self.ensure_one()
+        key = (method_name, self.env.lang) + self._validacion_stamp()
+        msg = validacion.cache_get(key)
+        if msg is None:
+            msg = validacion.capture_validation(getattr(self, method_name))
+            validacion.cache_put(key, msg)
+        return msg
+
+    def _check_registros_exportables(self):
+        """Reglas de campo y estructura antes de exportar.
+
+        Siempre se evalúan en vivo (un export no se autoriza con un resultado
+        cacheado); el resultado refresca el caché que lee el wizard.
+        """
+        self.ensure_one()
+        stamp = self._validacion_stamp()
+        for method_name in ("_validate_field_rules_on_registros", "_validate_registros_vs_estructura"):
+            msg = validacion.capture_validation(getattr(self, method_name))
+            validacion.cache_put((method_name, self.env.lang) + stamp, msg)
+            if msg:
+                raise UserError(msg)
+
+    def _guardar_resumen_validacion(self, resumen):
+        """Guarda {op_id: (errores, advertencias)} sin tocar write_date."""
+        if not resumen:
+            return
+        now = fields.Datetime.now()
+        values = [(op_id, errores, advertencias, now) for op_id, (errores, advertencias) in resumen.items()]
+        placeholders = ", ".join(["(%s, %s, %s, %s::timestamp)"] * len(values))
+        self.env.cr.execute(
+            f"""
+            UPDATE mx_ped_operacion AS op
+               SET validacion_errores = v.errores,
+                   validacion_advertencias = v.advertencias,
+                   validacion_fecha = v.fecha
+              FROM (VALUES {placeholders}) AS v(id, errores, advertencias, fecha)
+             WHERE op.id = v.id
+            """,
+            [item for row in values for item in row],
+        )
+        self.browse(list(resumen)).invalidate_recordset(
+            ["validacion_errores", "validacion_advertencias", "validacion_fecha"]
+        )
+
+    @staticmethod
+    def _contar_validacion(lineas):
+        errores = sum(1 for linea in lineas if linea["severidad"] == "error")
+        advertencias = sum(1 for linea in lineas if linea["severidad"] == "advertencia")
+        return errores, advertencias
+
+    @api.model
+    def _validar_en_lote(self, domain=None, chunk_size=50, commit=False):
+        """Ejecuta la validación del wizard sobre todas las operaciones del dominio.
+
+        Procesa por bloques de `chunk_size` (prefetch compartido dentro del
+        bloque, caché del ORM liberado entre bloques) y guarda los conteos
+        de errores/advertencias para filtrar en el dashboard.
+
+        Returns:
+            int: operaciones validadas.
+        """
+        ids = self.search(domain if domain is not None else [("fecha_pago", "=", False)]).ids
+        total = 0
+        for start in range(0, len(ids), chunk_size):
+            chunk = self.browse(ids[start:start + chunk_size])
+            resumen = {}
+            for op in chunk:
+                try:
+                    with self.env.cr.savepoint():
+                        resumen[op.id] = self._contar_validacion(op._get_validacion_resultado())
+                except Exception:
+                    _logger.exception("Validación en lote falló para operación %s", op.id)
+            self._guardar_resumen_validacion(resumen)
+            total += len(resumen)
+            if commit:
+                self.env.cr.commit()
+            self.env.invalidate_all()
+        return total
+
+    @api.model
+    def cron_validar_operaciones_abiertas(self):
+        self._validar_en_lote(commit=True)
+        return True
+
+    def action_validar_en_lote(self):
+        validadas = self._validar_en_lote(domain=[("id", "in", self.ids)])
+        return {
+            "type": "ir.actions.client",
+            "tag": "display_notification",
+            "params": {
+                "title": _("Validación en lote"),
+                "message": _("%d operación(es) validadas.") % validadas,
+                "type": "success",
+                "sticky": False,
+                "next": {"type": "ir.actions.client", "tag": "soft_reload"},
+            },
+        }
+
     def action_validar_operacion(self):
         """Abre el wizard de validación mostrando todos los errores y advertencias de una vez."""
         self.ensure_one()
         wizard = self.env["mx.ped.validacion.wizard"].ejecutar_para_operacion(self)
+        self._guardar_resumen_validacion({self.id: (wizard.total_errores, wizard.total_advertencias)})
         return {
             "type": "ir.actions.act_window",
             "name": _("Validación del Pedimento"),
@@ -3952,8 +4457,7 @@ class MxPedOperacion(models.Model):
             raise UserError(_("Falta seleccionar un layout en la operación."))
         if not self.registro_ids:
             raise UserError(_("No hay registros capturados para exportar."))
-        self._validate_field_rules_on_registros()
-        self._validate_registros_vs_estructura()
+        self._check_registros_exportables()
 
         if self.es_consolidado and self.modo_export_consolidado == "por_remesa":
             # ── Validación legal: el pedimento consolidado debe estar pagado ──
@@ -3966,14 +4470,16 @@ class MxPedOperacion(models.Model):
                     "principal esté pagado. Captura la fecha de pago en la pestaña "
                     "de datos generales."
                 ))
-            remesas = self.remesa_ids.filtered("active").sorted(lambda r: (r.sequence or 0, r.id))
+            remesas = self._get_remesas_exportables()
             if not remesas:
                 raise UserError(_("No hay remesas activas para exportar en modo por remesa."))
 
+            # Orden, registros base y sus líneas se calculan una vez para todo el ZIP
+            export_base = self._prepare_remesa_export_base(remesas)
             zip_buffer = io.BytesIO()
             with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
                 for remesa in remesas:
-                    txt_data = self._build_remesa_txt_data(remesa)
+                    txt_data = self._build_remesa_txt_data(remesa, export_base=export_base)
                     zip_file.writestr(self._build_remesa_txt_member_name(remesa), txt_data.encode("utf-8"))
 
             attachment = self.env["ir.attachment"].create({
@@ -3990,18 +4496,7 @@ class MxPedOperacion(models.Model):
                 "target": "self",
             }
 
-        lines = []
-        order_map = self._get_record_order_map()
-        for reg in self.registro_ids.sorted(lambda r: self._registro_export_sort_key(r, order_map=order_map)):
-            layout_reg = self._get_layout_registro(reg.codigo)
-            partida_num = self._extract_partida_number(reg.valores)
-            if layout_reg:
-                lines.append(self._build_txt_line(layout_reg, reg.valores, partida_num=partida_num))
-            else:
-                lines.append(self._build_txt_line_pipe_direct(reg.codigo, reg.valores))
-
-        sep = self._get_record_separator()
-        txt_data = sep.join(lines)
+        txt_data = self._get_pedimento_documento(fresh=True).to_txt()
         attachment = self.env["ir.attachment"].create({
             "name": self._build_txt_filename(),
             "type": "binary",
@@ -4016,74 +4511,6 @@ class MxPedOperacion(models.Model):
             "target": "self",
         }
 
-    def action_export_proforma(self):
-        self.ensure_one()
-        # ── Reutiliza toda la validación y construcción del TXT ──
-        self._auto_refresh_generated_registros()
-        self._sync_registro_ids_from_tecnicos()
-        self._validate_confirmacion_pago_formas()
-        self._validate_partida_facturas_505()
-        self._run_process_stage_checks("export")
-        if not self.layout_id:
-            raise UserError(_("Falta seleccionar un layout en la operación."))
-        if not self.registro_ids:
-            raise UserError(_("No hay registros capturados para exportar."))
-        self._validate_field_rules_on_registros()
-        self._validate_registros_vs_estructura()
-
-        lines = []
-        order_map = self._get_record_order_map()
-        for reg in self.registro_ids.sorted(lambda r: self._registro_export_sort_key(r, order_map=order_map)):
-            layout_reg = self._get_layout_registro(reg.codigo)
-            partida_num = self._extract_partida_number(reg.valores)
-            if layout_reg:
-                lines.append(self._build_txt_line(layout_reg, reg.valores, partida_num=partida_num))
-            else:
-                lines.append(self._build_txt_line_pipe_direct(reg.codigo, reg.valores))
-
-        sep = self._get_record_separator()
-        txt_data = sep.join(lines)
-
-        # ── Datos del agente desde la operación/compañía ──
-        agente = self._get_agente_data()
-
-        # ── Generar PDF ──
-        from .pedimento_proforma_v2 import generar_proforma
-        pdf_bytes = generar_proforma(txt_data, agente)
-
-        pedimento_ref = re.sub(r"[^A-Za-z0-9_-]+", "", (self.pedimento_numero or self.name or "").strip())
-        pdf_name = "proforma_%s.pdf" % (pedimento_ref or self.id)
-
-        attachment = self.env["ir.attachment"].create({
-            "name": pdf_name,
-            "type": "binary",
-            "datas": base64.b64encode(pdf_bytes),
-            "mimetype": "application/pdf",
-            "res_model": self._name,
-            "res_id": self.id,
-        })
-        return {
-            "type": "ir.actions.act_url",
-            "url": f"/web/content/{attachment.id}?download=true",
-            "target": "self",
-        }
-
-    def _get_agente_data(self):
-        """Extrae datos del agente aduanal desde la operación o la compañía."""
-        # Ajusta los campos según cómo los tengas guardados en tu modelo
-        company = self.env.company
-        return {
-            "nombre":           getattr(self, "agente_nombre", "") or company.name,
-            "rfc":              getattr(self, "agente_rfc",    "") or company.vat or "",
-            "curp":             getattr(self, "agente_curp",   ""),
-            "patente":          getattr(self, "patente",       ""),
-            "mandatario_nombre":getattr(self, "mandatario_nombre", ""),
-            "mandatario_rfc":   getattr(self, "mandatario_rfc",    ""),
-            "mandatario_curp":  getattr(self, "mandatario_curp",   ""),
-            "num_serie_cert":   getattr(self, "num_serie_cert",    ""),
-            "firma_electronica":getattr(self, "fiel",               ""),
-        }
-
     def _proforma_text(self, value, decimals=2):
         if value in (False, None, ""):
             return ""
@@ -4223,6 +4650,21 @@ class MxPedOperacion(models.Model):
         )
 
     def _build_proforma_pedimento(self):
+        """Pedimento de la proforma.
+
+        Lo declarado en los registros (el mismo PedimentoDocumento del TXT)
+        manda; los datos del ORM solo completan lo que el TXT no lleva.
+        """
+        from .pedimento_proforma_v2 import merge_declarado
+
+        self.ensure_one()
+        ped = self._build_proforma_complemento()
+        if self.layout_id and self.registro_ids:
+            ped = merge_declarado(ped, self._get_pedimento_documento().to_pedimento())
+        return ped
+
+    def _build_proforma_complemento(self):
+        """Pedimento armado desde los campos del ORM (domicilios, agente, guías...)."""
         from .pedimento_proforma_v2 import Pedimento
 
         self.ensure_one()
@@ -4539,6 +4981,8 @@ class MxPedOperacion(models.Model):
         self._validate_confirmacion_pago_formas()
         self._validate_partida_facturas_505()
         self._run_process_stage_checks("export")
+        if self.layout_id and self.registro_ids:
+            self._check_registros_exportables()
 
         from .pedimento_proforma_v2 import PedimentoPDF
 
@@ -4549,9 +4993,7 @@ class MxPedOperacion(models.Model):
 
         # ── Consolidado por remesa: ZIP con un PDF por remesa ────────────
         if self.es_consolidado and self.modo_export_consolidado == "por_remesa":
-            remesas = self.remesa_ids.filtered("active").sorted(
-                lambda r: (r.sequence or 0, r.id)
-            )
+            remesas = self._get_remesas_exportables()
             if not remesas:
                 raise UserError(_("No hay remesas activas para exportar."))
 
@@ -4632,8 +5074,7 @@ class MxPedOperacion(models.Model):
             raise UserError(_("Falta seleccionar un layout en la operación."))
         if not self.registro_ids:
             raise UserError(_("No hay registros capturados para exportar."))
-        self._validate_field_rules_on_registros()
-        self._validate_registros_vs_estructura()
+        self._check_registros_exportables()
 
         root = ET.Element("pedimento", layout=(self.layout_id.name or ""))
         order_map = self._get_record_order_map()
@@ -4645,7 +5086,7 @@ class MxPedOperacion(models.Model):
                 secuencia=str(reg.secuencia or 1),
             )
             layout_reg = self._get_layout_registro(reg.codigo)
-            partida_num = self._extract_partida_number(reg.valores)
+            partida_num = reg.partida_numero or None
             effective_vals = self._apply_field_rules_to_vals(
                 layout_reg.codigo,
                 dict(reg.valores or {}),
@@ -4999,53 +5440,8 @@ class MxPedOperacion(models.Model):
                 })
         return True
 
-    def _extract_bl_pdf_text(self, pdf_bytes):
-        if not PdfReader:
-            raise UserError(_("Falta dependencia PyPDF2 en el servidor para leer PDF de B/L."))
-        reader = PdfReader(io.BytesIO(pdf_bytes))
-        chunks = []
-        for page in reader.pages[:3]:
-            chunks.append(page.extract_text() or "")
-        return "\n".join(chunks)
-
     def _parse_bl_text(self, text):
-        clean = re.sub(r"[ \t]+", " ", text or "")
-
-        def _pick(patterns):
-            for pat in patterns:
-                m = re.search(pat, clean, re.IGNORECASE | re.MULTILINE)
-                if m:
-                    return (m.group(1) or "").strip()
-            return False
-
-        bl_no = _pick([
-            r"\bB/?L\s*(?:NO\.?|NUMBER)?\s*[:#]?\s*([A-Z0-9\-]+)",
-            r"\bMBL\s*[:#]?\s*([A-Z0-9\-]+)",
-            r"\bMASTER\s*B/?L\s*[:#]?\s*([A-Z0-9\-]+)",
-        ])
-        container = _pick([r"\b([A-Z]{4}\d{7})\b"])
-        seal = _pick([r"\b(?:SEAL\s*NO\.?\s*[:#]?\s*|/)([A-Z0-9]{6,})\b"])
-        kgs = _pick([r"(\d+(?:\.\d+)?)\s*KGS\b"])
-        cbm = _pick([r"(\d+(?:\.\d+)?)\s*CBM\b"])
-        bultos = _pick([
-            r"/\s*(\d+)\s+[A-Z ]{2,20}/",
-            r"\b(\d+)\s+(?:WOODEN\s+CASES?|PACKAGES?|PKGS?)\b",
-        ])
-        loading = _pick([r"Port of Loading\s*([A-Z0-9 ,\-\(\)]+)"])
-        discharge = _pick([r"Port of discharge:\s*Place of delivery\s*([A-Z0-9 ,\-\(\)\/]+)"])
-        vessel_line = _pick([r"Ocean Vessel\s+Voy\.?No\.\s+Port of Loading\s*([A-Z0-9 .,\-\(\)]+)"])
-
-        return {
-            "bl_no": bl_no,
-            "container": container,
-            "seal": seal,
-            "kgs": kgs,
-            "cbm": cbm,
-            "bultos": bultos,
-            "loading": loading,
-            "discharge": discharge,
-            "vessel": vessel_line,
-        }
+        return bl_parser.parse_bl_text(text)
 
     def action_read_bl(self):
         self.ensure_one()
@@ -5054,9 +5450,10 @@ class MxPedOperacion(models.Model):
         if not self.lead_id:
             raise UserError(_("La operacion requiere un Lead asociado para cargar datos del B/L."))
 
-        pdf_bytes = base64.b64decode(self.bl_file)
-        text = self._extract_bl_pdf_text(pdf_bytes)
-        parsed = self._parse_bl_text(text)
+        if not PdfReader:
+            raise UserError(_("Falta dependencia PyPDF2 en el servidor para leer PDF de B/L."))
+        parsed = self._parse_bl_text(bl_parser.read_bl_text(self, "bl_file"))
+        parsed.pop("template", None)
         if not any(parsed.values()):
             raise UserError(_("No se detectaron datos utiles en el B/L. Revisa calidad del PDF."))
 
@@ -5243,125 +5640,110 @@ class MxPedOperacion(models.Model):
 
     def _lead_value_for_field_name(self, field_name, source_field=None, source_model=None):
         self.ensure_one()
-        lead = self.lead_id
+        return self._value_for_source_binding(_compile_source_binding(field_name, source_field, source_model))
 
-        def _norm(name):
-            return (name or "").lower().replace(" ", "").replace("_", "")
-
-        aliases = {
-            "aduana": "aduana_clave",
-            "patente": "patente",
-            "clave_pedimento": "clave_pedimento",
-            "tipo_operacion": "tipo_operacion",
-            "tipo_movimiento": "tipo_movimiento",
-            "regimen": "regimen",
-            "incoterm": "incoterm",
-            "moneda": "currency_id",
-            "pais_origen": "x_pais_origen_id",
-            "pais_destino": "x_pais_destino_id",
-            "bultos": "total_packages_line",
-            "bultos_totales": "total_packages_line",
-            "numero_total_de_bultos": "total_packages_line",
-            "peso_bruto": "total_gross_weight",
-            "peso_bruto_total": "total_gross_weight",
-            "peso_bruto_total_de_la_mercancia": "total_gross_weight",
-            "peso_neto": "total_net_weight",
-            "peso_neto_total": "total_net_weight",
-            "peso_neto_total_de_la_mercancia": "total_net_weight",
-            "valor_factura": "x_valor_factura",
-            "valor_aduana": "x_valor_aduana_estimado",
-            "folio_operacion": "x_folio_operacion",
-            "referencia_cliente": "x_referencia_cliente",
-            "aduana_seccion_entrada_salida": "aduana_seccion_entrada_salida",
-            "medio_transporte_salida": "x_medio_transporte_salida",
-            "tipo_contenedor": "x_tipo_contenedor_id",
-            "clave_tipo_contenedor": "x_tipo_contenedor_id",
-            "acuse_validacion": "acuse_validacion",
-            "curp_agente": "curp_agente",
-            "rfc_importador_exportador": "participante_rfc",
-            "curp_importador_exportador": "participante_curp",
-            "nombre_importador_exportador": "participante_nombre",
-            "comprador": "x_comprador_id",
-            "nombre_proveedor_comprador": "x_counterparty_name_505",
-        }
-        aliases_by_norm = {_norm(key): value for key, value in aliases.items()}
-
-        source = source_field or aliases.get(field_name, aliases_by_norm.get(_norm(field_name), field_name))
-        source_model = source_model or "lead"
-
-        field_norm = _norm(field_name)
-        source_norm_hint = _norm(source)
-        if source == field_name:
-            if "pesobruto" in field_norm:
-                source = "total_gross_weight"
-            elif "pesoneto" in field_norm:
-                source = "total_net_weight"
-            elif "bulto" in field_norm or "paquete" in field_norm:
-                source = "total_packages_line"
-        elif "pesobruto" in source_norm_hint:
-            source = "total_gross_weight"
-        elif "pesoneto" in source_norm_hint:
-            source = "total_net_weight"
-        elif "bulto" in source_norm_hint or "paquete" in source_norm_hint:
-            source = "total_packages_line"
-
-        # Normaliza tipo de operación a 1/2 aunque el layout use nombre "amigable"
-        source_norm = _norm(source)
-        if source_norm in ("tipooperacion", "xtipooperacion"):
-            raw = self._record_value_for_field(lead, "x_tipo_operacion")
+    def _source_record(self, source_model):
+        """Registro del que sale el valor para un modelo origen del layout."""
+        self.ensure_one()
+        if source_model == "operacion":
+            return self
+        lead = self.lead_id
+        if source_model == "lead" or not lead:
+            return lead
+        if source_model == "cliente":
+            return lead.partner_id
+        if source_model == "importador":
+            return lead.x_importador_id
+        if source_model == "exportador":
+            return lead.x_exportador_id
+        if source_model == "comprador":
+            return lead.x_comprador_id
+        if source_model == "proveedor":
+            if lead.x_tipo_operacion == "exportacion":
+                return lead.x_comprador_id or lead.x_proveedor_id
+            return lead.x_proveedor_id
+        if source_model == "contraparte":
+            if lead.x_tipo_operacion == "exportacion":
+                return lead.x_comprador_id or lead.x_proveedor_id
+            return lead.x_proveedor_id or lead.x_comprador_id
+        if source_model == "transportista":
+            return lead.x_transportista_ids[:1].transportista_id
+        return lead
+
+    def _value_for_source_binding(self, binding):
+        kind, source, source_model = binding
+        if kind == "tipo_operacion":
+            # Normaliza tipo de operación a 1/2 aunque el layout use nombre "amigable"
+            raw = self._record_value_for_field(self.lead_id, "x_tipo_operacion")
             raw = (str(raw or "")).strip().lower()
             if raw in ("importacion", "1", "01"):
                 return "1"
             if raw in ("exportacion", "2", "02"):
                 return "2"
             return ""
-        if source_norm in ("tipomovimiento", "xtipomovimiento"):
+        if kind == "tipo_movimiento":
             return self._get_tipo_movimiento_effective() or ""
-
-        # Origen/destino: usa Many2one al catálogo de países → devuelve saai_m3 (2 dígitos)
-        if source_norm in ("origendestino", "xorigendestino", "xorigendestinomercancia"):
+        if kind == "origen_destino":
+            # Usa Many2one al catálogo de países → devuelve saai_m3 (2 dígitos)
+            lead = self.lead_id
             pais = getattr(lead, "x_origen_destino_id", False) if lead else False
             if pais:
                 return (pais.saai_m3 or "").strip()
             # fallback al campo Char anterior para registros ya existentes
             return (getattr(lead, "x_origen_destino_mercancia", "") or "").strip()
-
-        if source_model == "operacion":
-            return self._record_value_for_field(self, source)
-        if source in {"total_packages_line", "total_gross_weight", "total_net_weight"}:
-            return self._record_value_for_field(self, source)
-        if source_model == "partida":
+        if kind == "none":
             return None
-        if source_model == "cliente":
-            return self._record_value_for_field(lead.partner_id if lead else None, source)
-        if source_model == "importador":
-            return self._record_value_for_field(lead.x_importador_id if lead else None, source)
-        if source_model == "exportador":
-            return self._record_value_for_field(lead.x_exportador_id if lead else None, source)
-        if source_model == "proveedor":
-            if lead and lead.x_tipo_operacion == "exportacion":
-                partner = lead.x_comprador_id or lead.x_proveedor_id
-                return self._record_value_for_field(partner, source)
-            return self._record_value_for_field(lead.x_proveedor_id if lead else None, source)
-        if source_model == "comprador":
-            return self._record_value_for_field(lead.x_comprador_id if lead else None, source)
-        if source_model == "contraparte":
-            if lead and lead.x_tipo_operacion == "exportacion":
-                partner = lead.x_comprador_id or lead.x_proveedor_id
-            else:
-                partner = lead.x_proveedor_id or lead.x_comprador_id if lead else None
-            return self._record_value_for_field(partner, source)
-        if source_model == "transportista":
-            t_line = lead.x_transportista_ids[:1] if lead else None
-            return self._record_value_for_field(t_line.transportista_id if t_line else None, source)
+        return self._record_value_for_field(self._source_record(source_model), source)
+
+    def _campo_fuente(self, campo):
+        """(nombre, campo origen, modelo origen) del campo, desde la tabla del layout."""
+        layout = campo.registro_id.layout_id
+        fuente = layout._get_lookup().fuentes.get(campo.id) if layout else None
+        if fuente is None:
+            source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
+            fuente = (campo.nombre or "", source_name or "", campo.source_model or "")
+        return fuente
 
-        return self._record_value_for_field(lead, source)
+    def _prefetch_layout_sources(self, campos, partidas=None):
+        """Lee de una vez, por registro fuente, los campos que usarán `campos`.
+
+        Después `_field_value_for_layout` solo consulta el caché del ORM: la
+        carga desde el lead hace un número fijo de lecturas sin importar
+        cuántos registros o partidas genere.
+        """
+        self.ensure_one()
+        por_modelo = defaultdict(set)
+        partida_fields = set()
+        for campo in campos:
+            nombre, source_name, source_model = self._campo_fuente(campo)
+            if source_model == "partida":
+                partida_fields.add(source_name or nombre)
+                continue
+            kind, source, model = _compile_source_binding(nombre, source_name, source_model)
+            if kind == "record":
+                por_modelo[model].add(source)
+
+        def fetchable(records, names):
+            result = set()
+            for name in names:
+                if name in records._fields:
+                    result.add(name)
+                elif not name.startswith("x_") and f"x_{name}" in records._fields:
+                    result.add(f"x_{name}")
+            return list(result)
+
+        for model, names in por_modelo.items():
+            record = self._source_record(model)
+            if record:
+                record.fetch(fetchable(record, names))
+        if partidas and partida_fields:
+            partidas.fetch(fetchable(partidas, partida_fields))
 
     def _field_value_for_layout(self, campo, partida=None):
         self.ensure_one()
-        source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
-        if campo.source_model == "partida":
-            source = source_name or campo.nombre
+        nombre, source_name, source_model = self._campo_fuente(campo)
+        if source_model == "partida":
+            source = source_name or nombre
             val = self._record_value_for_field(partida, source)
             # fraccion_arancelaria es un snapshot que puede quedar vacío si la
             # línea del lead se creó programáticamente (sin disparar el onchange).
@@ -5379,11 +5761,7 @@ class MxPedOperacion(models.Model):
             if not val and source in ("cantidad_tarifa", "cantidad_umt") and partida:
                 val = partida.cantidad_comercial or partida.quantity or 0.0
             return val
-        return self._lead_value_for_field_name(
-            campo.nombre,
-            source_field=source_name,
-            source_model=campo.source_model,
-        )
+        return self._value_for_source_binding(_compile_source_binding(nombre, source_name, source_model))
 
     def _document_value_for_505_field(self, campo, documento):
         self.ensure_one()
@@ -5554,7 +5932,7 @@ class MxPedOperacion(models.Model):
     def _build_505_valores(self, layout_reg, documento):
         self.ensure_one()
         valores = {}
-        for campo in layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0):
+        for campo in self._get_layout_campos(layout_reg, por_posicion=True):
             source_name = (campo.source_field_id.name if campo.source_field_id else campo.source_field) or ""
             campo_name = self._norm_layout_token(campo.nombre)
             source_norm = self._norm_layout_token(source_name)
@@ -5584,7 +5962,7 @@ class MxPedOperacion(models.Model):
         tipo_code = (fecha_line.tipo_fecha_code or "").strip()
         fecha_txt = self._format_506_date(fecha_line.fecha)
 
-        for campo in layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0):
+        for campo in self._get_layout_campos(layout_reg, por_posicion=True):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = (campo.nombre or "").strip().lower()
             source_norm = (source_name or "").strip().lower()
@@ -5616,7 +5994,7 @@ class MxPedOperacion(models.Model):
         comp2 = ((identificador_line.complemento2 if identificador_line else "") or "").strip() or "NULO"
         comp3 = ((identificador_line.complemento3 if identificador_line else "") or "").strip() or "NULO"
 
-        for campo in layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0):
+        for campo in self._get_layout_campos(layout_reg, por_posicion=True):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = (campo.nombre or "").strip().lower()
             source_norm = (source_name or "").strip().lower()
@@ -5664,7 +6042,7 @@ class MxPedOperacion(models.Model):
         self.ensure_one()
         valores = {}
         fecha_txt = self._format_508_date(cuenta_line.fecha_constancia)
-        for campo in layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0):
+        for campo in self._get_layout_campos(layout_reg, por_posicion=True):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = self._norm_layout_token(campo.nombre)
             source_norm = self._norm_layout_token(source_name)
@@ -5707,7 +6085,7 @@ class MxPedOperacion(models.Model):
     def _build_501_valores(self, layout_reg):
         self.ensure_one()
         valores = {}
-        for campo in layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0):
+        for campo in self._get_layout_campos(layout_reg, por_posicion=True):
             source_name = (campo.source_field_id.name if campo.source_field_id else campo.source_field) or ""
             campo_name = self._norm_layout_token(campo.nombre)
             source_norm = self._norm_layout_token(source_name)
@@ -5741,7 +6119,7 @@ class MxPedOperacion(models.Model):
         sequence_txt = str(observation_line.get("sequence") or "").zfill(3)
         clean_text = self._sanitize_511_text(observation_line.get("texto"))
 
-        ordered_campos = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+        ordered_campos = self._get_layout_campos(layout_reg, por_posicion=True)
         for idx, campo in enumerate(ordered_campos, start=1):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = self._norm_layout_token(campo.nombre)
@@ -5787,7 +6165,7 @@ class MxPedOperacion(models.Model):
         if descargo_line.get("fecha_operacion_original"):
             fecha_original = fields.Date.from_string(descargo_line["fecha_operacion_original"]).strftime("%d%m%Y")
 
-        ordered_campos = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+        ordered_campos = self._get_layout_campos(layout_reg, por_posicion=True)
         for idx, campo in enumerate(ordered_campos, start=1):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = self._norm_layout_token(campo.nombre)
@@ -5852,7 +6230,7 @@ class MxPedOperacion(models.Model):
         if compensacion_line.get("fecha_pago_original"):
             fecha_original = fields.Date.from_string(compensacion_line["fecha_pago_original"]).strftime("%d%m%Y")
 
-        ordered_campos = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+        ordered_campos = self._get_layout_campos(layout_reg, por_posicion=True)
         for idx, campo in enumerate(ordered_campos, start=1):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = self._norm_layout_token(campo.nombre)
@@ -5905,7 +6283,7 @@ class MxPedOperacion(models.Model):
                 if cuenta and cuenta.institucion_financiera_id:
                     institucion_emisora = cuenta.institucion_financiera_id.name or ""
 
-        ordered_campos = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+        ordered_campos = self._get_layout_campos(layout_reg, por_posicion=True)
         for idx, campo in enumerate(ordered_campos, start=1):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = self._norm_layout_token(campo.nombre)
@@ -5974,7 +6352,7 @@ class MxPedOperacion(models.Model):
         self.ensure_one()
         valores = {}
 
-        ordered_campos = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+        ordered_campos = self._get_layout_campos(layout_reg, por_posicion=True)
         for idx, campo in enumerate(ordered_campos, start=1):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = self._norm_layout_token(campo.nombre)
@@ -6045,7 +6423,7 @@ class MxPedOperacion(models.Model):
         transporte_identificador = candado_line.get("transporte_identificador") or ""
         num_candado = candado_line.get("num_candado") or ""
 
-        ordered_campos = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+        ordered_campos = self._get_layout_campos(layout_reg, por_posicion=True)
         for idx, campo in enumerate(ordered_campos, start=1):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = self._norm_layout_token(campo.nombre)
@@ -6197,7 +6575,7 @@ class MxPedOperacion(models.Model):
     def _build_502_valores(self, layout_reg, transporte_line):
         self.ensure_one()
         valores = {}
-        ordered_campos = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+        ordered_campos = self._get_layout_campos(layout_reg, por_posicion=True)
         for idx, campo in enumerate(ordered_campos, start=1):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = self._norm_layout_token(campo.nombre)
@@ -6238,7 +6616,7 @@ class MxPedOperacion(models.Model):
     def _build_503_valores(self, layout_reg, guia_line):
         self.ensure_one()
         valores = {}
-        ordered_campos = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+        ordered_campos = self._get_layout_campos(layout_reg, por_posicion=True)
         for idx, campo in enumerate(ordered_campos, start=1):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = self._norm_layout_token(campo.nombre)
@@ -6272,7 +6650,7 @@ class MxPedOperacion(models.Model):
     def _build_504_valores(self, layout_reg, contenedor_line):
         self.ensure_one()
         valores = {}
-        ordered_campos = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+        ordered_campos = self._get_layout_campos(layout_reg, por_posicion=True)
         for idx, campo in enumerate(ordered_campos, start=1):
             source_name = campo.source_field_id.name if campo.source_field_id else campo.source_field
             campo_name = self._norm_layout_token(campo.nombre)
@@ -6321,6 +6699,7 @@ class MxPedOperacion(models.Model):
         repeat_codes_by_partida = {"551", "552", "553", "554", "555", "556", "557", "558"}
         registros = []
         order_map = self._get_record_order_map()
+        self._prefetch_layout_sources(self.layout_id.registro_ids.campo_ids, self.partida_ids)
         for layout_reg in self.layout_id.registro_ids.sorted(lambda r: self._layout_registro_sort_key(r, order_map=order_map)):
             if allowed is not None and layout_reg.codigo not in allowed:
                 continue
@@ -6337,7 +6716,7 @@ class MxPedOperacion(models.Model):
             # Registros condicionales de escenario: solo via auto_single con guardia propia.
             if code in {"800", "801", "701", "702", "301", "302"}:
                 continue
-            campos = layout_reg.campo_ids.sorted(lambda c: c.pos_ini or c.orden or 0)
+            campos = self._get_layout_campos(layout_reg, por_posicion=True)
 
             if code == "506":
                 fecha_lines = self.lead_id.x_fecha_506_ids.sorted(lambda l: (l.sequence or 0, l.id))
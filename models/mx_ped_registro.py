@@ -1,5 +1,57 @@
 # -*- coding: utf-8 -*-
-from odoo import fields, models
+import hashlib
+import json
+import logging
+
+from odoo import api, fields, models
+from odoo.tools import split_every
+
+_logger = logging.getLogger(__name__)
+
+_PARTIDA_KEYS = frozenset({
+    "partida",
+    "numero_partida",
+    "num_partida",
+    "partida_numero",
+    "secuencia_partida",
+    "partida_seq",
+})
+_META_BATCH = 1000
+
+
+def extract_partida_number(payload):
+    """Número de partida declarado en un dict de valores, o None."""
+    if not payload or not isinstance(payload, dict):
+        return None
+    for key, value in payload.items():
+        if str(key or "").strip().lower() not in _PARTIDA_KEYS:
+            continue
+        if isinstance(value, int):
+            return value
+        if isinstance(value, str):
+            digits = "".join(ch for ch in value if ch.isdigit())
+            if digits:
+                return int(digits)
+    return None
+
+
+def valores_hash(valores):
+    """SHA-1 del JSON canónico de `valores` (para saltar escrituras idénticas)."""
+    raw = json.dumps(valores or {}, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def registro_meta(valores):
+    """Columnas indexadas que se derivan de `valores`."""
+    valores = valores if isinstance(valores, dict) else {}
+    source_id = valores.get("__source_id")
+    return {
+        "partida_numero": extract_partida_number(valores) or 0,
+        "sync_origin": valores.get("__sync_origin") or False,
+        "sync_key": valores.get("__sync_key") or False,
+        "source_id": source_id if isinstance(source_id, int) and not isinstance(source_id, bool) else 0,
+        "valores_hash": valores_hash(valores),
+    }
 
 
 class MxPedRegistro(models.Model):
@@ -17,3 +69,94 @@ class MxPedRegistro(models.Model):
     codigo = fields.Char(string="Código", required=True)
     secuencia = fields.Integer(default=1)
     valores = fields.Json(string="Valores")
+    # Metadatos extraídos de `valores` al escribir (ver `registro_meta`).
+    partida_numero = fields.Integer(string="Partida", readonly=True, index=True)
+    sync_origin = fields.Char(string="Origen de sincronización", readonly=True, index=True)
+    sync_key = fields.Char(string="Llave de sincronización", readonly=True, index=True)
+    source_id = fields.Integer(string="Id de origen", readonly=True)
+    valores_hash = fields.Char(string="Hash de valores", readonly=True)
+
+    def _backfill_registro_meta(self):
+        """Llena los metadatos de registros creados antes de existir las columnas.
+
+        Solo la llama la migración 18.0.1.12.0 (post-migrate).
+        """
+        cr = self.env.cr
+        last_id = 0
+        total = 0
+        while True:
+            cr.execute(
+                """
+                SELECT id, secuencia, valores FROM mx_ped_registro
+                 WHERE id > %s AND valores_hash IS NULL
+                 ORDER BY id LIMIT %s
+                """,
+                [last_id, _META_BATCH],
+            )
+            rows = cr.fetchall()
+            if not rows:
+                break
+            self._bulk_update_valores(rows, touch=False)
+            last_id = rows[-1][0]
+            total += len(rows)
+        if total:
+            _logger.info("Metadatos de registros extraídos: %s", total)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        for vals in vals_list:
+            if "valores" in vals:
+                vals.update(registro_meta(vals["valores"]))
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if "valores" in vals:
+            vals = dict(vals, **registro_meta(vals["valores"]))
+        return super().write(vals)
+
+    def _bulk_update_valores(self, rows, touch=True):
+        """Actualiza [(id, secuencia, valores)] con un UPDATE ... FROM (VALUES ...).
+
+        Sin auditoría ni un write por fila; write_date se actualiza para que
+        la firma de validación de la operación cambie (``touch=False`` la deja
+        igual, p. ej. al solo recalcular metadatos en una migración).
+        """
+        if not rows:
+            return
+        self.flush_model()
+        cr = self.env.cr
+        touch_sql = ", write_uid = %s, write_date = %s" if touch else ""
+        touch_params = [self.env.uid, cr.now()] if touch else []
+        for chunk in split_every(_META_BATCH, rows):
+            placeholders = []
+            params = []
+            for reg_id, secuencia, valores in chunk:
+                meta = registro_meta(valores)
+                placeholders.append("(%s::int, %s::int, %s::jsonb, %s::int, %s::varchar, %s::varchar, %s::int, %s::varchar)")
+                params += [
+                    reg_id,
+                    secuencia,
+                    json.dumps(valores or {}, ensure_ascii=False, default=str),
+                    meta["partida_numero"],
+                    meta["sync_origin"] or None,
+                    meta["sync_key"] or None,
+                    meta["source_id"],
+                    meta["valores_hash"],
+                ]
+            cr.execute(
+                """
+                UPDATE mx_ped_registro r
+                   SET secuencia = v.secuencia,
+                       valores = v.valores,
+                       partida_numero = v.partida_numero,
+                       sync_origin = v.sync_origin,
+                       sync_key = v.sync_key,
+                       source_id = v.source_id,
+                       valores_hash = v.valores_hash%s
+                  FROM (VALUES %s) AS v(id, secuencia, valores, partida_numero,
+                                        sync_origin, sync_key, source_id, valores_hash)
+                 WHERE r.id = v.id
+                """ % (touch_sql, ", ".join(placeholders)),
+                touch_params + params,
+            )
+        self.browse([row[0] for row in rows]).invalidate_recordset()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Trazas del motor de reglas por operación (solo se agregan filas).
+
+`mx.ped.operacion._store_rule_trace` calcula un hash del contenido de la
+traza y solo agrega una versión nueva cuando difiere de la vigente; la
+operación guarda el puntero (`rule_trace_id`) y la fecha de la última
+evaluación (`rule_trace_at`) por SQL, sin pasar por auditoría ni tracking.
+
+Retención (cron `cron_compactar_rule_traces`):
+  - Las `mx_ped.rule_trace.keep_full` versiones más recientes de cada
+    operación conservan el JSON legible; las anteriores se comprimen.
+  - Las versiones más allá de `mx_ped.rule_trace.max_versions` se
+    eliminan (0 = nunca).
+"""
+import hashlib
+import json
+import logging
+
+from odoo import api, fields, models
+
+from .mx_vucem_log import _pack_payload, _unpack_payload
+
+_logger = logging.getLogger(__name__)
+
+_KEEP_FULL_DEFAULT = 5
+_MAX_VERSIONS_DEFAULT = 50
+_COMPACT_BATCH = 500
+
+
+class MxPedRuleTrace(models.Model):
+    _name = "mx.ped.rule.trace"
+    _description = "Traza de reglas de operación"
+    _order = "id desc"
+    _rec_name = "content_hash"
+
+    operacion_id = fields.Many2one(
+        "mx.ped.operacion",
+        string="Operación",
+        required=True,
+        ondelete="cascade",
+        index=True,
+    )
+    content_hash = fields.Char(string="Hash de contenido", required=True, index=True, readonly=True)
+    rulepack_id = fields.Many2one("mx.ped.rulepack", string="Rulepack", ondelete="set null", readonly=True)
+    payload = fields.Json(string="Traza", readonly=True)
+    payload_gz = fields.Binary(string="Traza comprimida", attachment=False, readonly=True)
+    compressed = fields.Boolean(string="Comprimida", readonly=True)
+
+    @api.model
+    def _content_hash(self, payload):
+        """SHA-256 de la traza sin la marca de tiempo de generación."""
+        meta = {k: v for k, v in (payload.get("meta") or {}).items() if k != "generated_at"}
+        raw = json.dumps(
+            dict(payload, meta=meta),
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+            default=str,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _get_payload(self):
+        self.ensure_one()
+        if self.compressed:
+            return _unpack_payload(self.payload_gz)
+        return self.payload or {}
+
+    @api.model
+    def cron_compactar_rule_traces(self):
+        icp = self.env["ir.config_parameter"].sudo()
+        keep_full = max(int(icp.get_param("mx_ped.rule_trace.keep_full", _KEEP_FULL_DEFAULT) or 0), 1)
+        max_versions = int(icp.get_param("mx_ped.rule_trace.max_versions", _MAX_VERSIONS_DEFAULT) or 0)
+        cr = self.env.cr
+
+        if max_versions > 0:
+            cr.execute("""
+                DELETE FROM mx_ped_rule_trace t
+                 USING (
+                    SELECT id, row_number() OVER (PARTITION BY operacion_id ORDER BY id DESC) AS rn
+                      FROM mx_ped_rule_trace
+                 ) v
+                 WHERE t.id = v.id AND v.rn > %s
+            """, [max(max_versions, keep_full)])
+            if cr.rowcount:
+                _logger.info("Trazas de reglas eliminadas: %s", cr.rowcount)
+
+        while True:
+            cr.execute("""
+                SELECT id FROM (
+                    SELECT id, compressed,
+                           row_number() OVER (PARTITION BY operacion_id ORDER BY id DESC) AS rn
+                      FROM mx_ped_rule_trace
+                ) v
+                 WHERE v.rn > %s AND NOT COALESCE(v.compressed, FALSE)
+                 LIMIT %s
+            """, [keep_full, _COMPACT_BATCH])
+            ids = [row[0] for row in cr.fetchall()]
+            if not ids:
+                break
+            for trace in self.browse(ids):
+                trace.write({
+                    "payload_gz": _pack_payload(trace.payload or {}),
+                    "payload": False,
+                    "compressed": True,
+                })
+            self.env.invalidate_all()
+        return True
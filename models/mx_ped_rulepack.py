@@ -1,7 +1,26 @@
 # -*- coding: utf-8 -*-
+import bisect
+import threading
+from datetime import timedelta
+
 from odoo import api, fields, models, _
 from odoo.exceptions import ValidationError
 
+# ── Índice de vigencia por worker ────────────────────────────────────────────
+# Fechas de corte (fecha_inicio y fecha_fin + 1 de cada rulepack activo) y el
+# rulepack ganador de cada tramo, con la misma precedencia que
+# `mx.ped.operacion._resolve_rulepack` (priority desc, fecha_inicio desc,
+# id desc).  Se valida contra una firma de la tabla una vez por transacción;
+# create/write/unlink de rulepacks lo descartan.
+_INDEX = {}
+_INDEX_LOCK = threading.Lock()
+_INDEX_CR_KEY = "mx_ped_rulepack_index"
+
+
+def _rulepack_index_wipe(dbname):
+    with _INDEX_LOCK:
+        _INDEX.pop(dbname, None)
+
 
 class MxPedRulepack(models.Model):
     _name = "mx.ped.rulepack"
@@ -52,6 +71,77 @@ class MxPedRulepack(models.Model):
             if rec.fecha_fin and rec.fecha_fin < rec.fecha_inicio:
                 raise ValidationError(_("La fecha fin no puede ser menor que fecha inicio."))
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super().create(vals_list)
+        self._rulepack_index_invalidate()
+        return records
+
+    def write(self, vals):
+        res = super().write(vals)
+        self._rulepack_index_invalidate()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self._rulepack_index_invalidate()
+        return res
+
+    @api.model
+    def _rulepack_index_invalidate(self):
+        _rulepack_index_wipe(self.env.cr.dbname)
+        self.env.cr.cache.pop(_INDEX_CR_KEY, None)
+
+    @api.model
+    def _rulepack_index(self):
+        """(fechas de corte, rulepack ganador por tramo) de los rulepacks activos."""
+        cr = self.env.cr
+        index = cr.cache.get(_INDEX_CR_KEY)
+        if index is not None:
+            return index
+        cr.execute("SELECT COUNT(*), MAX(write_date) FROM mx_ped_rulepack")
+        stamp = cr.fetchone()
+        with _INDEX_LOCK:
+            hit = _INDEX.get(cr.dbname)
+        if hit and hit[0] == stamp:
+            index = hit[1]
+        else:
+            cr.execute("""
+                SELECT id, fecha_inicio, fecha_fin
+                  FROM mx_ped_rulepack
+                 WHERE active AND state = 'active' AND fecha_inicio IS NOT NULL
+                 ORDER BY priority DESC, fecha_inicio DESC, id DESC
+            """)
+            packs = cr.fetchall()
+            cortes = sorted(
+                {inicio for _id, inicio, _fin in packs}
+                | {fin + timedelta(days=1) for _id, _inicio, fin in packs if fin}
+            )
+            ganadores = [
+                next(
+                    (pack_id for pack_id, inicio, fin in packs if inicio <= corte and (not fin or fin >= corte)),
+                    False,
+                )
+                for corte in cortes
+            ]
+            index = (tuple(cortes), tuple(ganadores))
+            with _INDEX_LOCK:
+                _INDEX[cr.dbname] = (stamp, index)
+        cr.cache[_INDEX_CR_KEY] = index
+        return index
+
+    @api.model
+    def _resolve_many(self, dates):
+        """{fecha: rulepack_id o False} para cada fecha, sin consultas por fecha."""
+        cortes, ganadores = self._rulepack_index()
+        result = {}
+        for fecha in dates:
+            if fecha in result:
+                continue
+            pos = bisect.bisect_right(cortes, fecha) - 1
+            result[fecha] = ganadores[pos] if pos >= 0 else False
+        return result
+
 
 class MxPedRulepackScenario(models.Model):
     _name = "mx.ped.rulepack.scenario"
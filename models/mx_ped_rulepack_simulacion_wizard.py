@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import base64
+import csv
+import io
+from datetime import timedelta
+
+from odoo import fields, models, _
+from odoo.exceptions import UserError
+
+from . import rulepack_simulator as simulador
+
+
+class MxPedRulepackSimulacionWizard(models.TransientModel):
+    _name = "mx.ped.rulepack.simulacion.wizard"
+    _description = "Simulación de rulepack contra el historial de operaciones"
+
+    rulepack_id = fields.Many2one(
+        "mx.ped.rulepack",
+        string="Rulepack a simular",
+        required=True,
+        ondelete="cascade",
+    )
+    rulepack_base_id = fields.Many2one(
+        "mx.ped.rulepack",
+        string="Comparar contra",
+        ondelete="cascade",
+        help="Vacío: el rulepack vigente de cada operación.",
+    )
+    fecha_desde = fields.Date(
+        string="Operaciones desde",
+        required=True,
+        default=lambda self: fields.Date.context_today(self) - timedelta(days=365),
+    )
+    fecha_hasta = fields.Date(
+        string="Operaciones hasta",
+        required=True,
+        default=fields.Date.context_today,
+    )
+    total_operaciones = fields.Integer(string="Operaciones evaluadas", readonly=True)
+    total_con_cambios = fields.Integer(string="Operaciones con cambios", readonly=True)
+    resumen = fields.Text(string="Resumen", readonly=True)
+    reporte = fields.Binary(string="Reporte", readonly=True, attachment=False)
+    reporte_nombre = fields.Char(readonly=True)
+
+    def action_simular(self):
+        self.ensure_one()
+        if self.fecha_hasta < self.fecha_desde:
+            raise UserError(_("La fecha final no puede ser menor que la inicial."))
+        Operacion = self.env["mx.ped.operacion"]
+        ids = Operacion.search([
+            ("fecha_operacion", ">=", self.fecha_desde),
+            ("fecha_operacion", "<=", self.fecha_hasta),
+        ]).ids
+        if not ids:
+            raise UserError(_("No hay operaciones en el periodo indicado."))
+        snaps = simulador.snapshot_operaciones(self.env.cr, ids)
+
+        if self.rulepack_base_id:
+            old_ids = {snap["id"]: self.rulepack_base_id.id for snap in snaps}
+        else:
+            sin_pack = {snap["fecha_operacion"] for snap in snaps if not snap["rulepack_id"]}
+            por_fecha = self.env["mx.ped.rulepack"]._resolve_many(sin_pack)
+            old_ids = {
+                snap["id"]: snap["rulepack_id"] or por_fecha.get(snap["fecha_operacion"]) or False
+                for snap in snaps
+            }
+
+        pack_ids = {pack_id for pack_id in old_ids.values() if pack_id} | {self.rulepack_id.id}
+        packs = {
+            pack.id: simulador.compile_rulepack(pack, Operacion)
+            for pack in self.env["mx.ped.rulepack"].browse(pack_ids).exists()
+        }
+        claves = simulador.compile_claves(
+            self.env["mx.ped.clave"].browse({snap["clave_id"] for snap in snaps if snap["clave_id"]}),
+            Operacion,
+        )
+        fallback = simulador.compile_estructura_fallback(
+            self.env["mx.ped.estructura.regla"].search([("active", "=", True)]),
+            Operacion,
+        )
+        jobs = [(snap, old_ids[snap["id"]], self.rulepack_id.id) for snap in snaps]
+        resultados = simulador.simulate(jobs, packs, claves, fallback)
+
+        by_id = {snap["id"]: snap for snap in snaps}
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["operacion_id", "operacion", "fecha", "rulepack_anterior", "registro", "antes", "despues"])
+        por_registro = {}
+        con_cambios = 0
+        for op_id, cambios in resultados:
+            if not cambios:
+                continue
+            con_cambios += 1
+            snap = by_id[op_id]
+            old_pack = packs.get(old_ids[op_id])
+            for cambio in cambios:
+                por_registro[cambio["codigo"]] = por_registro.get(cambio["codigo"], 0) + 1
+                writer.writerow([
+                    op_id,
+                    snap["name"],
+                    fields.Date.to_string(snap["fecha_operacion"]) if snap["fecha_operacion"] else "",
+                    old_pack["code"] if old_pack else "",
+                    cambio["codigo"],
+                    cambio["antes"],
+                    cambio["despues"],
+                ])
+
+        resumen = [_("Operaciones evaluadas: %s") % len(resultados), _("Con cambios: %s") % con_cambios]
+        resumen += [_("Registro %s: %s operación(es)") % (code, count) for code, count in sorted(por_registro.items())]
+        self.write({
+            "total_operaciones": len(resultados),
+            "total_con_cambios": con_cambios,
+            "resumen": "\n".join(resumen),
+            "reporte": base64.b64encode(buffer.getvalue().encode("utf-8")),
+            "reporte_nombre": "simulacion_%s.csv" % (self.rulepack_id.code or self.rulepack_id.id),
+        })
+        return {
+            "type": "ir.actions.act_window",
+            "res_model": self._name,
+            "res_id": self.id,
+            "view_mode": "form",
+            "target": "new",
+        }
@@ -1,7 +1,485 @@
 # -*- coding: utf-8 -*-
+"""
+Validación previa a exportar de mx.ped.operacion.
+
+Las reglas viven en un registro de checks (`register_check`) que se evalúan
+en una sola pasada sobre una foto (`build_snapshot`) de la operación hecha
+de dicts simples: cada relación (partidas, documentos, contribuciones,
+remesas) se lee una vez con prefetch en lugar de volver a filtrarse en cada
+regla.
+
+El resultado se cachea por worker con la firma de la operación
+(`mx.ped.operacion._validacion_stamp`: write_date de la operación, de sus
+relaciones, del rulepack, la estructura, el layout y los catálogos), así
+abrir el wizard varias veces sin cambios intermedios reutiliza la misma
+validación.  Las entradas caducan a los `_RESULT_CACHE_TTL` segundos por si
+algo que no está en la firma cambió; los exports no leen este caché.
+"""
+import threading
+import time
+from collections import OrderedDict
+
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError, ValidationError
 
+_CHECKS = []
+
+_RESULT_CACHE_SIZE = 128
+_RESULT_CACHE_TTL = 300  # segundos
+_RESULT_CACHE = OrderedDict()
+_RESULT_CACHE_LOCK = threading.Lock()
+
+# Formas de pago que exigen documento 514
+_FP_VIRTUALES = frozenset({"2", "4", "7", "12", "15", "19", "22"})
+
+
+def register_check(func):
+    """Registra un check `func(snap, add)`; se ejecutan en orden de registro."""
+    _CHECKS.append(func)
+    return func
+
+
+def cache_get(key):
+    with _RESULT_CACHE_LOCK:
+        if key not in _RESULT_CACHE:
+            return None
+        stored_at, value = _RESULT_CACHE[key]
+        if time.monotonic() - stored_at > _RESULT_CACHE_TTL:
+            del _RESULT_CACHE[key]
+            return None
+        _RESULT_CACHE.move_to_end(key)
+        return value
+
+
+def cache_put(key, value):
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE[key] = (time.monotonic(), value)
+        _RESULT_CACHE.move_to_end(key)
+        while len(_RESULT_CACHE) > _RESULT_CACHE_SIZE:
+            _RESULT_CACHE.popitem(last=False)
+
+
+def _exc_lines(exc):
+    return [line.strip() for line in str(exc.args[0]).split("\n") if line.strip()]
+
+
+def capture_validation(method):
+    """Ejecuta un _validate_* de la operación; devuelve el mensaje de error o False."""
+    try:
+        method()
+    except (UserError, ValidationError) as exc:
+        return str(exc.args[0])
+    return False
+
+
+# ── Foto de la operación ─────────────────────────────────────────────────────
+
+def _contrib_key(contrib):
+    return (contrib.tipo_contribucion or "").strip() or str(contrib.contribucion_code or contrib.id)
+
+
+def build_snapshot(op):
+    """Lee una sola vez todo lo que usan los checks y lo deja en dicts."""
+    lead = op.lead_id
+    partidas = op.partida_ids
+    # Prefetch de las relaciones que se recorren por partida
+    partidas.mapped("fraccion_id.regulaciones_economia")
+    partidas.mapped("remesa_assignment_ids.remesa_id.active")
+    cancel = op._get_tipo_movimiento_effective() in {"2", "3"}
+
+    snap = {
+        "op": op,
+        "cancel": cancel,
+        "layout": bool(op.layout_id),
+        "clave": bool(op.clave_pedimento_id),
+        "aduana": bool(op.aduana_seccion_despacho_id),
+        "agente": bool(op.agente_aduanal_id),
+        "fecha_operacion": bool(op.fecha_operacion),
+        "incoterm": bool(op.incoterm),
+        "tipo_operacion": op.tipo_operacion,
+        "tipo_cambio": lead.x_tipo_cambio if lead else 0.0,
+        "es_rectificacion": op.es_rectificacion,
+        "rect_pedimento": (op.rect_pedimento_original or "").strip(),
+        "rect_fecha_pago": bool(op.rect_fecha_pago_original),
+        "rect_aduana": bool(op.rect_aduana_original_id),
+        "tiene_estructura": bool(op.estructura_regla_id or op.rulepack_id),
+        "tiene_registros": bool(op.registro_ids),
+        "tiene_cuentas": bool(op.cuenta_aduanera_ids),
+        "tiene_compensacion": bool(op.compensacion_line_ids),
+        "es_consolidado": op.es_consolidado,
+        "fecha_pago": bool(op.fecha_pago),
+        "modo_export": op.modo_export_consolidado,
+        "partidas": [],
+        "documentos": [],
+        "contribuciones": [],
+        "remesas": [],
+    }
+
+    for p in partidas:
+        frac = p.fraccion_id
+        snap["partidas"].append({
+            "id": p.id,
+            "ref": _("Partida %s") % (p.numero_partida or p.id),
+            "fraccion": bool(frac),
+            "frac_code": (frac.fraccion_8 or frac.llave_10 or "") if frac else "",
+            "regulaciones": bool((frac.regulaciones_economia or "").strip()) if frac else False,
+            "tiene_regulatorio": bool(p.nom_ids or p.permiso_ids or p.rrna_ids),
+            "quantity": p.quantity or 0.0,
+            "value_usd": p.value_usd or 0.0,
+            "factura_id": p.factura_documento_id.id,
+            "pais_origen": bool(p.pais_origen_id),
+            "descripcion": (p.descripcion or "").strip(),
+            "asignaciones": [
+                (a.quantity or 0.0, a.value_usd or 0.0)
+                for a in p.remesa_assignment_ids if a.remesa_id.active
+            ],
+        })
+
+    for doc in op.documento_ids:
+        snap["documentos"].append({
+            "id": doc.id,
+            "ref": _("Doc. %s") % (doc.folio or doc.id),
+            "tipo": doc.tipo or "",
+            "registro_codigo": (doc.registro_codigo or "").strip(),
+            "cfdi_valor_usd": doc.cfdi_valor_usd or 0.0,
+            "forma_pago_code": (doc.forma_pago_code or "").strip(),
+        })
+
+    for line in op.contribucion_global_ids:
+        snap["contribuciones"].append({
+            "importe": line.importe or 0.0,
+            "forma_pago_code": (line.forma_pago_code or "").strip(),
+            "label": (
+                (line.contribucion_id.abbreviation or "").strip()
+                or (line.tipo_contribucion or "").strip()
+                or str(line.id)
+            ),
+        })
+    snap["formas_pago"] = (
+        op._get_declared_formas_pago_codes() if hasattr(op, "_get_declared_formas_pago_codes") else set()
+    )
+
+    if op.es_consolidado:
+        remesas = op.remesa_ids.filtered("active") if op.remesa_ids else op.env["mx.ped.consolidado.remesa"]
+        for rem in remesas:
+            snap["remesas"].append({
+                "ref": _("Remesa %s") % (rem.folio or rem.id),
+                "cove_sin_acuse": bool(rem.cove_id and not rem.acuse_valor),
+                "partida_count": rem.partida_count,
+            })
+        if remesas and op.modo_export_consolidado == "por_remesa":
+            # Mismos montos que se exportan: matriz de prorrateo de las remesas
+            prorate = op._build_remesa_prorate(remesas)
+            contribs = {
+                c.id: c
+                for partida_contribs in prorate["contribs"].values()
+                for c in partida_contribs
+            }
+            prorrateado = {}
+            for (_remesa_id, contrib_id), share in prorate["contrib"].items():
+                key = _contrib_key(contribs[contrib_id])
+                prorrateado[key] = prorrateado.get(key, 0.0) + share["importe"]
+            real = {}
+            for contrib in op.partida_contribucion_ids:
+                key = _contrib_key(contrib)
+                real[key] = real.get(key, 0.0) + (contrib.importe or 0.0)
+            snap["suma_557_prorrateada"] = prorrateado
+            snap["suma_557_real"] = real
+    return snap
+
+
+def run_checks(op):
+    """Evalúa todos los checks registrados. Devuelve lista de dicts de línea."""
+    snap = build_snapshot(op)
+    lineas = []
+
+    def add(severidad, categoria, mensaje, referencia=None, seq=10):
+        lineas.append({
+            "severidad": severidad,
+            "categoria": categoria,
+            "mensaje": mensaje,
+            "referencia": referencia or "",
+            "sequence": seq,
+        })
+
+    for check in _CHECKS:
+        check(snap, add)
+
+    # Si no hay ningún problema, agregar línea de confirmación
+    if not lineas:
+        add("info", "general", _("Validación completada sin problemas. La operación está lista para exportar."), seq=1)
+    return lineas
+
+
+# ── Checks ───────────────────────────────────────────────────────────────────
+
+@register_check
+def _check_datos_generales(snap, add):
+    if not snap["layout"]:
+        add("error", "general", _("Falta seleccionar el Layout técnico."), seq=10)
+    if not snap["clave"]:
+        add("error", "general", _("Falta la Clave de Pedimento (ej. A1, V1)."), seq=20)
+    if not snap["aduana"]:
+        add("error", "general", _("Falta la Aduana / Sección de despacho."), seq=30)
+    if not snap["agente"]:
+        add("error", "general", _("Falta el Agente Aduanal."), seq=40)
+    if not snap["fecha_operacion"]:
+        add("error", "general", _("Falta la Fecha de operación."), seq=50)
+    if not snap["incoterm"] and snap["tipo_operacion"] == "importacion" and not snap["cancel"]:
+        # Para eliminación/desistimiento no aplica incoterm: la mercancía
+        # no llegó a entrar o salir del país.
+        add("advertencia", "general", _("No se indicó el Incoterm. Recomendado para importaciones."), seq=60)
+
+    tipo_cambio = snap["tipo_cambio"]
+    if not tipo_cambio or tipo_cambio <= 0:
+        add("error", "general", _("El Tipo de cambio en el Lead es 0 o no está definido. Los valores en MXN serán incorrectos."), seq=70)
+    elif tipo_cambio < 10 or tipo_cambio > 30:
+        add("advertencia", "general", _("Tipo de cambio inusual: %.5f MXN/USD. Verifique que sea correcto.") % tipo_cambio, seq=71)
+
+
+@register_check
+def _check_rectificacion(snap, add):
+    if not snap["es_rectificacion"]:
+        return
+    if not snap["rect_pedimento"]:
+        add("error", "rectificacion", _("Es rectificación pero falta el número de pedimento original."), seq=10)
+    if not snap["rect_fecha_pago"]:
+        add("error", "rectificacion", _("Es rectificación pero falta la fecha de pago del pedimento original."), seq=20)
+    if not snap["rect_aduana"]:
+        add("advertencia", "rectificacion", _("Es rectificación: se recomienda indicar la aduana del pedimento original."), seq=30)
+
+
+@register_check
+def _check_partidas(snap, add):
+    partidas = snap["partidas"]
+    if snap["cancel"]:
+        # Eliminación/desistimiento nunca tienen partidas — es lo correcto.
+        return
+    if not partidas:
+        add("error", "partidas", _("La operación no tiene partidas capturadas."), seq=10)
+    for p in partidas:
+        ref = p["ref"]
+        if not p["fraccion"]:
+            add("error", "partidas", _("Sin fracción arancelaria."), ref, seq=20)
+        if p["quantity"] <= 0:
+            add("error", "partidas", _("Cantidad debe ser mayor a cero."), ref, seq=30)
+        if p["value_usd"] <= 0:
+            add("error", "partidas", _("Valor USD debe ser mayor a cero."), ref, seq=40)
+        if not p["factura_id"]:
+            add("error", "partidas", _("Sin factura / CFDI asignado."), ref, seq=50)
+        if snap["tipo_operacion"] == "importacion" and not p["pais_origen"]:
+            add("advertencia", "partidas", _("Sin país de origen declarado."), ref, seq=60)
+        if len(p["descripcion"]) < 5:
+            add("advertencia", "partidas", _("Descripción de mercancía muy corta o vacía."), ref, seq=70)
+
+        # Regulaciones desde fracción (mx.tigie.maestra es modelo plano;
+        # no existen nom_default_ids/permiso_default_ids/rrna_default_ids).
+        # Si la fracción tiene texto de regulaciones, advertimos cuando la
+        # partida no tiene ningún NOM/permiso/RRNA capturado.
+        if p["regulaciones"] and not p["tiene_regulatorio"]:
+            add(
+                "advertencia", "regulatorio",
+                _("La fracción %s tiene regulaciones de economía en TIGIE. Verifique si aplican NOM/permisos/RRNA en la partida.")
+                % p["frac_code"],
+                ref, seq=10,
+            )
+
+
+@register_check
+def _check_documentos_505(snap, add):
+    partidas = snap["partidas"]
+    docs_505 = [
+        d for d in snap["documentos"]
+        if d["tipo"] in ("factura", "e_document") or d["registro_codigo"] == "505"
+    ]
+    if not docs_505 and partidas:
+        add("error", "documentos", _("No hay documentos tipo Factura / CFDI capturados (registro 505)."), seq=10)
+        return
+    usd_por_factura = {}
+    for p in partidas:
+        if p["factura_id"]:
+            usd_por_factura.setdefault(p["factura_id"], []).append(p["value_usd"])
+    for doc in docs_505:
+        linked = usd_por_factura.get(doc["id"])
+        if not linked:
+            add("advertencia", "documentos", _("Documento sin partidas asignadas — no se usará en el pedimento."), doc["ref"], seq=20)
+            continue
+        total_usd = sum(linked)
+        doc_usd = doc["cfdi_valor_usd"]
+        if doc_usd > 0 and abs(total_usd - doc_usd) > 0.01:
+            add(
+                "error", "documentos",
+                _("Valor USD de partidas (%.2f) no coincide con el 505 (%.2f).") % (total_usd, doc_usd),
+                doc["ref"], seq=30,
+            )
+        # No se compara valor_comercial vs cfdi_valor_moneda: están en monedas
+        # distintas (valor_comercial en moneda de la operación; el 505 puede ser USD).
+        # El chequeo de value_usd ya cubre la validación correctamente.
+
+
+@register_check
+def _check_contribuciones(snap, add):
+    if not snap["contribuciones"] and snap["partidas"]:
+        add("advertencia", "contribuciones", _("No se han generado contribuciones (557/510). Use 'Generar contribuciones 557' primero."), seq=10)
+        return
+    for line in snap["contribuciones"]:
+        if line["importe"] > 0 and not line["forma_pago_code"]:
+            add(
+                "error", "contribuciones",
+                _("Falta forma de pago en el registro 510 para la contribución: %s") % line["label"],
+                seq=20,
+            )
+
+    # Verificar 508 si hay formas de pago 4 o 15
+    declared_fp = snap["formas_pago"]
+    if ("4" in declared_fp or "15" in declared_fp) and not snap["tiene_cuentas"]:
+        add("error", "contribuciones", _("Formas de pago 4 o 15 declaradas pero no hay cuentas aduaneras (508)."), seq=30)
+    if "12" in declared_fp and not snap["tiene_compensacion"]:
+        add("error", "contribuciones", _("Forma de pago 12 (Compensación) declarada pero no hay líneas de compensación (513)."), seq=40)
+
+    # Verificar 514 para formas de pago virtuales
+    needed = declared_fp & _FP_VIRTUALES
+    fp_514 = {d["forma_pago_code"] for d in snap["documentos"] if d["registro_codigo"] == "514"}
+    has_514 = any(d["registro_codigo"] == "514" for d in snap["documentos"])
+    if needed and not has_514:
+        add(
+            "error", "contribuciones",
+            _("Formas de pago virtuales (%s) declaradas pero no hay documentos 514.") % ", ".join(sorted(needed)),
+            seq=50,
+        )
+        return
+    for code in sorted(needed - fp_514):
+        add("error", "contribuciones", _("Falta documento 514 para la forma de pago %s.") % code, seq=55)
+
+
+@register_check
+def _check_estructura(snap, add):
+    op = snap["op"]
+    if not snap["tiene_estructura"]:
+        add("error", "estructura", _("No hay estructura ni rulepack configurado — no se puede generar el archivo TXT."), seq=10)
+        return
+    if not snap["tiene_registros"]:
+        add("advertencia", "estructura", _("No hay registros técnicos generados. Use 'Preparar estructura' para generarlos."), seq=20)
+        return
+    if snap["cancel"]:
+        # Para eliminación/desistimiento solo se valida la estructura mínima 500/800/801.
+        # La validación completa de rulepack (que exige 502, partidas, etc.) no aplica.
+        try:
+            op._validate_cancel_desist_structure()
+        except (UserError, ValidationError) as exc:
+            for linea_msg in _exc_lines(exc):
+                add("error", "estructura", linea_msg, seq=30)
+        # Validar campos de registro 800/801 pero tratar acuse vacío como advertencia,
+        # ya que el SAAI lo asigna después de presentar el TXT.
+        msg = op._validacion_estructura_cacheada("_validate_field_rules_on_registros")
+        for linea_msg in (msg or "").split("\n"):
+            linea_msg = linea_msg.strip()
+            if not linea_msg:
+                continue
+            if "acuse" in linea_msg.lower():
+                add(
+                    "advertencia", "estructura",
+                    linea_msg + _(" — puede dejarse vacío ahora y llenarse después de que el SAAI valide el TXT."),
+                    seq=35,
+                )
+            else:
+                add("error", "estructura", linea_msg, seq=35)
+        return
+    # Validación real de estructura; el export reutiliza el mismo resultado
+    for method, seq in (("_validate_registros_vs_estructura", 30), ("_validate_field_rules_on_registros", 35)):
+        msg = op._validacion_estructura_cacheada(method)
+        for linea_msg in (msg or "").split("\n"):
+            if linea_msg.strip():
+                add("error", "estructura", linea_msg.strip(), seq=seq)
+
+
+@register_check
+def _check_consolidado(snap, add):
+    if not snap["es_consolidado"]:
+        return
+    # ── Pago del pedimento principal ────────────────────────────────────
+    if not snap["fecha_pago"]:
+        add(
+            "error", "general",
+            _("El pedimento consolidado no tiene fecha de pago registrada. "
+              "Las remesas solo pueden exportarse (TXT y AVC) una vez que "
+              "el pedimento principal esté pagado."),
+            seq=79,
+        )
+    # ── Remesas con COVE pero sin e-document ────────────────────────────
+    remesas = snap["remesas"]
+    for rem in remesas:
+        if rem["cove_sin_acuse"]:
+            add(
+                "advertencia", "general",
+                _("La remesa tiene COVE ligado pero aún no tiene e-document de VUCEM. "
+                  "Consulta el resultado del COVE antes de exportar."),
+                rem["ref"], seq=79,
+            )
+    if not remesas:
+        add("advertencia", "partidas", _("Es operación consolidada pero no tiene remesas capturadas."), seq=80)
+        return
+    for rem in remesas:
+        if rem["partida_count"] == 0:
+            add("advertencia", "partidas", _("Remesa sin partidas asignadas."), rem["ref"], seq=85)
+
+    # ── Cobertura de partidas en remesas ────────────────────────────────
+    # Cada partida debe estar asignada a por lo menos una remesa.
+    # La suma de cantidades y valores asignados no debe exceder el
+    # total de la partida (los constraints del modelo ya lo impiden,
+    # pero verificamos aqui para darlo como error de validacion).
+    for p in snap["partidas"]:
+        ref_p = p["ref"]
+        if not p["asignaciones"]:
+            add("error", "partidas", _("La partida no está asignada a ninguna remesa activa."), ref_p, seq=87)
+            continue
+        total_asignado_qty = sum(qty for qty, _usd in p["asignaciones"])
+        total_asignado_usd = sum(usd for _qty, usd in p["asignaciones"])
+        if p["quantity"] > 0 and abs(total_asignado_qty - p["quantity"]) > 0.001:
+            add(
+                "advertencia", "partidas",
+                _("Cantidad asignada a remesas (%.6f) difiere de la cantidad de la partida (%.6f).") % (
+                    total_asignado_qty, p["quantity"]
+                ),
+                ref_p, seq=88,
+            )
+        if p["value_usd"] > 0 and abs(total_asignado_usd - p["value_usd"]) > 0.01:
+            add(
+                "advertencia", "partidas",
+                _("Valor USD asignado a remesas (%.2f) difiere del valor de la partida (%.2f).") % (
+                    total_asignado_usd, p["value_usd"]
+                ),
+                ref_p, seq=89,
+            )
+
+    # ── Balance 557 por remesa vs 557 del pedimento ─────────────────────
+    # Solo aplica en modo por_remesa. Verifica que la suma de los importes
+    # de contribucion prorrateados en todas las remesas cuadra con el
+    # total de 557 del pedimento, tipo por tipo.
+    if "suma_557_real" not in snap:
+        return
+    suma_real = snap["suma_557_real"]
+    suma_prorrateada = snap["suma_557_prorrateada"]
+    # Tolerancia de 1 centavo por remesa
+    tolerancia = len(remesas) * 0.01
+    for tipo in sorted(set(suma_real) | set(suma_prorrateada)):
+        real = round(suma_real.get(tipo, 0.0), 2)
+        prorrateado = round(suma_prorrateada.get(tipo, 0.0), 2)
+        if abs(real - prorrateado) > tolerancia:
+            add(
+                "error", "contribuciones",
+                _(
+                    "Contribución %(tipo)s: la suma prorrateada en remesas (%(pro)s) "
+                    "no cuadra con el total 557 del pedimento (%(real)s). "
+                    "Posible edición manual de importes."
+                ) % {
+                    "tipo": tipo,
+                    "pro": "%.2f" % prorrateado,
+                    "real": "%.2f" % real,
+                },
+                seq=60,
+            )
+
 
 class MxPedValidacionLinea(models.TransientModel):
     _name = "mx.ped.validacion.linea"
@@ -79,349 +557,10 @@ class MxPedValidacionWizard(models.TransientModel):
             raise UserError(_("No se puede generar proforma: existen %d error(es) pendientes de corregir.") % self.total_errores)
         return self.operacion_id.action_export_proforma()
 
-    # ------------------------------------------------------------------
-    # Lógica central de validación
-    # ------------------------------------------------------------------
-
-    def _add(self, lineas, severidad, categoria, mensaje, referencia=None, seq=10):
-        lineas.append({
-            "severidad": severidad,
-            "categoria": categoria,
-            "mensaje": mensaje,
-            "referencia": referencia or "",
-            "sequence": seq,
-        })
-
     def _run_validacion(self):
         """Ejecuta todas las validaciones y devuelve lista de dicts."""
         self.ensure_one()
-        op = self.operacion_id
-        lineas = []
-        e = lambda msg, ref=None, cat="general", seq=10: self._add(lineas, "error", cat, msg, ref, seq)
-        w = lambda msg, ref=None, cat="general", seq=10: self._add(lineas, "advertencia", cat, msg, ref, seq)
-        i = lambda msg, ref=None, cat="general", seq=10: self._add(lineas, "info", cat, msg, ref, seq)
-
-        # Determina si es un pedimento de cancelación (eliminación o desistimiento).
-        # Para estos tipos la estructura válida es 500/800/801 sin partidas.
-        is_cancel_desist = op._get_tipo_movimiento_effective() in {"2", "3"}
-
-        # ── 1. DATOS GENERALES ──────────────────────────────────────────
-        if not op.layout_id:
-            e(_("Falta seleccionar el Layout técnico."), cat="general", seq=10)
-        if not op.clave_pedimento_id:
-            e(_("Falta la Clave de Pedimento (ej. A1, V1)."), cat="general", seq=20)
-        if not op.aduana_seccion_despacho_id:
-            e(_("Falta la Aduana / Sección de despacho."), cat="general", seq=30)
-        if not op.agente_aduanal_id:
-            e(_("Falta el Agente Aduanal."), cat="general", seq=40)
-        if not op.fecha_operacion:
-            e(_("Falta la Fecha de operación."), cat="general", seq=50)
-        if not op.incoterm and op.tipo_operacion == "importacion" and not is_cancel_desist:
-            # Para eliminación/desistimiento no aplica incoterm: la mercancía
-            # no llegó a entrar o salir del país.
-            w(_("No se indicó el Incoterm. Recomendado para importaciones."), cat="general", seq=60)
-
-        tipo_cambio = op.lead_id.x_tipo_cambio if op.lead_id else 0.0
-        if not tipo_cambio or tipo_cambio <= 0:
-            e(_("El Tipo de cambio en el Lead es 0 o no está definido. Los valores en MXN serán incorrectos."), cat="general", seq=70)
-        elif tipo_cambio < 10 or tipo_cambio > 30:
-            w(_("Tipo de cambio inusual: %.5f MXN/USD. Verifique que sea correcto.") % tipo_cambio, cat="general", seq=71)
-
-        if op.es_rectificacion:
-            if not (op.rect_pedimento_original or "").strip():
-                e(_("Es rectificación pero falta el número de pedimento original."), cat="rectificacion", seq=10)
-            if not op.rect_fecha_pago_original:
-                e(_("Es rectificación pero falta la fecha de pago del pedimento original."), cat="rectificacion", seq=20)
-            if not op.rect_aduana_original_id:
-                w(_("Es rectificación: se recomienda indicar la aduana del pedimento original."), cat="rectificacion", seq=30)
-
-        # ── 2. PARTIDAS ─────────────────────────────────────────────────
-        partidas = op.partida_ids
-        if not partidas and not is_cancel_desist:
-            # Eliminación/desistimiento nunca tienen partidas — es lo correcto.
-            e(_("La operación no tiene partidas capturadas."), cat="partidas", seq=10)
-        if partidas and not is_cancel_desist:
-            for p in partidas:
-                ref = _("Partida %s") % (p.numero_partida or p.id)
-                if not p.fraccion_id:
-                    e(_("Sin fracción arancelaria."), ref=ref, cat="partidas", seq=20)
-                if not p.quantity or p.quantity <= 0:
-                    e(_("Cantidad debe ser mayor a cero."), ref=ref, cat="partidas", seq=30)
-                if not p.value_usd or p.value_usd <= 0:
-                    e(_("Valor USD debe ser mayor a cero."), ref=ref, cat="partidas", seq=40)
-                if not p.factura_documento_id:
-                    e(_("Sin factura / CFDI asignado."), ref=ref, cat="partidas", seq=50)
-                if op.tipo_operacion == "importacion" and not p.pais_origen_id:
-                    w(_("Sin país de origen declarado."), ref=ref, cat="partidas", seq=60)
-                if not p.descripcion or len((p.descripcion or "").strip()) < 5:
-                    w(_("Descripción de mercancía muy corta o vacía."), ref=ref, cat="partidas", seq=70)
-
-                # Regulaciones desde fracción (mx.tigie.maestra es modelo plano;
-                # no existen nom_default_ids/permiso_default_ids/rrna_default_ids).
-                # Si la fracción tiene texto de regulaciones, advertimos cuando la
-                # partida no tiene ningún NOM/permiso/RRNA capturado.
-                if p.fraccion_id:
-                    frac = p.fraccion_id
-                    frac_code = frac.fraccion_8 or frac.llave_10 or ""
-                    if (frac.regulaciones_economia or "").strip() and not p.nom_ids and not p.permiso_ids and not p.rrna_ids:
-                        w(
-                            _("La fracción %s tiene regulaciones de economía en TIGIE. Verifique si aplican NOM/permisos/RRNA en la partida.")
-                            % frac_code,
-                            ref=ref, cat="regulatorio", seq=10,
-                        )
-
-        # ── 3. DOCUMENTOS 505 ───────────────────────────────────────────
-        docs_505 = op.documento_ids.filtered(
-            lambda d: (d.tipo or "") in ("factura", "e_document") or (d.registro_codigo or "").strip() == "505"
-        )
-        if not docs_505 and partidas:
-            e(_("No hay documentos tipo Factura / CFDI capturados (registro 505)."), cat="documentos", seq=10)
-        else:
-            for doc in docs_505:
-                ref_doc = _("Doc. %s") % (doc.folio or doc.id)
-                linked = partidas.filtered(lambda p: p.factura_documento_id == doc)
-                if not linked:
-                    w(_("Documento sin partidas asignadas — no se usará en el pedimento."), ref=ref_doc, cat="documentos", seq=20)
-                    continue
-                total_usd = sum(linked.mapped("value_usd"))
-                doc_usd = doc.cfdi_valor_usd or 0.0
-                if doc_usd > 0 and abs(total_usd - doc_usd) > 0.01:
-                    e(
-                        _("Valor USD de partidas (%.2f) no coincide con el 505 (%.2f).") % (total_usd, doc_usd),
-                        ref=ref_doc, cat="documentos", seq=30,
-                    )
-                # No se compara valor_comercial vs cfdi_valor_moneda: están en monedas
-                # distintas (valor_comercial en moneda de la operación; el 505 puede ser USD).
-                # El chequeo de value_usd ya cubre la validación correctamente.
-
-        # ── 4. CONTRIBUCIONES ────────────────────────────────────────────
-        contribuciones = op.contribucion_global_ids
-        if not contribuciones and partidas:
-            w(_("No se han generado contribuciones (557/510). Use 'Generar contribuciones 557' primero."), cat="contribuciones", seq=10)
-        else:
-            sin_forma_pago = contribuciones.filtered(
-                lambda l: (l.importe or 0.0) > 0 and not ((l.forma_pago_code or "").strip())
-            )
-            for line in sin_forma_pago:
-                label = (
-                    (line.contribucion_id.abbreviation or "").strip()
-                    or (line.tipo_contribucion or "").strip()
-                    or str(line.id)
-                )
-                e(
-                    _("Falta forma de pago en el registro 510 para la contribución: %s") % label,
-                    cat="contribuciones", seq=20,
-                )
-
-            # Verificar 508 si hay formas de pago 4 o 15
-            declared_fp = op._get_declared_formas_pago_codes() if hasattr(op, "_get_declared_formas_pago_codes") else set()
-            if ("4" in declared_fp or "15" in declared_fp) and not op.cuenta_aduanera_ids:
-                e(
-                    _("Formas de pago 4 o 15 declaradas pero no hay cuentas aduaneras (508)."),
-                    cat="contribuciones", seq=30,
-                )
-            if "12" in declared_fp and not op.compensacion_line_ids:
-                e(
-                    _("Forma de pago 12 (Compensación) declarada pero no hay líneas de compensación (513)."),
-                    cat="contribuciones", seq=40,
-                )
-
-            # Verificar 514 para formas de pago virtuales
-            required_fp_virtual = {"2", "4", "7", "12", "15", "19", "22"}
-            needed = declared_fp & required_fp_virtual
-            docs_514 = op.documento_ids.filtered(lambda d: (d.registro_codigo or "").strip() == "514")
-            if needed and not docs_514:
-                e(
-                    _("Formas de pago virtuales (%s) declaradas pero no hay documentos 514.") % ", ".join(sorted(needed)),
-                    cat="contribuciones", seq=50,
-                )
-            else:
-                for code in sorted(needed):
-                    if not docs_514.filtered(lambda d: (d.forma_pago_code or "").strip() == code):
-                        e(
-                            _("Falta documento 514 para la forma de pago %s.") % code,
-                            cat="contribuciones", seq=55,
-                        )
-
-        # ── 5. ESTRUCTURA DE REGISTROS ───────────────────────────────────
-        if not op.estructura_regla_id and not op.rulepack_id:
-            e(_("No hay estructura ni rulepack configurado — no se puede generar el archivo TXT."), cat="estructura", seq=10)
-        elif not op.registro_ids:
-            w(_("No hay registros técnicos generados. Use 'Preparar estructura' para generarlos."), cat="estructura", seq=20)
-        elif is_cancel_desist:
-            # Para eliminación/desistimiento solo se valida la estructura mínima 500/800/801.
-            # La validación completa de rulepack (que exige 502, partidas, etc.) no aplica.
-            try:
-                op._validate_cancel_desist_structure()
-            except (UserError, ValidationError) as exc:
-                for linea_msg in str(exc.args[0]).split("\n"):
-                    linea_msg = linea_msg.strip()
-                    if linea_msg:
-                        e(linea_msg, cat="estructura", seq=30)
-            # Validar campos de registro 800/801 pero tratar acuse vacío como advertencia,
-            # ya que el SAAI lo asigna después de presentar el TXT.
-            try:
-                op._validate_field_rules_on_registros()
-            except (UserError, ValidationError) as exc:
-                for linea_msg in str(exc.args[0]).split("\n"):
-                    linea_msg = linea_msg.strip()
-                    if not linea_msg:
-                        continue
-                    if "acuse" in linea_msg.lower():
-                        w(
-                            linea_msg + _(" — puede dejarse vacío ahora y llenarse después de que el SAAI valide el TXT."),
-                            cat="estructura", seq=35,
-                        )
-                    else:
-                        e(linea_msg, cat="estructura", seq=35)
-        else:
-            # Intentar la validación real de estructura y capturar sus errores
-            try:
-                op._validate_registros_vs_estructura()
-            except (UserError, ValidationError) as exc:
-                for linea_msg in str(exc.args[0]).split("\n"):
-                    linea_msg = linea_msg.strip()
-                    if linea_msg:
-                        e(linea_msg, cat="estructura", seq=30)
-            try:
-                op._validate_field_rules_on_registros()
-            except (UserError, ValidationError) as exc:
-                for linea_msg in str(exc.args[0]).split("\n"):
-                    linea_msg = linea_msg.strip()
-                    if linea_msg:
-                        e(linea_msg, cat="estructura", seq=35)
-
-        # ── 6. CONSOLIDADO ───────────────────────────────────────────────
-        if op.es_consolidado:
-            # ── 6.0 Pago del pedimento principal ────────────────────────
-            if not op.fecha_pago:
-                e(
-                    _("El pedimento consolidado no tiene fecha de pago registrada. "
-                      "Las remesas solo pueden exportarse (TXT y AVC) una vez que "
-                      "el pedimento principal esté pagado."),
-                    cat="general", seq=79,
-                )
-            # ── 6.1 Remesas con COVE pero sin e-document ─────────────────
-            remesas = op.remesa_ids.filtered("active") if op.remesa_ids else op.env["mx.ped.consolidado.remesa"]
-            for rem in remesas.filtered(lambda r: r.cove_id and not r.acuse_valor):
-                w(
-                    _("La remesa tiene COVE ligado pero aún no tiene e-document de VUCEM. "
-                      "Consulta el resultado del COVE antes de exportar."),
-                    ref=_("Remesa %s") % (rem.folio or rem.id),
-                    cat="general", seq=79,
-                )
-            if not remesas:
-                w(_("Es operación consolidada pero no tiene remesas capturadas."), cat="partidas", seq=80)
-            else:
-                remesas_sin_partidas = remesas.filtered(lambda r: r.partida_count == 0)
-                for r in remesas_sin_partidas:
-                    w(
-                        _("Remesa sin partidas asignadas."),
-                        ref=_("Remesa %s") % (r.folio or r.id),
-                        cat="partidas", seq=85,
-                    )
-
-                # ── 6a. Cobertura de partidas en remesas ─────────────────
-                # Cada partida debe estar asignada a por lo menos una remesa.
-                # La suma de cantidades y valores asignados no debe exceder el
-                # total de la partida (los constraints del modelo ya lo impiden,
-                # pero verificamos aqui para darlo como error de validacion).
-                for partida in op.partida_ids:
-                    ref_p = _("Partida %s") % (partida.numero_partida or partida.id)
-                    asignaciones = partida.remesa_assignment_ids.filtered(
-                        lambda a: a.remesa_id.active
-                    )
-                    if not asignaciones:
-                        e(
-                            _("La partida no está asignada a ninguna remesa activa."),
-                            ref=ref_p, cat="partidas", seq=87,
-                        )
-                        continue
-
-                    total_asignado_qty = sum(a.quantity or 0.0 for a in asignaciones)
-                    total_asignado_usd = sum(a.value_usd or 0.0 for a in asignaciones)
-                    partida_qty = partida.quantity or 0.0
-                    partida_usd = partida.value_usd or 0.0
-
-                    if partida_qty > 0 and abs(total_asignado_qty - partida_qty) > 0.001:
-                        w(
-                            _("Cantidad asignada a remesas (%.6f) difiere de la cantidad de la partida (%.6f).") % (
-                                total_asignado_qty, partida_qty
-                            ),
-                            ref=ref_p, cat="partidas", seq=88,
-                        )
-                    if partida_usd > 0 and abs(total_asignado_usd - partida_usd) > 0.01:
-                        w(
-                            _("Valor USD asignado a remesas (%.2f) difiere del valor de la partida (%.2f).") % (
-                                total_asignado_usd, partida_usd
-                            ),
-                            ref=ref_p, cat="partidas", seq=89,
-                        )
-
-                # ── 6b. Balance 557 por remesa vs 510 del pedimento ──────
-                # Solo aplica en modo por_remesa. Verifica que la suma de los
-                # importes de contribucion prorrateados en todas las remesas
-                # cuadra con el total de 557 del pedimento, tipo por tipo.
-                # Una diferencia indica edicion manual de montos.
-                if op.modo_export_consolidado == "por_remesa":
-                    # Acumular importes prorrateados por tipo de contribucion
-                    suma_prorrateada: dict = {}   # key: tipo_str -> float
-                    for remesa in remesas:
-                        for rel in remesa.partida_rel_ids:
-                            partida = rel.partida_id
-                            if not partida:
-                                continue
-                            pv = partida.value_usd or 0.0
-                            qv = partida.quantity or 0.0
-                            rv = rel.value_usd or 0.0
-                            rq = rel.quantity or 0.0
-                            ratio = (rv / pv) if pv > 0 else ((rq / qv) if qv > 0 else 1.0)
-                            for contrib in partida.contribucion_ids.filtered(
-                                lambda c: c.operacion_id == op
-                            ):
-                                key = (
-                                    (contrib.tipo_contribucion or "").strip()
-                                    or str(contrib.contribucion_code or contrib.id)
-                                )
-                                suma_prorrateada[key] = (
-                                    suma_prorrateada.get(key, 0.0)
-                                    + round((contrib.importe or 0.0) * ratio, 2)
-                                )
-
-                    # Total real de 557 por tipo de contribucion
-                    suma_real: dict = {}
-                    for contrib in op.partida_contribucion_ids:
-                        key = (
-                            (contrib.tipo_contribucion or "").strip()
-                            or str(contrib.contribucion_code or contrib.id)
-                        )
-                        suma_real[key] = suma_real.get(key, 0.0) + (contrib.importe or 0.0)
-
-                    # Comparar tipo por tipo con tolerancia de 1 centavo por remesa
-                    tolerancia = len(remesas) * 0.01
-                    todos_los_tipos = set(suma_real) | set(suma_prorrateada)
-                    for tipo in sorted(todos_los_tipos):
-                        real = round(suma_real.get(tipo, 0.0), 2)
-                        prorrateado = round(suma_prorrateada.get(tipo, 0.0), 2)
-                        if abs(real - prorrateado) > tolerancia:
-                            e(
-                                _(
-                                    "Contribución %(tipo)s: la suma prorrateada en remesas (%(pro)s) "
-                                    "no cuadra con el total 557 del pedimento (%(real)s). "
-                                    "Posible edición manual de importes."
-                                ) % {
-                                    "tipo": tipo,
-                                    "pro": "%.2f" % prorrateado,
-                                    "real": "%.2f" % real,
-                                },
-                                cat="contribuciones", seq=60,
-                            )
-
-        # Si no hay ningún problema, agregar línea de confirmación
-        if not lineas:
-            i(_("Validación completada sin problemas. La operación está lista para exportar."), cat="general", seq=1)
-
-        return lineas
+        return self.operacion_id._get_validacion_resultado()
 
     @api.model
     def ejecutar_para_operacion(self, operacion):
@@ -5,8 +5,90 @@ Log de transmisiones VUCEM.
 Registra cada intento de comunicación con el webservice de VUCEM:
 XML enviado, respuesta recibida, errores, tiempos y credencial usada.
 Sirve como trazabilidad y para diagnóstico de errores.
+
+Almacenamiento:
+  Los payloads (cadena original, XML enviado, respuesta) se guardan en una
+  sola columna comprimida `payload_gz` (zstd si está disponible, si no gzip),
+  truncando cada texto a `mx_ped.vucem_log.max_payload_kb` KB.  Los campos
+  de texto del formulario se descomprimen al leerse.
+  Buscar en esos textos solo recorre los logs del COVE/MV del contexto o,
+  sin él, los de los últimos `mx_ped.vucem_log.search_days` días (default 30),
+  y como máximo `mx_ped.vucem_log.search_max_rows` filas (default 20000).
+  El cron de archivo mueve los logs con más de
+  `mx_ped.vucem_log.retention_days` días (0 = nunca) a adjuntos mensuales
+  `.jsonl.gz` y los elimina de la tabla.
 """
-from odoo import fields, models
+import base64
+import gzip
+import json
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from odoo import api, fields, models
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+# ── Compresión opcional zstd ─────────────────────────────────────────────────
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+_PAYLOAD_FIELDS = ("cadena_original", "xml_enviado", "xml_recibido")
+_CODEC_ZSTD = b"Z"
+_CODEC_GZIP = b"G"
+_MAX_PAYLOAD_KB_DEFAULT = 512
+_RETENTION_DAYS_DEFAULT = 180
+_ARCHIVE_BATCH = 5000
+_SEARCH_DAYS_DEFAULT = 30
+_SEARCH_MAX_ROWS_DEFAULT = 20000
+
+
+def _pack_payload(payload):
+    """dict → bytes comprimidos con prefijo de codec.
+
+    Se guardan tal cual en la columna bytea (sin Base64) para no inflar
+    el tamaño un tercio.
+    """
+    raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if _zstd is not None:
+        return _CODEC_ZSTD + _zstd.ZstdCompressor(level=9).compress(raw)
+    return _CODEC_GZIP + gzip.compress(raw, compresslevel=9)
+
+
+def _unpack_payload(value):
+    """Inverso de _pack_payload. Tolera valores vacíos, corruptos o en Base64
+    (formato anterior a 18.0.1.12.0)."""
+    if not value:
+        return {}
+    try:
+        blob = value.encode() if isinstance(value, str) else bytes(value)
+        if blob[:1] not in (_CODEC_ZSTD, _CODEC_GZIP):
+            blob = base64.b64decode(blob)
+        codec, body = blob[:1], blob[1:]
+        if codec == _CODEC_ZSTD:
+            if _zstd is None:
+                return {"xml_recibido": "(payload comprimido con zstd; instala 'zstandard')"}
+            raw = _zstd.ZstdDecompressor().decompress(body)
+        else:
+            raw = gzip.decompress(body)
+        return json.loads(raw.decode("utf-8"))
+    except Exception:
+        _logger.exception("Payload de mx.vucem.log ilegible")
+        return {}
+
+
+def _cap_text(value, max_bytes):
+    if not value:
+        return None
+    text = str(value)
+    data = text.encode("utf-8")
+    if max_bytes <= 0 or len(data) <= max_bytes:
+        return text
+    cut = data[:max_bytes].decode("utf-8", errors="ignore")
+    return f"{cut}\n…[truncado: {len(data) - max_bytes} bytes omitidos]"
 
 
 class MxVucemLog(models.Model):
@@ -49,17 +131,32 @@ class MxVucemLog(models.Model):
         required=True,
     )
 
-    # ── Payload ───────────────────────────────────────────────────────────────
+    # ── Payload (comprimido) ──────────────────────────────────────────────────
+    payload_gz = fields.Binary(
+        string="Payload comprimido",
+        attachment=False,
+        help="Cadena original, XML enviado y respuesta, comprimidos.",
+    )
+    payload_size = fields.Integer(
+        string="Tamaño payload (bytes)",
+        help="Tamaño sin comprimir de los textos guardados.",
+    )
     cadena_original = fields.Text(
         string="Cadena original",
+        compute="_compute_payload",
+        search="_search_cadena_original",
         help="Cadena pipe-separated enviada para firma.",
     )
     xml_enviado = fields.Text(
         string="XML enviado",
+        compute="_compute_payload",
+        search="_search_xml_enviado",
         help="XML / payload SOAP completo enviado a VUCEM.",
     )
     xml_recibido = fields.Text(
         string="XML / respuesta recibida",
+        compute="_compute_payload",
+        search="_search_xml_recibido",
         help="Respuesta SOAP cruda devuelta por VUCEM.",
     )
 
@@ -111,6 +208,227 @@ class MxVucemLog(models.Model):
         store=False,
     )
 
+    def init(self):
+        """Índices parciales para el patrón de acceso "logs recientes de un
+        COVE/MV"."""
+        cr = self.env.cr
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS mx_vucem_log_cove_recent_idx
+                ON mx_vucem_log (cove_id, timestamp DESC)
+             WHERE cove_id IS NOT NULL
+        """)
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS mx_vucem_log_mv_recent_idx
+                ON mx_vucem_log (mv_id, timestamp DESC)
+             WHERE mv_id IS NOT NULL
+        """)
+
+    def _migrate_legacy_payload_columns(self):
+        """Pasa las antiguas columnas de texto a payload_gz y las elimina.
+
+        Solo la llama la migración 18.0.1.12.0 (post-migrate).
+        """
+        cr = self.env.cr
+        cr.execute("""
+            SELECT column_name FROM information_schema.columns
+             WHERE table_name = 'mx_vucem_log' AND column_name = ANY(%s)
+        """, (list(_PAYLOAD_FIELDS),))
+        legacy = [row[0] for row in cr.fetchall()]
+        if not legacy:
+            return
+        select_cols = ", ".join(f'"{col}"' for col in legacy)
+        total = 0
+        while True:
+            cr.execute(f"""
+                SELECT id, {select_cols} FROM mx_vucem_log
+                 WHERE payload_gz IS NULL
+                   AND ({" OR ".join(f'"{col}" IS NOT NULL' for col in legacy)})
+                 LIMIT 1000
+            """)
+            rows = cr.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                payload = {col: val for col, val in zip(legacy, row[1:]) if val}
+                cr.execute(
+                    "UPDATE mx_vucem_log SET payload_gz = %s, payload_size = %s WHERE id = %s",
+                    (_pack_payload(payload), sum(len(v.encode("utf-8")) for v in payload.values()), row[0]),
+                )
+            total += len(rows)
+        for col in legacy:
+            cr.execute(f'ALTER TABLE mx_vucem_log DROP COLUMN "{col}"')
+        _logger.info("mx.vucem.log: %d payloads migrados a payload_gz; columnas %s eliminadas.", total, legacy)
+
+    # ── Compresión de payloads ────────────────────────────────────────────────
+
+    @api.model
+    def _log_param(self, key, default):
+        raw = self.env["ir.config_parameter"].sudo().get_param(f"mx_ped.vucem_log.{key}")
+        try:
+            return int(raw) if raw not in (None, False, "") else default
+        except (TypeError, ValueError):
+            return default
+
+    @api.model
+    def _pack_vals(self, vals, max_bytes):
+        if not any(key in vals for key in _PAYLOAD_FIELDS):
+            return vals
+        vals = dict(vals)
+        payload = {}
+        for key in _PAYLOAD_FIELDS:
+            text = _cap_text(vals.pop(key, None), max_bytes)
+            if text:
+                payload[key] = text
+        vals["payload_gz"] = _pack_payload(payload) if payload else False
+        vals["payload_size"] = sum(len(v.encode("utf-8")) for v in payload.values())
+        return vals
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        max_bytes = self._log_param("max_payload_kb", _MAX_PAYLOAD_KB_DEFAULT) * 1024
+        return super().create([self._pack_vals(vals, max_bytes) for vals in vals_list])
+
+    @api.depends("payload_gz")
+    def _compute_payload(self):
+        for rec in self:
+            payload = _unpack_payload(rec.payload_gz)
+            for key in _PAYLOAD_FIELDS:
+                rec[key] = payload.get(key) or False
+
+    def _search_cadena_original(self, operator, value):
+        return self._search_payload("cadena_original", operator, value)
+
+    def _search_xml_enviado(self, operator, value):
+        return self._search_payload("xml_enviado", operator, value)
+
+    def _search_xml_recibido(self, operator, value):
+        return self._search_payload("xml_recibido", operator, value)
+
+    @api.model
+    def _search_payload(self, key, operator, value):
+        """Dominio por id para buscar en un texto del payload comprimido.
+
+        El texto no existe en SQL: hay que descomprimir cada payload, así que
+        solo se recorren los logs del COVE/MV del contexto (``default_cove_id``
+        / ``default_mv_id``, los que ponen los botones "Logs VUCEM") o los de
+        los últimos ``search_days`` días.  Si aun así hay más de
+        ``search_max_rows`` candidatos se pide acotar la búsqueda.  Los
+        operadores negativos también se limitan a ese alcance.
+        """
+        if value in (None, False) and operator in ("=", "!="):
+            # "está / no está establecido"
+            operator, value = ("not like" if operator == "=" else "like"), ""
+        matchers = {
+            "like": lambda text: value in text,
+            "ilike": lambda text: value.lower() in text.lower(),
+            "=": lambda text: text == value,
+        }
+        negative = operator in ("not like", "not ilike", "!=")
+        match = matchers.get(operator.replace("not ", "") if operator != "!=" else "=")
+        if match is None or not isinstance(value, str):
+            raise UserError(f"Operador no soportado para buscar en {key}: {operator!r}")
+        where, params = self._search_payload_scope()
+        self.flush_model(["payload_gz", "cove_id", "mv_id", "timestamp"])
+        cr = self.env.cr
+        max_rows = self._log_param("search_max_rows", _SEARCH_MAX_ROWS_DEFAULT)
+        cr.execute(f"SELECT count(*) FROM mx_vucem_log WHERE {where}", params)
+        if max_rows > 0 and cr.fetchone()[0] > max_rows:
+            raise UserError(
+                "La búsqueda en los XML del log abarca demasiados registros. "
+                "Ábrela desde el COVE o la MV, o reduce "
+                "mx_ped.vucem_log.search_days."
+            )
+        matched, unmatched = [], []
+        last_id = 0
+        while True:
+            cr.execute(f"""
+                SELECT id, payload_gz FROM mx_vucem_log
+                 WHERE id > %s AND {where}
+                 ORDER BY id LIMIT %s
+            """, [last_id, *params, _ARCHIVE_BATCH])
+            rows = cr.fetchall()
+            if not rows:
+                break
+            for log_id, blob in rows:
+                text = _unpack_payload(blob).get(key)
+                (matched if text and match(text) else unmatched).append(log_id)
+            last_id = rows[-1][0]
+        return [("id", "in", unmatched if negative else matched)]
+
+    @api.model
+    def _search_payload_scope(self):
+        """Cláusula WHERE (y parámetros) con los logs que se pueden descomprimir."""
+        where = "payload_gz IS NOT NULL"
+        cove_id = self.env.context.get("default_cove_id")
+        mv_id = self.env.context.get("default_mv_id")
+        if cove_id:
+            return f"{where} AND cove_id = %s", [cove_id]
+        if mv_id:
+            return f"{where} AND mv_id = %s", [mv_id]
+        days = self._log_param("search_days", _SEARCH_DAYS_DEFAULT)
+        if days <= 0:
+            return where, []
+        desde = fields.Datetime.now() - timedelta(days=days)
+        return f"{where} AND timestamp >= %s", [desde]
+
+    # ── Retención / archivo ───────────────────────────────────────────────────
+
+    @api.model
+    def cron_archivar_logs(self):
+        """Mueve logs viejos a adjuntos mensuales .jsonl.gz y los elimina."""
+        days = self._log_param("retention_days", _RETENTION_DAYS_DEFAULT)
+        if days <= 0:
+            return True
+        cutoff = fields.Datetime.now() - timedelta(days=days)
+        Attachment = self.env["ir.attachment"].sudo()
+        while True:
+            logs = self.sudo().search(
+                [("timestamp", "<", cutoff)],
+                order="timestamp asc, id asc",
+                limit=_ARCHIVE_BATCH,
+            )
+            if not logs:
+                break
+            by_month = defaultdict(list)
+            for log in logs:
+                by_month[log.timestamp.strftime("%Y-%m")].append(log._archive_line())
+            for month, lines in by_month.items():
+                part = Attachment.search_count([
+                    ("res_model", "=", self._name),
+                    ("name", "=like", f"vucem_log_{month}_%"),
+                ]) + 1
+                data = gzip.compress(("\n".join(lines) + "\n").encode("utf-8"), compresslevel=9)
+                Attachment.create({
+                    "name": f"vucem_log_{month}_{part:03d}.jsonl.gz",
+                    "res_model": self._name,
+                    "res_id": 0,
+                    "mimetype": "application/gzip",
+                    "raw": data,
+                })
+            _logger.info("mx.vucem.log: %d logs archivados (corte %s).", len(logs), cutoff)
+            logs.unlink()
+        return True
+
+    def _archive_line(self):
+        self.ensure_one()
+        data = {
+            "id": self.id,
+            "timestamp": fields.Datetime.to_string(self.timestamp),
+            "cove_id": self.cove_id.id or None,
+            "mv_id": self.mv_id.id or None,
+            "credencial_id": self.credencial_id.id or None,
+            "tipo_operacion": self.tipo_operacion,
+            "ambiente": self.ambiente,
+            "estatus": self.estatus,
+            "numero_operacion": self.numero_operacion or None,
+            "e_document": self.e_document or None,
+            "error_code": self.error_code or None,
+            "error_descripcion": self.error_descripcion or None,
+            "duracion_ms": self.duracion_ms,
+        }
+        data.update(_unpack_payload(self.payload_gz))
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
     def _compute_display_name_computed(self):
         for rec in self:
             tipo = dict(self._fields["tipo_operacion"].selection).get(
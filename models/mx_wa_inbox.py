@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Bandeja de entrada de mensajes de WhatsApp (procesamiento asíncrono).
+
+El webhook (`/whatsapp/webhook`) solo guarda el mensaje crudo aquí y responde
+200 de inmediato; Meta reintenta los webhooks lentos y antes eso provocaba
+procesar dos veces el mismo mensaje.  La llave única `message_id` hace que un
+reintento de Meta sea un no-op.
+
+El cron `cron_procesar_wa_inbox` procesa la bandeja en orden de llegada:
+  pending → done
+          ↘ (error) pending con reintento diferido … → failed
+
+Las llamadas a la Graph API usan una sesión HTTP por worker (pool de
+conexiones keep-alive y reintentos de urllib3 en errores 5xx/429 para GET).
+
+Parámetros (ir.config_parameter):
+  mx_ped.wa_inbox.batch_size    mensajes por corrida (default 50)
+  mx_ped.wa_inbox.max_attempts  intentos antes de marcar fallido (default 5)
+  mx_ped.wa_inbox.max_media_mb  tamaño máximo de un archivo recibido (default 10)
+"""
+import hashlib
+import json
+import logging
+import threading
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+GRAPH_URL = "https://graph.facebook.com/v21.0"
+
+_HTTP_LOCAL = threading.local()
+_CHUNK_SIZE = 64 * 1024
+
+
+class MediaTooLarge(ValueError):
+    """El archivo recibido excede mx_ped.wa_inbox.max_media_mb."""
+
+
+def _wa_http():
+    """Sesión requests por hilo con pool de conexiones y reintentos."""
+    session = getattr(_HTTP_LOCAL, "session", None)
+    if session is None:
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # POST no se reintenta: duplicaría la respuesta al remitente
+            allowed_methods=frozenset({"GET"}),
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        _HTTP_LOCAL.session = session
+    return session
+
+
+class MxWaInbox(models.Model):
+    _name = "mx.wa.inbox"
+    _description = "Bandeja de mensajes entrantes de WhatsApp"
+    _order = "id"
+    _rec_name = "message_id"
+
+    message_id = fields.Char(string="ID de mensaje", required=True, readonly=True)
+    wa_id = fields.Char(string="WhatsApp ID", required=True, index=True, readonly=True)
+    msg_type = fields.Char(string="Tipo", readonly=True)
+    payload = fields.Text(string="Mensaje (JSON)", readonly=True)
+    state = fields.Selection(
+        [
+            ("pending", "Pendiente"),
+            ("done", "Procesado"),
+            ("failed", "Fallido"),
+        ],
+        string="Estado",
+        default="pending",
+        required=True,
+        index=True,
+    )
+    attempts = fields.Integer(string="Intentos", default=0)
+    next_attempt_at = fields.Datetime(string="Próximo intento", index=True)
+    processed_at = fields.Datetime(string="Procesado el", readonly=True)
+    last_error = fields.Text(string="Último error", readonly=True)
+
+    _sql_constraints = [
+        ("mx_wa_inbox_message_id_uniq", "unique(message_id)", "El mensaje ya fue recibido."),
+    ]
+
+    # ── Parámetros ────────────────────────────────────────────────────────────
+
+    @api.model
+    def _param(self, key):
+        return self.env["ir.config_parameter"].sudo().get_param(key)
+
+    @api.model
+    def _inbox_param(self, key, default):
+        raw = self._param(f"mx_ped.wa_inbox.{key}")
+        try:
+            return int(raw) if raw not in (None, False, "") else default
+        except (TypeError, ValueError):
+            _logger.warning("Parámetro mx_ped.wa_inbox.%s inválido (%r), usando %s", key, raw, default)
+            return default
+
+    # ── Alta desde el webhook ─────────────────────────────────────────────────
+
+    @api.model
+    def _encolar_payload(self, payload):
+        """Guarda los mensajes de un webhook de Meta. Ignora los ya recibidos.
+
+        Returns:
+            int: mensajes nuevos encolados.
+        """
+        messages = []
+        for entry in payload.get("entry", []) or []:
+            for change in entry.get("changes", []) or []:
+                value = change.get("value", {}) or {}
+                for msg in value.get("messages", []) or []:
+                    if msg.get("from") and msg.get("id"):
+                        messages.append(msg)
+        if not messages:
+            return 0
+
+        # ON CONFLICT: dos reintentos simultáneos de Meta no chocan en la llave única
+        now = fields.Datetime.now()
+        uid = self.env.uid
+        inserted = 0
+        for msg in messages:
+            self.env.cr.execute(
+                """
+                INSERT INTO mx_wa_inbox
+                    (message_id, wa_id, msg_type, payload, state, attempts,
+                     create_uid, create_date, write_uid, write_date)
+                VALUES (%s, %s, %s, %s, 'pending', 0, %s, %s, %s, %s)
+                ON CONFLICT (message_id) DO NOTHING
+                """,
+                (msg["id"], msg["from"], msg.get("type"), json.dumps(msg), uid, now, uid, now),
+            )
+            inserted += self.env.cr.rowcount
+        if inserted:
+            cron = self.env.ref("modulo_aduana_odoo.cron_procesar_wa_inbox", raise_if_not_found=False)
+            if cron:
+                cron.sudo()._trigger()
+        return inserted
+
+    # ── Cron ──────────────────────────────────────────────────────────────────
+
+    @api.model
+    def cron_procesar_wa_inbox(self):
+        now = fields.Datetime.now()
+        batch = self.search(
+            [
+                ("state", "=", "pending"),
+                "|", ("next_attempt_at", "=", False), ("next_attempt_at", "<=", now),
+            ],
+            limit=self._inbox_param("batch_size", 50),
+        )
+        max_attempts = self._inbox_param("max_attempts", 5)
+        for item in batch:
+            try:
+                with self.env.cr.savepoint():
+                    item._procesar_mensaje()
+                item.write({"state": "done", "processed_at": fields.Datetime.now(), "last_error": False})
+            except Exception as exc:
+                attempts = item.attempts + 1
+                _logger.warning("WhatsApp inbox %s falló (intento %s): %s", item.message_id, attempts, exc)
+                if attempts >= max_attempts:
+                    item.write({"state": "failed", "attempts": attempts, "last_error": str(exc)})
+                    item._avisar_fallo()
+                else:
+                    # Backoff exponencial: 1, 2, 4, 8… minutos
+                    item.write({
+                        "attempts": attempts,
+                        "next_attempt_at": fields.Datetime.now() + timedelta(minutes=2 ** (attempts - 1)),
+                        "last_error": str(exc),
+                    })
+        if len(batch) >= self._inbox_param("batch_size", 50):
+            self.env.ref("modulo_aduana_odoo.cron_procesar_wa_inbox")._trigger()
+        return True
+
+    def action_reintentar(self):
+        self.filtered(lambda m: m.state == "failed").write({
+            "state": "pending",
+            "attempts": 0,
+            "next_attempt_at": False,
+            "last_error": False,
+        })
+        return True
+
+    # ── Procesamiento ─────────────────────────────────────────────────────────
+
+    def _procesar_mensaje(self):
+        self.ensure_one()
+        msg = json.loads(self.payload or "{}")
+        wa_id = self.wa_id
+        session = self.env["mx.wa.session"].sudo()._session_for_sender(wa_id)
+        msg_type = msg.get("type")
+        if msg_type == "interactive":
+            reply = ((msg.get("interactive") or {}).get("list_reply") or {})
+            reply_id = reply.get("id")
+            if reply_id == "send_csf":
+                session.write({
+                    "expected_doc_type": "csf",
+                    "last_message_id": msg.get("id"),
+                    "last_event_at": fields.Datetime.now(),
+                })
+                self._send_text(wa_id, "Perfecto. Adjunta tu archivo CSF en PDF.")
+            elif reply_id == "send_ine":
+                self._send_text(wa_id, "INE aun no esta habilitado. Por ahora usa Enviar CSF.")
+        elif msg_type == "text":
+            body = ((msg.get("text") or {}).get("body") or "").strip().lower()
+            if body in ("menu", "documentos", "docs", "hola"):
+                self._send_doc_menu(wa_id)
+        elif msg_type == "document":
+            self._process_document_message(session, wa_id, msg)
+
+    def _process_document_message(self, session, wa_id, msg):
+        doc = msg.get("document") or {}
+        media_id = doc.get("id")
+        filename = doc.get("filename") or "documento"
+        if not media_id:
+            self._send_text(wa_id, "No pude leer el archivo. Intenta de nuevo.")
+            return
+
+        if session.expected_doc_type != "csf":
+            self._send_text(wa_id, "Primero selecciona el tipo de documento (ej. Enviar CSF).")
+            return
+
+        partner = session.partner_id or session._find_partner_by_wa_id(wa_id)
+        if not partner:
+            self._send_text(wa_id, "No encontre tu contacto. Pide a soporte vincular tu numero.")
+            return
+
+        # Errores de red se propagan: el cron reintenta con backoff.
+        # Si el CSF es el mismo que ya tiene el contacto no se descarga.
+        try:
+            media = self._download_media(media_id, known_sha256=partner.x_csf_sha256)
+        except MediaTooLarge as exc:
+            self._send_text(wa_id, str(exc))
+            return
+        if media["content"] is None:
+            stored = False
+        else:
+            try:
+                stored = partner.sudo()._store_csf_document(
+                    media["content"],
+                    filename,
+                    mimetype=media["mime_type"],
+                    sha256=media["sha256"],
+                )
+            except Exception:
+                _logger.exception("Error procesando documento WhatsApp para partner %s", partner.id)
+                self._send_text(wa_id, "No pude procesar el archivo. Verifica que sea PDF y vuelve a intentar.")
+                return
+        session.write({
+            "expected_doc_type": False,
+            "last_message_id": msg.get("id"),
+            "last_event_at": fields.Datetime.now(),
+            "partner_id": partner.id,
+        })
+        if stored:
+            self._send_text(wa_id, "CSF recibido y cargado correctamente.")
+        else:
+            self._send_text(wa_id, "Ese CSF ya estaba cargado en tu expediente.")
+
+    def _avisar_fallo(self):
+        for item in self.filtered(lambda m: m.msg_type == "document"):
+            self._send_text(item.wa_id, "No pude procesar el archivo. Verifica que sea PDF y vuelve a intentar.")
+
+    # ── Graph API ─────────────────────────────────────────────────────────────
+
+    @api.model
+    def _send_whatsapp_message(self, to, payload):
+        token = self._param("modulo_aduana_odoo.whatsapp_token")
+        phone_number_id = self._param("modulo_aduana_odoo.whatsapp_phone_number_id")
+        if not token or not phone_number_id:
+            _logger.warning("WhatsApp config incompleta (token/phone_number_id).")
+            return
+        url = f"{GRAPH_URL}/{phone_number_id}/messages"
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        }
+        body = {"messaging_product": "whatsapp", "to": to}
+        body.update(payload)
+        try:
+            resp = _wa_http().post(url, headers=headers, data=json.dumps(body), timeout=20)
+            if resp.status_code >= 300:
+                _logger.warning("WhatsApp send failed %s: %s", resp.status_code, resp.text)
+        except Exception:
+            _logger.exception("Error enviando mensaje de WhatsApp")
+
+    @api.model
+    def _send_text(self, to, text):
+        self._send_whatsapp_message(to, {"type": "text", "text": {"body": text}})
+
+    @api.model
+    def _send_doc_menu(self, wa_id):
+        payload = {
+            "type": "interactive",
+            "interactive": {
+                "type": "list",
+                "body": {"text": "Selecciona el documento que quieres enviar:"},
+                "action": {
+                    "button": "Seleccionar",
+                    "sections": [
+                        {
+                            "title": "Documentos",
+                            "rows": [
+                                {"id": "send_csf", "title": "Enviar CSF"},
+                                {"id": "send_ine", "title": "Enviar INE"},
+                            ],
+                        }
+                    ],
+                },
+            },
+        }
+        self._send_whatsapp_message(wa_id, payload)
+
+    @api.model
+    def _download_media(self, media_id, known_sha256=None):
+        """Descarga un archivo de la Graph API por bloques con tope de tamaño.
+
+        El cuerpo se lee por bloques calculando el SHA-256 al vuelo y se corta
+        en cuanto excede mx_ped.wa_inbox.max_media_mb, sin esperar a bajar el
+        archivo completo.  El contenido sí termina en memoria (a lo más
+        max_media_mb): el campo binario y el adjunto del contacto lo
+        necesitan completo.  Si Meta reporta el mismo sha256 que
+        `known_sha256` no se descarga nada.
+
+        Returns:
+            dict: content (bytes, o None si coincidió con known_sha256),
+                  mime_type, sha256, size
+        """
+        token = self._param("modulo_aduana_odoo.whatsapp_token")
+        if not token:
+            raise ValueError("Falta token de WhatsApp.")
+        max_mb = self._inbox_param("max_media_mb", 10)
+        max_bytes = max_mb * 1024 * 1024
+        too_large = MediaTooLarge("El archivo excede el limite de %s MB." % max_mb)
+
+        http = _wa_http()
+        headers = {"Authorization": f"Bearer {token}"}
+        meta_resp = http.get(f"{GRAPH_URL}/{media_id}", headers=headers, timeout=20)
+        meta_resp.raise_for_status()
+        meta = meta_resp.json()
+        media_url = meta.get("url")
+        if not media_url:
+            raise ValueError("No llego URL de media.")
+        mime_type = (meta.get("mime_type") or "").lower()
+        if int(meta.get("file_size") or 0) > max_bytes:
+            raise too_large
+        if known_sha256 and meta.get("sha256") == known_sha256:
+            return {"content": None, "mime_type": mime_type, "sha256": known_sha256, "size": 0}
+
+        digest = hashlib.sha256()
+        size = 0
+        with http.get(media_url, headers=headers, timeout=20, stream=True) as bin_resp:
+            bin_resp.raise_for_status()
+            if int(bin_resp.headers.get("Content-Length") or 0) > max_bytes:
+                raise too_large
+            chunks = []
+            for chunk in bin_resp.iter_content(chunk_size=_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise too_large
+                digest.update(chunk)
+                chunks.append(chunk)
+            content = b"".join(chunks)
+        sha256 = digest.hexdigest()
+        if known_sha256 and sha256 == known_sha256:
+            content = None
+        return {"content": content, "mime_type": mime_type, "sha256": sha256, "size": size}
@@ -1,5 +1,38 @@
 # -*- coding: utf-8 -*-
-from odoo import fields, models
+import re
+import threading
+import time
+
+from odoo import api, fields, models
+
+_NON_DIGIT_RE = re.compile(r"\D+")
+
+# ── Caché remitente → contacto por worker ────────────────────────────────────
+# Un mismo remitente manda varios mensajes seguidos (menú, selección, PDF);
+# se recuerda el contacto encontrado para sus últimos 10 dígitos.  Solo se
+# cachean aciertos: un número recién vinculado se encuentra en el siguiente
+# mensaje.  res.partner.write limpia las entradas al cambiar phone/mobile,
+# pero solo en el worker que hizo el cambio; los demás vuelven a comprobar
+# x_mobile_last10/x_phone_last10 del contacto cacheado en cada acierto.
+_PARTNER_CACHE_TTL = 600  # segundos
+_PARTNER_CACHE = {}
+_PARTNER_CACHE_LOCK = threading.Lock()
+
+
+def phone_last10(value):
+    """Últimos 10 dígitos de un teléfono (False si no tiene dígitos)."""
+    digits = _NON_DIGIT_RE.sub("", value or "")
+    return digits[-10:] or False
+
+
+def _wa_partner_cache_wipe(dbname, last10s=None):
+    """Elimina del caché los números indicados (o todos los de la base)."""
+    with _PARTNER_CACHE_LOCK:
+        for cache_key in list(_PARTNER_CACHE):
+            if cache_key[0] != dbname:
+                continue
+            if last10s is None or cache_key[1] in last10s:
+                del _PARTNER_CACHE[cache_key]
 
 
 class MxWaSession(models.Model):
@@ -21,3 +54,43 @@ class MxWaSession(models.Model):
     _sql_constraints = [
         ("mx_wa_session_wa_id_uniq", "unique(wa_id)", "Ya existe una sesion para este remitente."),
     ]
+
+    @api.model
+    def _normalize_phone(self, value):
+        return _NON_DIGIT_RE.sub("", value or "")
+
+    @api.model
+    def _find_partner_by_wa_id(self, wa_id):
+        # Match by last 10 digits to support local/international formatting differences.
+        last10 = phone_last10(wa_id)
+        partner_model = self.env["res.partner"].sudo()
+        if not last10:
+            return partner_model.browse()
+        cache_key = (self.env.cr.dbname, last10)
+        with _PARTNER_CACHE_LOCK:
+            hit = _PARTNER_CACHE.get(cache_key)
+        if hit and hit[1] > time.monotonic():
+            partner = partner_model.browse(hit[0]).exists()
+            if partner and last10 in (partner.x_mobile_last10, partner.x_phone_last10):
+                return partner
+        domain = ["|", ("x_mobile_last10", "=", last10), ("x_phone_last10", "=", last10)]
+        partner = partner_model.search(domain, limit=1)
+        if partner:
+            with _PARTNER_CACHE_LOCK:
+                _PARTNER_CACHE[cache_key] = (partner.id, time.monotonic() + _PARTNER_CACHE_TTL)
+        return partner
+
+    @api.model
+    def _session_for_sender(self, wa_id):
+        session = self.search([("wa_id", "=", wa_id)], limit=1)
+        if not session:
+            partner = self._find_partner_by_wa_id(wa_id)
+            session = self.create({
+                "wa_id": wa_id,
+                "partner_id": partner.id or False,
+            })
+        elif not session.partner_id:
+            partner = self._find_partner_by_wa_id(wa_id)
+            if partner:
+                session.partner_id = partner.id
+        return session
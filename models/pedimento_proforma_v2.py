@@ -8,6 +8,13 @@ Tipografía oficial:
   Nombre del Campo       : Arial 8 Negrita  (Helvetica-Bold 8)
   Información Declarada  : Arial 9          (Helvetica     9)
   Fechas                 : DD/MM/AAAA
+
+El "mobiliario" estático que se repite en cada hoja (marca de agua, pie de
+página, encabezado de páginas 2..N, encabezados de bloque y de la tabla de
+partidas) se dibuja una sola vez por documento como form XObject de
+ReportLab (beginForm/doForm) y en las demás hojas solo se referencia; por
+hoja se dibujan únicamente los datos declarados.  `benchmark_proforma`
+compara tiempos y tamaño contra el dibujo directo (reuse_forms=False).
 """
 
 from reportlab.lib.pagesizes import letter
@@ -15,8 +22,9 @@ from reportlab.lib import colors
 from reportlab.lib.units import mm
 from reportlab.pdfgen import canvas
 import io
-from dataclasses import dataclass, field
-from typing import List, Optional
+import time
+from dataclasses import dataclass, field, fields
+from typing import List, Optional, Tuple
 
 
 # ══════════════════════════════════════════════
@@ -189,25 +197,226 @@ class Pedimento:
 
 
 # ══════════════════════════════════════════════
-#  PARSER TXT  (registros separados por |)
+#  DOCUMENTO INTERMEDIO  (registros ya formateados)
 # ══════════════════════════════════════════════
-def parse_txt(txt: str) -> Pedimento:
-    ped = Pedimento()
-    partida_actual: Optional[Partida] = None
+@dataclass(frozen=True)
+class RegistroDoc:
+    """Un registro del pedimento con sus campos ya formateados, en orden del layout.
+
+    `posiciones` solo aplica a layouts de ancho fijo: una tupla
+    (pos_ini, longitud, alinear_izquierda) por campo.  `nombres` lleva el
+    nombre del campo del layout de cada posición; con él la proforma se
+    arma por nombre y no por las posiciones del TXT de ejemplo.
+    """
+    codigo: str
+    campos: Tuple[str, ...]
+    posiciones: Optional[Tuple[Tuple[int, int, bool], ...]] = None
+    nombres: Optional[Tuple[str, ...]] = None
+
+    def to_line(self, field_sep: str = "|") -> str:
+        if self.posiciones is None:
+            return field_sep.join(self.campos)
+        line = []
+        for txt, (pos_ini, length, left) in zip(self.campos, self.posiciones):
+            txt = txt.ljust(length) if left else txt.rjust(length, "0")
+            start = pos_ini - 1
+            if len(line) < start + length:
+                line.extend([" "] * (start + length - len(line)))
+            line[start:start + length] = txt
+        return "".join(line)
+
+
+@dataclass
+class PedimentoDocumento:
+    """
+    Representación única del pedimento: los registros tal como se declaran.
+
+    De aquí salen tanto el TXT (`to_txt`) como los datos de la proforma
+    (`to_pedimento`), así ambas salidas no pueden diferir.
+    """
+    registros: List[RegistroDoc] = field(default_factory=list)
+    field_sep: str = "|"
+    record_sep: str = "\n"
 
+    def to_txt(self) -> str:
+        return self.record_sep.join(reg.to_line(self.field_sep) for reg in self.registros)
+
+    def to_pedimento(self) -> "Pedimento":
+        return pedimento_from_registros(self.registros)
+
+
+def documento_from_txt(txt: str, field_sep: str = "|") -> PedimentoDocumento:
+    """Documento a partir de un TXT con campos separados por `field_sep`."""
     # Normaliza separadores: convierte literales \\n a newline real por si el
     # layout almacenó la secuencia de escape como texto (2 chars) en vez del
     # carácter real. Luego splitlines() siempre encontrará los saltos de línea.
     txt = txt.replace("\\n", "\n").replace("\\r", "\r")
-
+    registros = []
     for linea in txt.strip().splitlines():
         linea = linea.strip()
         if not linea:
             continue
-        c = linea.split("|")
+        campos = tuple(linea.split(field_sep))
+        registros.append(RegistroDoc(campos[0].strip(), campos))
+    return PedimentoDocumento(registros=registros, field_sep=field_sep)
+
+
+# ══════════════════════════════════════════════
+#  MAPEO REGISTROS → PEDIMENTO
+# ══════════════════════════════════════════════
+# Nombre del campo del layout → atributo(s) de Pedimento.  Una llave
+# (código, nombre) gana sobre el nombre solo; "agente.x" va al agente.
+_NOMBRE_A_PEDIMENTO = {
+    "numero_pedimento":                "num_pedimento",
+    "tipo_operacion":                  "tipo_operacion",
+    "clave_pedimento":                 "clave_pedimento",
+    "aduana_seccion_despacho":         "clave_seccion_aduanera",
+    "aduana_despacho":                 "clave_seccion_aduanera",
+    "aduana_seccion_entrada_salida":   "aduana_es",
+    "acuse_validacion":                "codigo_aceptacion",
+    "rfc_importador_exportador":       "rfc",
+    "rfc_exportador":                  "rfc",
+    "curp_importador_exportador":      "curp",
+    "curp_exportador":                 "curp",
+    "nombre_importador_exportador":    "nombre_razon_social",
+    "nombre_exportador":               "nombre_razon_social",
+    "tipo_cambio":                     "tipo_cambio",
+    "importe_fletes":                  "fletes",
+    "importe_seguros":                 ("seguros", "val_seguros"),
+    "importe_embalajes":               "embalajes",
+    "otros_incrementables":            "otros_incrementables",
+    "peso_bruto_total":                "peso_bruto",
+    "medio_transporte_entrada_salida": "medio_transporte_entrada",
+    "medio_transporte_arribo":         "medio_transporte_arribo",
+    "medio_transporte_salida":         "medio_transporte_salida",
+    "origen_destino":                  "destino_origen",
+    "fecha_pago":                      "fecha_pago",
+    "rfc_transportista":               "transportista_rfc",
+    "curp_transportista":              "transportista_curp",
+    "nombre_transportista":            "transportista_nombre",
+    "domicilio_transportista":         "transportista_domicilio",
+    "pais_transporte":                 "transporte_pais",
+    "identificador_transporte":        "transporte_id",
+    "numero_candado":                  "candado1",
+    "cfdi_termino_facturacion":        "incoterm",
+    ("505", "folio"):                  "num_acuse_valor",
+    "observaciones":                   "observaciones",
+    "patente":                         "agente.patente",
+    "curp_agente":                     "agente.curp",
+}
+
+# Nombre del campo del layout → atributo(s) de Partida (registros que
+# llevan numero_partida).
+_NOMBRE_A_PARTIDA = {
+    "numero_partida":        "secuencia",
+    "fraccion_arancelaria":  "fraccion",
+    "subdivision":           "subdivision",
+    "vinculacion":           "vinculacion",
+    "metodo_valoracion":     "met_valoracion",
+    "descripcion":           "descripcion",
+    "precio_unitario":       "precio_unit",
+    "valor_usd":             "val_aduana_usd",
+    "valor_aduana":          "val_agregado",
+    "valor_comercial":       ("imp_precio_pag", "precio_pagado"),
+    "importe_precio":        ("imp_precio_pag", "precio_pagado"),
+    "cantidad_umc":          "cantidad_umc",
+    "umc":                   "umc",
+    "cantidad_umt":          "cantidad_umt",
+    "umt":                   "umt",
+    "pais_origen":           "pais_origen",
+    "pais_vendedor":         "pais_venta",
+    "observaciones":         "observaciones",
+    "observaciones_partida": "observaciones",
+}
+
+
+def pedimento_from_registros(registros: List[RegistroDoc]) -> Pedimento:
+    """Pedimento con lo declarado en `registros`.
+
+    Si los registros traen `nombres` (vienen de un layout) se mapean por
+    nombre de campo; si no (TXT suelto), por las posiciones del Anexo 22
+    que usa DEMO_TXT.
+    """
+    if any(registro.nombres for registro in registros):
+        return _pedimento_por_nombre(registros)
+    return _pedimento_por_posicion(registros)
+
+
+def _asignar(destino, mapa, codigo, valores):
+    for nombre, valor in valores.items():
+        if not valor:
+            continue
+        attrs = mapa.get((codigo, nombre)) or mapa.get(nombre)
+        if not attrs:
+            continue
+        for attr in (attrs,) if isinstance(attrs, str) else attrs:
+            obj = destino
+            if attr.startswith("agente."):
+                obj, attr = destino.agente, attr[len("agente."):]
+            setattr(obj, attr, valor)
+
+
+def _pedimento_por_nombre(registros: List[RegistroDoc]) -> Pedimento:
+    ped = Pedimento()
+    partidas = {}
+
+    for registro in registros:
+        if not registro.nombres:
+            continue
+        valores = {
+            nombre: (valor or "").strip()
+            for nombre, valor in zip(registro.nombres, registro.campos)
+        }
+        g = valores.get
+        num = g("numero_partida", "").lstrip("0")
+        if num:
+            partida = partidas.get(num)
+            if partida is None:
+                partida = partidas[num] = Partida()
+                ped.partidas.append(partida)
+            _asignar(partida, _NOMBRE_A_PARTIDA, registro.codigo, valores)
+            if g("clave_contribucion"):
+                # Tasa e importe de la misma contribución llegan en registros distintos.
+                clave = g("clave_contribucion")
+                contrib = next((c for c in partida.contribuciones if c.clave == clave), None)
+                if contrib is None:
+                    contrib = Contribucion(clave)
+                    partida.contribuciones.append(contrib)
+                contrib.tipo_tasa = g("tipo_tasa") or contrib.tipo_tasa
+                contrib.tasa = g("tasa") or contrib.tasa
+                contrib.importe = g("importe") or g("importe_pago") or contrib.importe
+                contrib.forma_pago = g("forma_pago") or contrib.forma_pago
+            if g("clave_identificador"):
+                partida.identificadores.append(Identificador(
+                    g("clave_identificador"), g("complemento1", ""), g("complemento2", ""), g("complemento3", "")))
+            continue
+
+        _asignar(ped, _NOMBRE_A_PEDIMENTO, registro.codigo, valores)
+        if g("clave_contribucion"):
+            importe = g("importe") or g("importe_pago")
+            contrib = Contribucion(g("clave_contribucion"), g("tipo_tasa", ""), g("tasa", ""),
+                                   importe or "", g("forma_pago") or g("clave_forma_pago", ""))
+            (ped.contribuciones_liq if importe else ped.tasas).append(contrib)
+        if g("clave_identificador"):
+            ped.identificadores.append(Identificador(
+                g("clave_identificador"), g("complemento1", ""), g("complemento2", ""), g("complemento3", "")))
+        if g("guia_manifiesto"):
+            ped.guias.append(Guia(g("guia_manifiesto"), g("identificador_guia", "")))
+        if g("numero_contenedor"):
+            ped.contenedores.append(Contenedor(g("numero_contenedor"), g("tipo_contenedor", "")))
+
+    return ped
+
+
+def _pedimento_por_posicion(registros: List[RegistroDoc]) -> Pedimento:
+    ped = Pedimento()
+    partida_actual: Optional[Partida] = None
+
+    for registro in registros:
+        c = registro.campos
         def g(i, d=""): return c[i].strip() if len(c) > i else d
 
-        reg = g(0)
+        reg = registro.codigo
 
         if reg == "500":
             ped.num_pedimento               = g(1)
@@ -286,17 +495,58 @@ def parse_txt(txt: str) -> Pedimento:
     return ped
 
 
+def parse_txt(txt: str) -> Pedimento:
+    return documento_from_txt(txt).to_pedimento()
+
+
+def merge_declarado(base: Pedimento, declarado: Pedimento) -> Pedimento:
+    """
+    Sobrepone a `base` lo declarado en los registros.
+
+    Todo valor no vacío de `declarado` reemplaza al de `base`; `base` solo
+    aporta lo que los registros no llevan (domicilios, agente, guías...).
+    Las partidas se emparejan por secuencia: las de `base` se conservan y
+    las declaradas sin pareja se agregan al final.
+    """
+    def _merge(dst, src):
+        for f in fields(src):
+            value = getattr(src, f.name)
+            if f.name == "partidas":
+                continue
+            if isinstance(value, AgenteAduanal):
+                _merge(getattr(dst, f.name), value)
+            elif value:
+                setattr(dst, f.name, value)
+
+    _merge(base, declarado)
+    if declarado.partidas:
+        def _sec(value):
+            return value.strip().lstrip("0")
+        por_secuencia = {_sec(p.secuencia): p for p in base.partidas}
+        for part in declarado.partidas:
+            destino = por_secuencia.get(_sec(part.secuencia))
+            if destino is None:
+                destino = por_secuencia[_sec(part.secuencia)] = Partida()
+                base.partidas.append(destino)
+            _merge(destino, part)
+    return base
+
+
 # ══════════════════════════════════════════════
 #  BUILDER DE PDF — LAYOUT OFICIAL ANEXO 22
 # ══════════════════════════════════════════════
 class PedimentoPDF:
-    def __init__(self, ped: Pedimento):
+    def __init__(self, ped: Pedimento, reuse_forms: bool = True):
         self.ped     = ped
         self.buf     = io.BytesIO()
         self.c       = canvas.Canvas(self.buf, pagesize=letter)
         self.y       = 0.0
         self.pg      = 0          # número de página
         self.total_pages = "N"    # se actualiza al final (placeholder)
+        self.reuse_forms = reuse_forms
+        self._forms  = {}         # llave → (nombre XObject, alto consumido)
+        self._form_seq = 0        # consecutivo de nombres de XObject
+        self._in_form  = False    # hay un form abierto (beginForm sin endForm)
 
     # ─────────────────────────────────────────
     #  UTILIDADES BÁSICAS
@@ -309,7 +559,47 @@ class PedimentoPDF:
         self.y = PH - MT
         self._watermark()
 
+    def _reuse(self, key, draw, anchored=True):
+        """Dibuja `draw` como form XObject la primera vez y luego lo reutiliza.
+
+        Con anchored=True el contenido se dibuja relativo a self.y (se
+        graba con la parte superior en PH y se traslada al usarlo) y self.y
+        avanza lo mismo que avanzó `draw`; con anchored=False el contenido
+        usa coordenadas absolutas de la hoja.  Un `_reuse` anidado (llamado
+        mientras se graba otro form) se dibuja en línea dentro del form
+        externo: ReportLab no permite abrir un form dentro de otro.
+        """
+        if not self.reuse_forms or self._in_form:
+            draw()
+            return
+        top = self.y
+        if key not in self._forms:
+            self._form_seq += 1
+            name = "F%d" % self._form_seq
+            self.c.beginForm(name)
+            self._in_form = True
+            self.y = PH
+            try:
+                draw()
+            finally:
+                self._in_form = False
+            self._forms[key] = (name, PH - self.y)
+            self.c.endForm()
+        name, height = self._forms[key]
+        if anchored:
+            self.c.saveState()
+            self.c.translate(0, top - PH)
+            self.c.doForm(name)
+            self.c.restoreState()
+            self.y = top - height
+        else:
+            self.c.doForm(name)
+            self.y = top
+
     def _watermark(self):
+        self._reuse("watermark", self._draw_watermark, anchored=False)
+
+    def _draw_watermark(self):
         self.c.saveState()
         self.c.setFont(FB, 72)
         self.c.setFillColor(WM_COLOR)
@@ -369,15 +659,28 @@ class PedimentoPDF:
         """Encabezado de bloque: sombreado gris + texto Arial 9 Negrita."""
         x = x if x is not None else ML
         w = w if w is not None else CW
-        top = self.y
-        bot = top - h
-        self._rect(x, bot, w, h, fill=SHADE15)
-        self.c.saveState()
-        self.c.setFont(FB, SZ_BLOCK_HDR)
-        self.c.setFillColor(BLACK)
-        self.c.drawString(x + 2, bot + (h - SZ_BLOCK_HDR) / 2, label)
-        self.c.restoreState()
-        self.y = bot
+
+        def draw():
+            bot = self.y - h
+            self._rect(x, bot, w, h, fill=SHADE15)
+            self.c.saveState()
+            self.c.setFont(FB, SZ_BLOCK_HDR)
+            self.c.setFillColor(BLACK)
+            self.c.drawString(x + 2, bot + (h - SZ_BLOCK_HDR) / 2, label)
+            self.c.restoreState()
+            self.y = bot
+
+        self._reuse(("block", label, x, w, h), draw)
+
+    def _bar_header(self, label: str):
+        """Barra sombreada con etiqueta Arial 7 Negrita (sub-bloques de partida)."""
+        def draw():
+            yh = self.y - HDR_H
+            self._rect(ML, yh, CW, HDR_H, fill=SHADE15)
+            self._text(ML + 2, yh + 1, label, SZ_FIELD_NAME, bold=True)
+            self.y = yh
+
+        self._reuse(("bar", label), draw)
 
     def _field_cell(self, x, y, w, h, field_name: str, value: str, shade=False):
         """
@@ -706,6 +1009,13 @@ class PedimentoPDF:
     #  ENCABEZADO PÁGINA 2..N  (Anexo 22, pág 2)
     # ─────────────────────────────────────────
     def _header_pagN(self):
+        top = self.y
+        # Todo es igual en cada hoja salvo el número de página
+        self._reuse("header_pagN", self._draw_header_pagN)
+        self._text(ML + CW * 0.75 + 2, top - HDR_H + 1.5,
+                   f"Página {self.pg} de {self.total_pages}", SZ_DATA)
+
+    def _draw_header_pagN(self):
         p = self.ped
         H = HDR_H
         top = self.y
@@ -715,8 +1025,6 @@ class PedimentoPDF:
         self._text(ML + CW * 0.375, top - H + 1.5,
                    "ANEXO DEL PEDIMENTO", SZ_BLOCK_HDR, bold=True, align="center")
         self._rect(ML + CW * 0.75, top - H, CW * 0.25, H)
-        self._text(ML + CW * 0.75 + 2, top - H + 1.5,
-                   f"Página {self.pg} de {self.total_pages}", SZ_DATA)
         self.y = top - H
 
         # NUM.PEDIMENTO | TIPO OPER | CVE.PEDIM | RFC | CURP
@@ -734,6 +1042,10 @@ class PedimentoPDF:
     #  PIE DE PÁGINA — TODAS LAS HOJAS
     # ─────────────────────────────────────────
     def _footer(self):
+        # Datos del agente: iguales en todas las hojas del documento
+        self._reuse("footer", self._draw_footer, anchored=False)
+
+    def _draw_footer(self):
         p = self.ped
         a = p.agente
         c = self.c
@@ -934,6 +1246,9 @@ class PedimentoPDF:
     # ─────────────────────────────────────────
     def _bloque_encabezado_partidas(self):
         self._need(HDR_H)
+        self._reuse("encabezado_partidas", self._draw_encabezado_partidas)
+
+    def _draw_encabezado_partidas(self):
         self._block_header("PARTIDAS")
 
         # Sub-header de columnas exacto según Anexo 22
@@ -1046,11 +1361,7 @@ class PedimentoPDF:
         # Identificadores de partida
         if part.identificadores:
             self._need(HDR_H + ROW_H * len(part.identificadores))
-            yh = self.y - HDR_H
-            self._rect(ML, yh, CW, HDR_H, fill=SHADE15)
-            self._text(ML + 2, yh + 1,
-                       "IDENTIFICADORES (NIVEL PARTIDA)", SZ_FIELD_NAME, bold=True)
-            self.y = yh
+            self._bar_header("IDENTIFICADORES (NIVEL PARTIDA)")
             for idf in part.identificadores:
                 yr = self.y - ROW_H * 0.8
                 self._row_of_cells(yr, ROW_H * 0.8, [
@@ -1064,11 +1375,7 @@ class PedimentoPDF:
         # Observaciones de partida
         if part.observaciones:
             self._need(HDR_H + ROW_H)
-            yh = self.y - HDR_H
-            self._rect(ML, yh, CW, HDR_H, fill=SHADE15)
-            self._text(ML + 2, yh + 1,
-                       "OBSERVACIONES A NIVEL PARTIDA", SZ_FIELD_NAME, bold=True)
-            self.y = yh
+            self._bar_header("OBSERVACIONES A NIVEL PARTIDA")
             yr = self.y - ROW_H
             self._field_cell(ML, yr, CW, ROW_H, "", part.observaciones)
             self.y = yr
@@ -1190,6 +1497,37 @@ def generar_proforma(txt_pedimento: str,
     return pdf_bytes
 
 
+def benchmark_proforma(txt_pedimento: str = None, num_partidas: int = 150, repeat: int = 3) -> dict:
+    """
+    Compara el render con y sin reutilización de form XObjects.
+
+    Replica las partidas del TXT (DEMO_TXT por defecto) hasta `num_partidas`
+    —150 partidas ≈ 27 hojas— y mide el mejor de `repeat` renders.
+
+    Returns:
+        dict {"paginas", "directo": {"segundos", "bytes"},
+              "forms": {"segundos", "bytes"}}
+    """
+    base = parse_txt(txt_pedimento or DEMO_TXT)
+    base.agente.nombre = DEMO_AGENTE["nombre"]
+    base.agente.patente = DEMO_AGENTE["patente"]
+    plantilla = base.partidas or [Partida()]
+    base.partidas = [plantilla[i % len(plantilla)] for i in range(num_partidas)]
+
+    resultado = {}
+    for etiqueta, reuse in (("directo", False), ("forms", True)):
+        mejor = None
+        for _ in range(max(1, repeat)):
+            t0 = time.perf_counter()
+            builder = PedimentoPDF(base, reuse_forms=reuse)
+            pdf = builder.build()
+            elapsed = time.perf_counter() - t0
+            mejor = elapsed if mejor is None else min(mejor, elapsed)
+        resultado[etiqueta] = {"segundos": round(mejor, 4), "bytes": len(pdf)}
+        resultado["paginas"] = builder.pg
+    return resultado
+
+
 # ══════════════════════════════════════════════
 #  DEMO
 # ══════════════════════════════════════════════
@@ -1221,6 +1559,10 @@ DEMO_AGENTE = {
 }
 
 if __name__ == "__main__":
+    import sys
+    if "--bench" in sys.argv:
+        print(benchmark_proforma())
+        sys.exit(0)
     out = "/mnt/user-data/outputs/proforma_pedimento_v2.pdf"
     generar_proforma(DEMO_TXT, DEMO_AGENTE, out)
     print(f"✅  Proforma v2 generada: {out}")
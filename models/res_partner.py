@@ -1,25 +1,27 @@
 # -*- coding: utf-8 -*-
 import base64
+import hashlib
 import io
 import json
 import logging
 import re
 import requests
 import secrets
-import ssl
 import unicodedata
 import urllib3
 from datetime import timedelta
 from odoo import api, fields, models
 from odoo.exceptions import UserError
 
+from . import csf_service
+from .csf_service import DESAdapter  # noqa: F401 — compatibilidad de imports
+from .mx_wa_session import _wa_partner_cache_wipe, phone_last10
+
 # Desactivar advertencias de SSL en el log
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 try:
     from pyzbar.pyzbar import decode
-    from pdf2image import convert_from_bytes
-    from bs4 import BeautifulSoup
     from PIL import Image
 except ImportError:
     decode = None
@@ -28,16 +30,6 @@ except ImportError:
 _logger = logging.getLogger(__name__)
 
 
-class DESAdapter(requests.adapters.HTTPAdapter):
-    def init_poolmanager(self, *args, **kwargs):
-        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        context.set_ciphers("DEFAULT@SECLEVEL=1")
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        kwargs["ssl_context"] = context
-        return super(DESAdapter, self).init_poolmanager(*args, **kwargs)
-
-
 class ResPartner(models.Model):
     _inherit = "res.partner"
     _DOC_FILENAME_PAIRS = [
@@ -121,6 +113,10 @@ class ResPartner(models.Model):
         "chofer_id",
         string="Gafetes ANAM",
     )
+    # Últimos 10 dígitos de phone/mobile: búsqueda exacta (indexada) del
+    # remitente de WhatsApp en lugar de ilike sobre toda la tabla.
+    x_phone_last10 = fields.Char(string="Teléfono normalizado", index=True, readonly=True, copy=False)
+    x_mobile_last10 = fields.Char(string="Móvil normalizado", index=True, readonly=True, copy=False)
     x_curp = fields.Char(string="CURP")
     x_identificacion_fiscal = fields.Char(string="Identificacion fiscal (extranjero)")
     x_patente_aduanal = fields.Char(string="Patente aduanal")
@@ -133,6 +129,7 @@ class ResPartner(models.Model):
     x_localidad = fields.Char(string="Localidad")
     x_csf_filename = fields.Char(string="Nombre de archivo CSF")
     x_csf_file = fields.Binary(string="CSF (PDF)")
+    x_csf_sha256 = fields.Char(string="SHA-256 del CSF", readonly=True, copy=False, index=True)
     # Persona fisica - expediente documental
     x_pf_programa_fomento_filename = fields.Char(string="Programa fomento / certificacion")
     x_pf_programa_fomento_file = fields.Binary(string="Programa fomento / certificacion")
@@ -313,108 +310,60 @@ class ResPartner(models.Model):
         }
 
     def _extract_csf_values(self, encoded_pdf):
-        if not encoded_pdf or not decode:
+        if not encoded_pdf or not csf_service.available():
             return {}
         try:
-            file_content = base64.b64decode(encoded_pdf)
-            images = convert_from_bytes(file_content, first_page=1, last_page=1)
-            if not images:
-                return {}
-
-            qr_codes = decode(images[0])
-            if not qr_codes:
-                _logger.warning("CSF sin QR detectable.")
-                return {}
-
-            qr_data = qr_codes[0].data.decode("utf-8")
-            session = requests.Session()
-            session.mount("https://", DESAdapter())
-            response = session.get(qr_data, timeout=15, verify=False)
-            if response.status_code != 200:
-                _logger.warning("CSF QR URL respondio %s", response.status_code)
-                return {}
-
-            soup = BeautifulSoup(response.text, "html.parser")
-
-            # Intentar extraer con <td> (estructura clásica del SAT)
-            tds = soup.find_all("td")
-            page_data = {}
-            for i in range(len(tds)):
-                label = tds[i].get_text().replace(":", "").strip()
-                if i + 1 < len(tds):
-                    value = tds[i + 1].get_text(strip=True)
-                    if "RFC" in label.upper():
-                        page_data["rfc"] = value
-                    if "CURP" in label.upper():
-                        page_data["curp"] = value
-                    if "CP" in label.upper() or "CODIGO POSTAL" in label.upper():
-                        page_data["cp"] = value
-                    if "VIALIDAD" in label.upper() or "NOMBRE DE LA CALLE" in label.upper():
-                        page_data["calle"] = value
-                    if "EXTERIOR" in label.upper():
-                        page_data["n_ext"] = value
-                    if "INTERIOR" in label.upper():
-                        page_data["n_int"] = value
-                    if "COLONIA" in label.upper():
-                        page_data["colonia"] = value
-                    if "MUNICIPIO" in label.upper() or "DEMARCACION" in label.upper() or "ALCALDIA" in label.upper():
-                        page_data["municipio"] = value
-                    if "LOCALIDAD" in label.upper():
-                        page_data["localidad"] = value
-
-            # Si no se encontró RFC con <td>, buscar en toda la página con regex
-            if not page_data.get("rfc"):
-                rfc_match = re.search(
-                    r'\b([A-ZÑ&]{3,4}\d{6}[A-Z0-9]{3})\b',
-                    response.text,
-                    re.IGNORECASE,
-                )
-                if rfc_match:
-                    page_data["rfc"] = rfc_match.group(1).upper()
-                    _logger.info("CSF: RFC extraído via regex: %s", page_data["rfc"])
-
-            # Intentar también con <span>, <div>, <p> si aún no hay RFC
-            if not page_data.get("rfc"):
-                for tag in soup.find_all(["span", "div", "p", "li"]):
-                    text = tag.get_text(strip=True)
-                    if "RFC" in text.upper() and len(text) < 60:
-                        rfc_match = re.search(
-                            r'\b([A-ZÑ&]{3,4}\d{6}[A-Z0-9]{3})\b',
-                            text,
-                            re.IGNORECASE,
-                        )
-                        if rfc_match:
-                            page_data["rfc"] = rfc_match.group(1).upper()
-                            _logger.info("CSF: RFC extraído via tag alternativo: %s", page_data["rfc"])
-                            break
-
-            vals = {}
-            if page_data.get("rfc"):
-                vals["vat"] = page_data["rfc"]
-            if page_data.get("curp"):
-                vals["x_curp"] = page_data["curp"]
-            if page_data.get("cp"):
-                vals["zip"] = page_data["cp"]
-            calle = page_data.get("calle", "")
-            nexten = page_data.get("n_ext", "")
-            if calle:
-                vals["street"] = ("%s %s" % (calle, nexten)).strip()
-                vals["x_street_name"] = calle
-            if page_data.get("n_ext"):
-                vals["x_street_number_ext"] = page_data["n_ext"]
-            if page_data.get("n_int"):
-                vals["x_street_number_int"] = page_data["n_int"]
-            if page_data.get("colonia"):
-                vals["x_colonia"] = page_data["colonia"]
-            if page_data.get("municipio"):
-                vals["x_municipio"] = page_data["municipio"]
-            if page_data.get("localidad"):
-                vals["x_localidad"] = page_data["localidad"]
-            return vals
+            return self.env["mx.csf.extraction"].sudo()._extract_values(base64.b64decode(encoded_pdf))
         except Exception:
             _logger.exception("Error procesando CSF")
             return {}
 
+    @api.model
+    def _csf_sha256(self, encoded_pdf):
+        if not encoded_pdf:
+            return False
+        return hashlib.sha256(base64.b64decode(encoded_pdf)).hexdigest()
+
+    def _store_csf_document(self, content, filename, mimetype=None, sha256=None):
+        """Guarda un CSF recibido (bytes) en el contacto y como adjunto.
+
+        Si el contenido es el mismo CSF que ya tiene el contacto no hace nada.
+        El campo y el adjunto de trazabilidad tienen el mismo checksum, así que
+        en el filestore comparten un solo archivo; si el adjunto ya existe se
+        reutiliza en lugar de crear otro.
+
+        Returns:
+            bool: False si el CSF ya estaba cargado.
+        """
+        self.ensure_one()
+        sha256 = sha256 or hashlib.sha256(content).hexdigest()
+        if self.x_csf_sha256 == sha256:
+            return False
+        encoded = base64.b64encode(content)
+        self.write({
+            "x_csf_file": encoded,
+            "x_csf_filename": filename,
+            "x_csf_sha256": sha256,
+        })
+        Attachment = self.env["ir.attachment"].sudo()
+        checksum = Attachment._compute_checksum(content)
+        existing = Attachment.search([
+            ("res_model", "=", self._name),
+            ("res_id", "=", self.id),
+            ("res_field", "=", False),
+            ("checksum", "=", checksum),
+        ], limit=1)
+        if not existing:
+            # Guarda adjunto también para trazabilidad.
+            Attachment.create({
+                "name": filename,
+                "raw": content,
+                "mimetype": mimetype or "application/octet-stream",
+                "res_model": self._name,
+                "res_id": self.id,
+            })
+        return True
+
     @api.onchange("x_csf_file")
     def _onchange_x_csf_file(self):
         for rec in self:
@@ -447,12 +396,40 @@ class ResPartner(models.Model):
             if vals:
                 super(ResPartner, rec).write(vals)
 
+    @api.model
+    def _backfill_phone_last10(self):
+        """Llena los teléfonos normalizados de contactos previos al campo.
+
+        La llaman el post_init_hook y la migración 18.0.1.12.0.
+        """
+        for src, dst in (("phone", "x_phone_last10"), ("mobile", "x_mobile_last10")):
+            self.env.cr.execute(
+                f"""
+                UPDATE res_partner
+                   SET {dst} = right(regexp_replace({src}, '\\D', '', 'g'), 10)
+                 WHERE {dst} IS NULL AND {src} ~ '\\d'
+                """
+            )
+        self.invalidate_model(["x_phone_last10", "x_mobile_last10"])
+
+    @api.model
+    def _phone_index_vals(self, vals):
+        index_vals = {}
+        if "phone" in vals:
+            index_vals["x_phone_last10"] = phone_last10(vals["phone"])
+        if "mobile" in vals:
+            index_vals["x_mobile_last10"] = phone_last10(vals["mobile"])
+        return index_vals
+
     @api.model_create_multi
     def create(self, vals_list):
         for vals in vals_list:
             self._fill_missing_document_filenames(vals)
             if vals.get("x_csf_file"):
                 vals.update(self._extract_csf_values(vals.get("x_csf_file")))
+            if "x_csf_file" in vals and "x_csf_sha256" not in vals:
+                vals["x_csf_sha256"] = self._csf_sha256(vals["x_csf_file"])
+            vals.update(self._phone_index_vals(vals))
         return super().create(vals_list)
 
     def write(self, vals):
@@ -460,6 +437,15 @@ class ResPartner(models.Model):
         self._fill_missing_document_filenames(update_vals)
         if vals.get("x_csf_file"):
             update_vals.update(self._extract_csf_values(vals.get("x_csf_file")))
+        if "x_csf_file" in vals and "x_csf_sha256" not in vals:
+            update_vals["x_csf_sha256"] = self._csf_sha256(vals["x_csf_file"])
+        index_vals = self._phone_index_vals(vals)
+        if index_vals:
+            update_vals.update(index_vals)
+            _wa_partner_cache_wipe(
+                self.env.cr.dbname,
+                set(self.mapped("x_phone_last10")) | set(self.mapped("x_mobile_last10")),
+            )
         return super().write(update_vals)
 
     def action_open_gafete_qr_camera(self):
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+Motor compilado de reglas y simulador "what-if" de rulepacks.
+
+Un rulepack se compila a datos planos (selectores, escenarios y reglas de
+registro ya normalizadas) y el plan de registros de nivel pedimento se
+evalúa en memoria con el mismo algoritmo de precedencia que
+`mx.ped.operacion._build_record_plan`: `condition_match`, `rule_sort_key`
+y `apply_rule_to_state` son los mismos que usa la operación.
+
+Para simular un rulepack contra el historial:
+  - `snapshot_operaciones` lee en una sola consulta las entradas de
+    `_build_rule_context` de miles de operaciones.
+  - `simulate` evalúa el rulepack anterior y el nuevo de cada operación y
+    devuelve las diferencias de registros obligatorios/prohibidos.  Corre
+    en el proceso actual: un pool con fork dentro de un worker HTTP de Odoo
+    duplicaría la conexión a la base y los hilos del servidor.
+
+Simplificaciones respecto al plan en vivo: se ignora la regla de
+estructura fijada en la operación (se re-resuelve con cada rulepack) y no
+se aplica el modo STRICT (un rulepack sin escenario no lanza error).
+"""
+import re
+
+_EMPTY_STATE = {"required": False, "forbidden": False, "min": 0, "max": 0, "identifier": ""}
+
+
+# ── Matcher compilado ────────────────────────────────────────────────────────
+
+def compile_conditions(rule):
+    """Condiciones de un selector / regla de rulepack como dict plano."""
+    forma_pago_code = ""
+    if getattr(rule, "forma_pago_id", False):
+        forma_pago_code = str(rule.forma_pago_id.code or "").strip()
+    if not forma_pago_code:
+        forma_pago_code = str(getattr(rule, "forma_pago_code", "") or "").strip()
+    return {
+        "tipo_movimiento": rule.tipo_movimiento_id.code if getattr(rule, "tipo_movimiento_id", False) else False,
+        "tipo_operacion": getattr(rule, "tipo_operacion", False) or "",
+        "regimen": getattr(rule, "regimen", False) or "",
+        "clave_id": rule.clave_pedimento_id.id if getattr(rule, "clave_pedimento_id", False) else False,
+        "is_virtual": getattr(rule, "is_virtual", False) or "",
+        "es_rectificacion": getattr(rule, "es_rectificacion", "any") or "any",
+        "escenario": getattr(rule, "escenario_code", "") or "",
+        "fraccion_id": rule.fraccion_id.id if getattr(rule, "fraccion_id", False) else False,
+        "fraccion_capitulo": (getattr(rule, "fraccion_capitulo", "") or "").strip(),
+        "forma_pago_match": getattr(rule, "forma_pago_match", "any") or "any",
+        "forma_pago_code": forma_pago_code,
+    }
+
+
+def condition_match(cond, context):
+    """True si las condiciones compiladas aplican al contexto de la operación."""
+    if cond["tipo_movimiento"] and cond["tipo_movimiento"] != context.get("tipo_movimiento"):
+        return False
+    if cond["tipo_operacion"] not in ("", "ambas") and cond["tipo_operacion"] != context.get("tipo_operacion"):
+        return False
+    if cond["regimen"] not in ("", "cualquiera") and cond["regimen"] != context.get("regimen"):
+        return False
+    if cond["clave_id"] and cond["clave_id"] != context.get("clave_id"):
+        return False
+    if cond["is_virtual"] not in ("", "any"):
+        if (cond["is_virtual"] == "yes") != bool(context.get("is_virtual")):
+            return False
+    if cond["es_rectificacion"] != "any":
+        if (cond["es_rectificacion"] == "yes") != bool(context.get("es_rectificacion")):
+            return False
+    if cond["escenario"] not in ("", "any") and cond["escenario"] != context.get("escenario"):
+        return False
+    if cond["fraccion_id"] and cond["fraccion_id"] not in (context.get("fraccion_ids") or set()):
+        return False
+    if cond["fraccion_capitulo"] and cond["fraccion_capitulo"] not in (context.get("fraccion_capitulos") or set()):
+        return False
+    declared = context.get("declared_formas_pago") or set()
+    code = cond["forma_pago_code"]
+    if cond["forma_pago_match"] == "present":
+        if not code or code not in declared:
+            return False
+    elif cond["forma_pago_match"] == "absent":
+        if code and code in declared:
+            return False
+    return True
+
+
+def rule_sort_key(item):
+    return (
+        -(item.get("priority") or 0),
+        -(item.get("specificity_score") or 0),
+        -(item.get("source_weight") or 0),
+        item.get("rule_id") or 0,
+    )
+
+
+def apply_rule_to_state(state, rule_item):
+    policy = rule_item.get("policy")
+    min_occ = max(rule_item.get("min") or 0, 0)
+    max_occ = max(rule_item.get("max") or 0, 0)
+    identifier = (rule_item.get("identifier") or "").strip().upper()
+
+    if policy == "forbidden":
+        state["forbidden"] = True
+        state["required"] = False
+        state["min"] = 0
+        state["max"] = 0
+    elif policy == "required" and not state.get("forbidden"):
+        state["required"] = True
+        state["min"] = max(state["min"], max(min_occ, 1))
+    elif policy == "optional" and not state.get("forbidden"):
+        state["min"] = max(state["min"], min_occ)
+
+    if max_occ and not state.get("forbidden"):
+        state["max"] = max_occ if not state["max"] else min(state["max"], max_occ)
+    if identifier:
+        state["identifier"] = identifier
+
+
+def plan_states(normalized):
+    """Estados finales de nivel pedimento {codigo: state} para reglas normalizadas."""
+    grouped = {}
+    base_states = {}
+    for item in normalized:
+        code = item.get("record_code")
+        if not code:
+            continue
+        scope = item.get("scope") or "pedimento"
+        grouped.setdefault((code, scope), []).append(item)
+        if item.get("source") == "estructura" and scope == "pedimento":
+            apply_rule_to_state(base_states.setdefault(code, dict(_EMPTY_STATE)), item)
+
+    states = {}
+    for (code, scope), items in grouped.items():
+        if scope == "partida":
+            continue
+        state = dict(base_states.get(code, _EMPTY_STATE))
+        for item in sorted(items, key=rule_sort_key):
+            apply_rule_to_state(state, item)
+            if item.get("stop"):
+                break
+        if state.get("forbidden"):
+            state.update(required=False, min=0, max=0)
+        states[code] = state
+    return states
+
+
+# ── Compilación (lado ORM) ───────────────────────────────────────────────────
+
+def compile_rulepack(rulepack, operacion_model):
+    """Rulepack → dict plano picklable (selectores, escenarios, reglas de registro)."""
+    weights = operacion_model._get_source_weights(rulepack)
+
+    def _scenario(scenario):
+        if not scenario:
+            return None
+        return {
+            "code": scenario.code or "",
+            "estructura": operacion_model._normalize_structure_rules(
+                scenario.estructura_regla_id, weights["estructura"]
+            ),
+        }
+
+    selectors = rulepack.selector_ids.filtered(lambda r: r.active).sorted(
+        key=lambda r: (-r.priority, r.sequence, r.id)
+    )
+    scenarios = rulepack.scenario_ids.filtered(lambda s: s.active)
+    default = scenarios.filtered(lambda s: s.is_default)[:1] or scenarios[:1]
+    condition_rules = rulepack.condition_rule_ids.filtered(lambda r: r.active).sorted(
+        key=lambda r: (-r.priority, r.sequence, r.id)
+    )
+    return {
+        "id": rulepack.id,
+        "code": rulepack.code,
+        "weights": weights,
+        "selectors": [
+            {"cond": compile_conditions(sel), "stop": bool(sel.stop), "scenario": _scenario(sel.scenario_id)}
+            for sel in selectors
+        ],
+        "default_scenario": _scenario(default),
+        "condition_rules": [
+            (compile_conditions(rule), item)
+            for rule in condition_rules
+            for item in operacion_model._normalize_condition_rules(rule, weights["condition"])
+        ],
+    }
+
+
+def compile_claves(claves, operacion_model):
+    """{clave_id: reglas por clave normalizadas + datos de estructura}."""
+    return {
+        clave.id: {
+            "structure": clave.saai_structure_type or "auto",
+            "items": operacion_model._normalize_clave_rules(0, clave=clave),
+        }
+        for clave in claves
+    }
+
+
+def compile_estructura_fallback(reglas, operacion_model):
+    """Reglas de estructura legacy (cuando el escenario no trae regla base)."""
+    return [
+        {
+            "movs": {regla.tipo_movimiento_id.code, regla.tipo_movimiento} - {False, None, ""},
+            "escenario": regla.escenario or "",
+            "clave_id": regla.clave_pedimento_id.id or False,
+            "tipo_operacion": regla.tipo_operacion or "",
+            "regimen": regla.regimen or "",
+            "items": operacion_model._normalize_structure_rules(regla, 0),
+        }
+        for regla in reglas.sorted(lambda r: (-r.priority, -r.id))
+    ]
+
+
+def _fallback_estructura(fallback, snap, escenario):
+    """Misma puntuación que `_resolve_estructura_regla` sin rulepack."""
+    best, best_score = [], -1
+    for regla in fallback:
+        if snap["tipo_movimiento"] not in regla["movs"]:
+            continue
+        score = 0
+        if regla["escenario"] and regla["escenario"] != "generico":
+            if regla["escenario"] != escenario:
+                continue
+            score += 4
+        if regla["clave_id"]:
+            if regla["clave_id"] != snap["clave_id"]:
+                continue
+            score += 3
+        if regla["tipo_operacion"] and regla["tipo_operacion"] != "ambas":
+            if regla["tipo_operacion"] != snap["tipo_operacion"]:
+                continue
+            score += 2
+        if regla["regimen"] and regla["regimen"] != "cualquiera":
+            if regla["regimen"] != snap["regimen"]:
+                continue
+            score += 1
+        if score > best_score:
+            best, best_score = regla["items"], score
+    return best
+
+
+# ── Evaluación ───────────────────────────────────────────────────────────────
+
+def evaluate(pack, snap, claves, fallback):
+    """Estados de nivel pedimento de la operación `snap` bajo el rulepack `pack`."""
+    clave = claves.get(snap["clave_id"]) or {"structure": "auto", "items": []}
+    if not pack:
+        return plan_states(clave["items"])
+    weights = pack["weights"]
+    context = dict(snap, escenario="")
+
+    scenario = None
+    for selector in pack["selectors"]:
+        if not condition_match(selector["cond"], context):
+            continue
+        scenario = selector["scenario"]
+        if selector["stop"]:
+            break
+    scenario = scenario or pack["default_scenario"]
+
+    if scenario:
+        escenario = scenario["code"]
+    elif clave["structure"] != "auto":
+        escenario = clave["structure"]
+    else:
+        escenario = "generico"
+    context["escenario"] = escenario
+
+    estructura = scenario["estructura"] if scenario and scenario["estructura"] else [
+        dict(item, source_weight=weights["estructura"])
+        for item in _fallback_estructura(fallback, snap, escenario)
+    ]
+    items = list(estructura)
+    items.extend(dict(item, source_weight=weights["clave"]) for item in clave["items"])
+    items.extend(item for cond, item in pack["condition_rules"] if condition_match(cond, context))
+    return plan_states(items)
+
+
+def _state_label(state):
+    if not state:
+        return "-"
+    if state["forbidden"]:
+        return "prohibido"
+    limits = "%s..%s" % (state["min"], state["max"] or "n")
+    return ("obligatorio " if state["required"] else "opcional ") + limits
+
+
+def diff_states(old, new):
+    """Registros cuyo estado (obligatorio/prohibido/ocurrencias) cambia."""
+    changes = []
+    for code in sorted(set(old) | set(new)):
+        before, after = old.get(code), new.get(code)
+        keys = ("required", "forbidden", "min", "max")
+        if before and after and all(before[k] == after[k] for k in keys):
+            continue
+        if not before and not after:
+            continue
+        changes.append({"codigo": code, "antes": _state_label(before), "despues": _state_label(after)})
+    return changes
+
+
+def simulate(jobs, packs, claves, fallback):
+    """Evalúa [(snap, rulepack_anterior_id, rulepack_nuevo_id)] → [(operacion_id, cambios)]."""
+    result = []
+    for snap, old_id, new_id in jobs:
+        old = evaluate(packs.get(old_id), snap, claves, fallback)
+        new = evaluate(packs.get(new_id), snap, claves, fallback)
+        result.append((snap["id"], diff_states(old, new)))
+    return result
+
+
+# ── Snapshot de operaciones (una consulta) ───────────────────────────────────
+
+_SNAPSHOT_SQL = """
+    SELECT op.id,
+           op.name,
+           op.fecha_operacion,
+           op.rulepack_id,
+           COALESCE(NULLIF(tm.code, ''), op.tipo_movimiento) AS tipo_movimiento,
+           COALESCE(op.tipo_operacion, '') AS tipo_operacion,
+           COALESCE(op.regimen, '') AS regimen,
+           op.clave_pedimento_id,
+           COALESCE(clave.is_virtual, FALSE) AS is_virtual,
+           COALESCE(op.es_rectificacion, FALSE) AS es_rectificacion,
+           op.formas_pago_claves,
+           ARRAY(SELECT DISTINCT p.fraccion_id FROM mx_ped_partida p
+                  WHERE p.operacion_id = op.id AND p.fraccion_id IS NOT NULL) AS fraccion_ids,
+           ARRAY(SELECT DISTINCT f.capitulo FROM mx_ped_partida p
+                   JOIN mx_tigie_maestra f ON f.id = p.fraccion_id
+                  WHERE p.operacion_id = op.id AND f.capitulo IS NOT NULL) AS fraccion_capitulos,
+           ARRAY(
+               SELECT g.forma_pago_code FROM mx_ped_contribucion_global g
+                WHERE g.operacion_id = op.id AND g.forma_pago_code IS NOT NULL
+               UNION
+               SELECT c.forma_pago_code FROM mx_ped_partida_contribucion c
+                WHERE c.operacion_id = op.id AND c.forma_pago_code IS NOT NULL
+               UNION
+               SELECT fp.code FROM mx_ped_partida p
+                 JOIN mx_forma_pago fp ON fp.id = p.forma_pago_sugerida_id
+                WHERE p.operacion_id = op.id AND fp.code IS NOT NULL
+               UNION
+               SELECT d.forma_pago_code FROM mx_ped_documento d
+                WHERE d.operacion_id = op.id AND d.registro_codigo = '514'
+                  AND d.forma_pago_code IS NOT NULL
+           ) AS formas_pago
+      FROM mx_ped_operacion op
+      LEFT JOIN mx_ped_clave clave ON clave.id = op.clave_pedimento_id
+      LEFT JOIN mx_ped_tipo_movimiento tm ON tm.id = clave.tipo_movimiento_id
+     WHERE op.id = ANY(%s)
+     ORDER BY op.id
+"""
+
+
+def snapshot_operaciones(cr, ids):
+    """Entradas de `_build_rule_context` de las operaciones `ids` (una consulta)."""
+    cr.execute(_SNAPSHOT_SQL, [list(ids)])
+    snaps = []
+    for row in cr.dictfetchall():
+        formas = {str(code).strip() for code in row["formas_pago"] if str(code).strip()}
+        if not formas:
+            # Compatibilidad con captura legacy (_parse_formas_pago_claves)
+            formas = set(re.findall(r"\d+", row["formas_pago_claves"] or ""))
+        snaps.append({
+            "id": row["id"],
+            "name": row["name"] or "",
+            "fecha_operacion": row["fecha_operacion"],
+            "rulepack_id": row["rulepack_id"] or False,
+            "tipo_movimiento": row["tipo_movimiento"] or False,
+            "tipo_operacion": row["tipo_operacion"],
+            "regimen": row["regimen"],
+            "clave_id": row["clave_pedimento_id"] or False,
+            "is_virtual": bool(row["is_virtual"]),
+            "es_rectificacion": bool(row["es_rectificacion"]),
+            "fraccion_ids": set(row["fraccion_ids"]),
+            "fraccion_capitulos": set(row["fraccion_capitulos"]),
+            "declared_formas_pago": formas,
+        })
+    return snaps
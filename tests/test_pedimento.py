@@ -1,7 +1,17 @@
 # -*- coding: utf-8 -*-
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+from odoo import fields
 from odoo.tests.common import TransactionCase
 from odoo.exceptions import UserError
 
+from ..models.mx_ped_operacion import _compile_source_binding, _prorate_amounts
+from ..models import bl_parser, country_resolver, rulepack_simulator
+from ..models import mx_ped_validacion_wizard as validacion
+from ..models import mx_wa_inbox
+from ..models.mx_ped_registro import registro_meta
+
 
 class TestPedimento(TransactionCase):
     """Smoke tests para el modelo aduana.pedimento y exportacion TXT."""
@@ -84,6 +94,28 @@ class TestPedimento(TransactionCase):
         self.assertEqual(len(result), 6)
         self.assertEqual(result, "    42")
 
+    def test_prepare_txt_payload_usa_plan_compilado(self):
+        ped = self._make_pedimento()
+        tipo = self.env["aduana.layout_registro_tipo"].create({
+            "codigo": "T500",
+            "nombre": "Datos generales",
+            "campo_ids": [
+                (0, 0, {"secuencia": 2, "nombre_tecnico": "ref", "etiqueta": "Ref", "longitud": 4}),
+                (0, 0, {
+                    "secuencia": 1, "nombre_tecnico": "patente", "etiqueta": "Patente",
+                    "origen_modelo": "aduana.pedimento", "origen_campo": "patente",
+                }),
+            ],
+        })
+        self.env["aduana.pedimento.registro_tecnico"].create({
+            "pedimento_id": ped.id,
+            "registro_tipo_id": tipo.id,
+            "payload": {"ref": "AB"},
+        })
+        lines = ped.action_prepare_txt_payload()
+        self.assertEqual(lines[0]["values"], {"patente": "1234", "ref": "AB"})
+        self.assertEqual(lines[0]["campo_ids"].mapped("nombre_tecnico"), ["patente", "ref"])
+
     def test_format_txt_value_none_returns_empty(self):
         ped = self._make_pedimento()
         campo = type("Campo", (), {"tipo_dato": "char", "longitud": 0})()
@@ -91,6 +123,430 @@ class TestPedimento(TransactionCase):
         self.assertEqual(result, "")
 
 
+class TestMxPedOperacion(TransactionCase):
+    """Operación de pedimento: prorrateo, bindings de origen y caché de validación."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.partner = cls.env["res.partner"].create({"name": "Importador Operacion SA", "is_company": True})
+        cls.lead = cls.env["crm.lead"].create({
+            "name": "Expediente Operacion 001",
+            "partner_id": cls.partner.id,
+            "x_tipo_operacion": "importacion",
+        })
+
+    def test_prorate_amounts_reconciles_total(self):
+        partes = _prorate_amounts(100.0, [1 / 3.0] * 3)
+        self.assertEqual(partes, [33.34, 33.33, 33.33])
+        self.assertAlmostEqual(sum(partes), 100.0, places=2)
+
+    def test_compile_source_binding_resuelve_alias_una_vez(self):
+        self.assertEqual(
+            _compile_source_binding("Peso Bruto Total"),
+            ("record", "total_gross_weight", "operacion"),
+        )
+        self.assertEqual(_compile_source_binding("moneda", None, "cliente"), ("record", "currency_id", "cliente"))
+        self.assertEqual(_compile_source_binding("tipo_operacion")[0], "tipo_operacion")
+        self.assertEqual(_compile_source_binding("foo", "bar", "desconocido"), ("record", "bar", "lead"))
+
+    def test_validacion_cache_caduca_y_export_valida_en_vivo(self):
+        validacion.cache_put(("prueba",), "resultado")
+        self.assertEqual(validacion.cache_get(("prueba",)), "resultado")
+        with patch.object(validacion, "_RESULT_CACHE_TTL", -1):
+            self.assertIsNone(validacion.cache_get(("prueba",)))
+
+        op = self.env["mx.ped.operacion"].create({"name": "OP-CACHE", "lead_id": self.lead.id})
+        key = ("_validate_registros_vs_estructura", self.env.lang) + op._validacion_stamp()
+        validacion.cache_put(key, "error cacheado")
+        Operacion = type(op)
+        with patch.object(Operacion, "_validate_field_rules_on_registros", lambda self: True), \
+                patch.object(Operacion, "_validate_registros_vs_estructura", lambda self: True):
+            op._check_registros_exportables()
+        self.assertFalse(validacion.cache_get(key))
+        self.assertFalse(op._validacion_estructura_cacheada("_validate_registros_vs_estructura"))
+        otro_idioma = op.with_context(lang="en_US" if self.env.lang != "en_US" else "es_MX")
+        self.assertIsNone(validacion.cache_get(
+            ("_validate_registros_vs_estructura", otro_idioma.env.lang) + op._validacion_stamp()
+        ))
+
+
+    def test_rule_trace_no_versiona_plan_identico(self):
+        op = self.env["mx.ped.operacion"].create({"name": "OP-TRAZA", "lead_id": self.lead.id})
+        Trace = self.env["mx.ped.rule.trace"]
+        plan = {"trace": [{"record_code": "501", "decision": "required"}], "errors": []}
+        op._store_rule_trace(plan)
+        primera = op.rule_trace_id
+        self.assertTrue(primera)
+        op._store_rule_trace(dict(plan))
+        self.assertEqual(op.rule_trace_id, primera)
+        self.assertEqual(Trace.search_count([("operacion_id", "=", op.id)]), 1)
+
+        op._store_rule_trace(dict(plan, errors=["registro 501 faltante"]))
+        self.assertNotEqual(op.rule_trace_id, primera)
+        self.assertEqual(Trace.search_count([("operacion_id", "=", op.id)]), 2)
+
+
+class TestMxPedLayout(TransactionCase):
+    """Tabla de búsqueda del layout de exportación."""
+
+    def test_layout_lookup_ordena_campos_y_se_invalida(self):
+        layout = self.env["mx.ped.layout"].create({
+            "name": "Layout prueba",
+            "export_format": "pipe",
+            "registro_ids": [
+                (0, 0, {"codigo": "500", "orden": 20}),
+                (0, 0, {"codigo": "500", "orden": 5, "campo_ids": [
+                    (0, 0, {"nombre": "B", "orden": 2, "pos_ini": 1, "pos_fin": 3}),
+                    (0, 0, {"nombre": "A", "orden": 1, "pos_ini": 4, "pos_fin": 6}),
+                ]}),
+            ],
+        })
+        desc = layout._get_lookup().por_codigo["500"]
+        registro = self.env["mx.ped.layout.registro"].browse(desc.registro_id)
+        self.assertEqual(registro.orden, 5)
+        campos = self.env["mx.ped.layout.campo"]
+        self.assertEqual(campos.browse(desc.campo_ids).mapped("nombre"), ["A", "B"])
+        self.assertEqual(campos.browse(desc.campo_ids_posicion).mapped("nombre"), ["B", "A"])
+        registro.orden = 30
+        self.assertEqual(layout._get_lookup().por_codigo["500"].campo_ids, ())
+
+
+class TestMxPedRegistro(TransactionCase):
+    """Metadatos indexados de los registros de la operación."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        partner = cls.env["res.partner"].create({"name": "Importador Registro SA", "is_company": True})
+        cls.lead = cls.env["crm.lead"].create({"name": "Expediente Registro 001", "partner_id": partner.id})
+
+    @staticmethod
+    def _deseado(codigo, secuencia, key, **valores):
+        valores.update({"__sync_origin": "auto", "__sync_key": key})
+        return {"codigo": codigo, "secuencia": secuencia, "key": key, "valores": valores}
+
+    def test_registro_meta_extrae_columnas_indexadas(self):
+        meta = registro_meta({
+            "Numero_Partida": "P-0007",
+            "__sync_origin": "auto",
+            "__sync_key": "551:7",
+            "__source_id": 42,
+        })
+        digest = meta.pop("valores_hash")
+        self.assertEqual(
+            meta,
+            {"partida_numero": 7, "sync_origin": "auto", "sync_key": "551:7", "source_id": 42},
+        )
+        self.assertEqual(digest, registro_meta({
+            "__source_id": 42,
+            "__sync_key": "551:7",
+            "__sync_origin": "auto",
+            "Numero_Partida": "P-0007",
+        })["valores_hash"])
+        self.assertEqual(registro_meta(None)["partida_numero"], 0)
+
+    def test_apply_registro_diff_crea_actualiza_y_elimina_por_llave(self):
+        op = self.env["mx.ped.operacion"].create({"name": "OP-DIFF", "lead_id": self.lead.id})
+        op._apply_registro_diff([
+            self._deseado("501", 1, "501:1", clave_pedimento="A1"),
+            self._deseado("551", 1, "551:1", numero_partida="1", fraccion="84713012"),
+            self._deseado("551", 2, "551:2", numero_partida="2", fraccion="84714101"),
+        ])
+        por_llave = {reg.sync_key: reg for reg in op.registro_ids}
+        self.assertEqual(set(por_llave), {"501:1", "551:1", "551:2"})
+        self.assertEqual(por_llave["551:2"].partida_numero, 2)
+
+        # Fecha vieja para distinguir las filas que el segundo diff toca
+        self.env.cr.execute(
+            "UPDATE mx_ped_registro SET write_date = '2000-01-01' WHERE operacion_id = %s", [op.id]
+        )
+        op.registro_ids.invalidate_recordset()
+        intacto = por_llave["501:1"]
+        hash_intacto = intacto.valores_hash
+
+        op._apply_registro_diff([
+            self._deseado("501", 1, "501:1", clave_pedimento="A1"),
+            self._deseado("551", 1, "551:1", numero_partida="7", fraccion="84713099"),
+            self._deseado("552", 1, "552:1", identificador="EC"),
+        ])
+        op.invalidate_recordset(["registro_ids"])
+        por_llave = {reg.sync_key: reg for reg in op.registro_ids}
+        self.assertEqual(set(por_llave), {"501:1", "551:1", "552:1"})
+        self.assertFalse(self.env["mx.ped.registro"].search([("sync_key", "=", "551:2"), ("operacion_id", "=", op.id)]))
+
+        self.assertEqual(por_llave["501:1"], intacto)
+        self.assertEqual(str(intacto.write_date), "2000-01-01 00:00:00")
+        self.assertEqual(intacto.valores_hash, hash_intacto)
+
+        cambiado = por_llave["551:1"]
+        self.assertEqual(cambiado.valores["fraccion"], "84713099")
+        self.assertEqual(cambiado.partida_numero, 7)
+        self.assertEqual(cambiado.valores_hash, registro_meta(cambiado.valores)["valores_hash"])
+        self.assertNotEqual(str(cambiado.write_date), "2000-01-01 00:00:00")
+
+
+class TestPedimentoProforma(TransactionCase):
+    """Documento del pedimento: TXT y proforma PDF."""
+
+    def test_documento_txt_y_proforma_consistentes(self):
+        from ..models.pedimento_proforma_v2 import (
+            DEMO_TXT, Partida, Pedimento, documento_from_txt, merge_declarado,
+        )
+
+        doc = documento_from_txt(DEMO_TXT)
+        self.assertEqual(doc.to_txt(), DEMO_TXT.strip())
+        declarado = doc.to_pedimento()
+        base = Pedimento(domicilio="DOMICILIO ORM", num_pedimento="ORM")
+        base.partidas = [Partida(secuencia="1", pais_venta="USA")]
+        ped = merge_declarado(base, declarado)
+        self.assertEqual(ped.num_pedimento, declarado.num_pedimento)
+        self.assertEqual(ped.partidas[0].pais_venta, "USA")
+        self.assertEqual(ped.partidas[0].fraccion, declarado.partidas[0].fraccion)
+
+    def test_proforma_mapea_layout_voce_por_nombre(self):
+        from ..models.pedimento_proforma_v2 import (
+            Partida, Pedimento, PedimentoDocumento, RegistroDoc, merge_declarado,
+        )
+
+        layout = self.env["mx.ped.layout"].search([("name", "=", "VOCE SAAI M3 v9.0")], limit=1)
+        lookup = layout._get_lookup()
+        Campo = self.env["mx.ped.layout.campo"]
+
+        def registro(codigo, **valores):
+            nombres = tuple(Campo.browse(lookup.por_codigo[codigo].campo_ids).mapped("nombre"))
+            valores["clave_registro"] = codigo
+            return RegistroDoc(codigo, tuple(valores.get(n, "") for n in nombres), nombres=nombres)
+
+        doc = PedimentoDocumento(registros=[
+            registro("500", tipo_movimiento="1", patente="3026", numero_pedimento="6000123"),
+            registro("501", numero_pedimento="6000123", tipo_operacion="1", clave_pedimento="A1"),
+            registro("510", numero_pedimento="6000123", clave_contribucion="6", forma_pago="0", importe="100"),
+            registro("551", numero_pedimento="6000123", numero_partida="2", fraccion_arancelaria="84713012"),
+        ])
+        declarado = doc.to_pedimento()
+        self.assertEqual(declarado.num_pedimento, "6000123")
+        self.assertEqual(declarado.tipo_operacion, "1")
+        self.assertEqual(declarado.clave_pedimento, "A1")
+        self.assertEqual(declarado.agente.patente, "3026")
+        self.assertEqual([c.importe for c in declarado.contribuciones_liq], ["100"])
+
+        base = Pedimento()
+        base.partidas = [Partida(secuencia="1"), Partida(secuencia="2", pais_venta="USA")]
+        ped = merge_declarado(base, declarado)
+        self.assertEqual([p.secuencia for p in ped.partidas], ["1", "2"])
+        self.assertEqual(ped.partidas[1].fraccion, "84713012")
+        self.assertEqual(ped.partidas[1].pais_venta, "USA")
+
+    def test_proforma_reutiliza_forms_anidados(self):
+        from ..models.pedimento_proforma_v2 import DEMO_TXT, PedimentoPDF, parse_txt
+
+        con_forms = PedimentoPDF(parse_txt(DEMO_TXT), reuse_forms=True)
+        pdf = con_forms.build()
+        self.assertTrue(pdf.startswith(b"%PDF"))
+        self.assertFalse(con_forms._in_form)
+        nombres = [name for name, _alto in con_forms._forms.values()]
+        self.assertEqual(len(nombres), len(set(nombres)))
+        directo = PedimentoPDF(parse_txt(DEMO_TXT), reuse_forms=False)
+        directo.build()
+        self.assertEqual(con_forms.pg, directo.pg)
+
+
+class TestCountryResolver(TransactionCase):
+    """Resolución de países por clave y nombre SAAI."""
+
+    def test_country_resolver_usa_claves_y_nombres_saai(self):
+        mapa = country_resolver.build_map(
+            [("MX", {"en_US": "Mexico", "es_MX": "México"}), ("US", "United States")],
+            [("MEX", "MÉXICO", "MX"), ("USA", "ESTADOS UNIDOS DE AMERICA", "US")],
+        )
+        self.assertEqual(mapa.resolve("méxico"), "MX")
+        self.assertEqual(mapa.resolve("USA"), "US")
+        self.assertEqual(mapa.resolve("Estados Unidos de América"), "US")
+        self.assertEqual(mapa.resolve("United"), "US")
+        self.assertIsNone(mapa.resolve("Narnia"))
+
+
+class TestBlParser(TransactionCase):
+    """Extracción de datos del conocimiento de embarque (B/L)."""
+
+    def test_bl_parser_no_trunca_kgs(self):
+        datos = bl_parser.parse_bl_text("GROSS WEIGHT 1234567 KGS 35.50 CBM MSCU1234567/40'")
+        self.assertEqual(datos["kgs"], "1234567")
+        self.assertEqual(datos["cbm"], "35.50")
+        self.assertEqual(datos["container"], "MSCU1234567")
+        self.assertEqual(bl_parser.parse_bl_text("12500.125 KGS")["kgs"], "12500.125")
+
+
+class TestMxCsfExtraction(TransactionCase):
+    """Cola de extracción de CSF del portal."""
+
+    def test_csf_extraction_limita_tamano_y_expira_pendientes(self):
+        Extraction = self.env["mx.csf.extraction"]
+        self.env["ir.config_parameter"].sudo().set_param("mx_ped.csf.max_pdf_mb", "1")
+        resultado = Extraction._submit(b"0" * (1024 * 1024 + 1))
+        self.assertEqual(resultado["state"], "error")
+
+        job = Extraction.create({"sha256": "0" * 64})
+        self.env.cr.execute(
+            "UPDATE mx_csf_extraction SET create_date = (now() at time zone 'UTC') - interval '3 hours' WHERE id = %s", [job.id]
+        )
+        job.invalidate_recordset()
+        Extraction.cron_limpiar_extracciones_csf()
+        self.assertEqual(job.state, "error")
+
+
+class TestMxPedRulepack(TransactionCase):
+    """Índice de vigencia de rulepacks por fecha."""
+
+    def _pack(self, code, priority, inicio, fin):
+        return self.env["mx.ped.rulepack"].create({
+            "name": code,
+            "code": code,
+            "priority": priority,
+            "state": "active",
+            "fecha_inicio": inicio,
+            "fecha_fin": fin,
+        })
+
+    def test_resolve_many_respeta_precedencia_y_cortes(self):
+        Rulepack = self.env["mx.ped.rulepack"]
+        Rulepack.search([]).write({"active": False})
+        a = self._pack("TEST-A", 10, "1990-01-01", "1990-06-30")
+        b = self._pack("TEST-B", 20, "1990-03-01", "1990-03-31")
+        c = self._pack("TEST-C", 20, "1990-03-15", "1990-03-20")
+        # Misma prioridad y fecha_inicio que C: gana el id mayor
+        d = self._pack("TEST-D", 20, "1990-03-15", "1990-03-17")
+        esperado = {
+            "1989-12-31": False,  # antes del primer rulepack
+            "1990-01-15": a.id,
+            "1990-03-01": b.id,
+            "1990-03-15": d.id,
+            "1990-03-17": d.id,
+            "1990-03-18": c.id,  # fecha_fin + 1 de D
+            "1990-03-21": b.id,  # fecha_fin + 1 de C
+            "1990-04-01": a.id,  # fecha_fin + 1 de B
+            "1990-06-30": a.id,
+            "1990-07-01": False,
+        }
+        fechas = {fields.Date.to_date(fecha): pack_id for fecha, pack_id in esperado.items()}
+        self.assertEqual(Rulepack._resolve_many(fechas), fechas)
+
+        b.priority = 5
+        marzo = fields.Date.to_date("1990-03-01")
+        self.assertEqual(Rulepack._resolve_many([marzo]), {marzo: a.id})
+
+
+class TestRulepackSimulator(TransactionCase):
+    """Simulador what-if de rulepacks."""
+
+    def test_rulepack_simulator_reporta_registro_prohibido(self):
+        base = {"rule_id": 1, "source": "estructura", "record_code": "501",
+                "policy": "required", "min": 1, "max": 1, "source_weight": 10}
+        prohibe = {"rule_id": 2, "source": "condition", "record_code": "501",
+                   "policy": "forbidden", "priority": 5, "source_weight": 30}
+        antes = rulepack_simulator.plan_states([base])
+        despues = rulepack_simulator.plan_states([base, prohibe])
+        self.assertEqual(
+            rulepack_simulator.diff_states(antes, despues),
+            [{"codigo": "501", "antes": "obligatorio 1..1", "despues": "prohibido"}],
+        )
+        self.assertEqual(rulepack_simulator.diff_states(antes, antes), [])
+
+
+class TestMxWaInbox(TransactionCase):
+    """Bandeja asíncrona de mensajes de WhatsApp."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.Inbox = cls.env["mx.wa.inbox"]
+
+    @staticmethod
+    def _webhook(message_id, msg_type="text"):
+        msg = {"from": "5215512345678", "id": message_id, "type": msg_type, "text": {"body": "hola"}}
+        return {"entry": [{"changes": [{"value": {"messages": [msg]}}]}]}
+
+    def test_encolar_payload_ignora_reintentos_de_meta(self):
+        self.assertEqual(self.Inbox._encolar_payload(self._webhook("wamid.DUP")), 1)
+        self.assertEqual(self.Inbox._encolar_payload(self._webhook("wamid.DUP")), 0)
+        self.assertEqual(self.Inbox.search_count([("message_id", "=", "wamid.DUP")]), 1)
+
+    def test_cron_reintenta_con_backoff_y_marca_fallido(self):
+        self.env["ir.config_parameter"].sudo().set_param("mx_ped.wa_inbox.max_attempts", "2")
+        self.Inbox._encolar_payload(self._webhook("wamid.FALLA"))
+        item = self.Inbox.search([("message_id", "=", "wamid.FALLA")])
+
+        def _falla(record):
+            raise ValueError("Graph API caída")
+
+        with patch.object(type(self.Inbox), "_procesar_mensaje", _falla):
+            self.Inbox.cron_procesar_wa_inbox()
+            self.assertEqual(item.state, "pending")
+            self.assertEqual(item.attempts, 1)
+            self.assertGreater(item.next_attempt_at, fields.Datetime.now())
+            self.assertIn("Graph API caída", item.last_error)
+
+            # Aún no vence el backoff: la corrida no lo toma
+            self.Inbox.cron_procesar_wa_inbox()
+            self.assertEqual(item.attempts, 1)
+
+            item.next_attempt_at = fields.Datetime.now() - timedelta(minutes=1)
+            self.Inbox.cron_procesar_wa_inbox()
+            self.assertEqual(item.state, "failed")
+            self.assertEqual(item.attempts, 2)
+
+    def test_action_reintentar_regresa_fallidos_a_pendiente(self):
+        self.Inbox._encolar_payload(self._webhook("wamid.REINTENTO"))
+        item = self.Inbox.search([("message_id", "=", "wamid.REINTENTO")])
+        item.write({"state": "failed", "attempts": 5, "last_error": "x"})
+        item.action_reintentar()
+        self.assertEqual(item.state, "pending")
+        self.assertEqual(item.attempts, 0)
+        self.assertFalse(item.next_attempt_at)
+        self.assertFalse(item.last_error)
+
+        with patch.object(type(self.Inbox), "_procesar_mensaje", lambda record: None):
+            self.Inbox.cron_procesar_wa_inbox()
+        self.assertEqual(item.state, "done")
+
+    def test_download_media_no_descarga_csf_conocido(self):
+        self.env["ir.config_parameter"].sudo().set_param("modulo_aduana_odoo.whatsapp_token", "token")
+        http = MagicMock()
+        http.get.return_value.json.return_value = {
+            "url": "https://lookaside.example/media", "mime_type": "application/pdf",
+            "file_size": 1024, "sha256": "a" * 64,
+        }
+        with patch.object(mx_wa_inbox, "_wa_http", return_value=http):
+            media = self.Inbox._download_media("MEDIA1", known_sha256="a" * 64)
+        self.assertIsNone(media["content"])
+        self.assertEqual(media["sha256"], "a" * 64)
+        # Solo la consulta de metadatos; el archivo no se pide
+        http.get.assert_called_once()
+        self.assertNotIn("stream", http.get.call_args.kwargs)
+
+
+class TestResPartnerCsf(TransactionCase):
+    """CSF recibido por WhatsApp guardado en el contacto."""
+
+    def test_store_csf_document_no_duplica_el_mismo_csf(self):
+        partner = self.env["res.partner"].create({"name": "Cliente CSF", "is_company": True})
+        contenido = b"%PDF-1.4 constancia de situacion fiscal"
+        Partner = type(partner)
+        with patch.object(Partner, "_extract_csf_values", lambda self, encoded: {}):
+            self.assertTrue(partner._store_csf_document(contenido, "csf.pdf", mimetype="application/pdf"))
+            sha256 = partner.x_csf_sha256
+            self.assertFalse(partner._store_csf_document(contenido, "csf_otra_vez.pdf"))
+        adjuntos = self.env["ir.attachment"].search([
+            ("res_model", "=", "res.partner"),
+            ("res_id", "=", partner.id),
+            ("res_field", "=", False),
+        ])
+        self.assertEqual(len(adjuntos), 1)
+        self.assertEqual(partner.x_csf_sha256, sha256)
+        self.assertEqual(partner.x_csf_filename, "csf.pdf")
+
+
 class TestCrmLeadAduanal(TransactionCase):
     """Smoke tests para campos aduanales en crm.lead."""
 